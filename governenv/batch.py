@@ -0,0 +1,380 @@
+"""Sharded OpenAI batch jobs tracked in a local ledger."""
+
+import json
+import os
+import sqlite3
+import time
+import zlib
+from typing import Iterator, Optional
+
+from governenv.constants import (
+    OPENAI_BATCH_MAX_BYTES,
+    OPENAI_BATCH_MAX_REQUESTS,
+    OPENAI_BATCH_QUEUE_TOKENS,
+)
+from governenv.llm import (
+    BATCH_TERMINAL,
+    ChatGPT,
+    estimate_tokens,
+    iter_batch_output,
+    iter_jsonl,
+)
+from governenv.llmcache import prompt_key
+
+ACTIVE = {"validating", "in_progress", "finalizing", "cancelling"}
+
+
+class BatchRunner:
+    """Run batch requests as shards that fit the OpenAI batch limits.
+
+    Requests are packed into shard files below the request, byte and token
+    caps of a batch, and shards are submitted while the tokens of the
+    unfinished shards fit the enqueued-token quota of the organisation.
+    The ledger in the directory records every shard with its batch id and
+    status, so a driver started again re-attaches to the batches in flight
+    instead of submitting them twice. Requests are known to the ledger by
+    custom_id and the hash of their body and prompt version, so a changed
+    prompt is sent again under the same custom_id. Once a shard ends, the
+    custom_ids that failed, expired or are missing from its output go to a
+    new shard, up to max_attempts times.
+    """
+
+    def __init__(
+        self,
+        gpt: ChatGPT,
+        directory: str,
+        max_requests: int = OPENAI_BATCH_MAX_REQUESTS,
+        max_bytes: int = OPENAI_BATCH_MAX_BYTES,
+        queue_tokens: int = OPENAI_BATCH_QUEUE_TOKENS,
+        max_tokens: Optional[int] = None,
+        max_attempts: int = 3,
+        poll_interval: float = 30,
+        max_poll_interval: float = 600,
+    ):
+        self.gpt = gpt
+        self.directory = str(directory)
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.queue_tokens = queue_tokens
+        # several shards in the queue at once by default
+        self.max_tokens = max_tokens or queue_tokens // 4
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.ledger_path = os.path.join(self.directory, "ledger.json")
+        self.ledger = {"shards": {}}
+
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.ledger_path):
+            with open(self.ledger_path, "r", encoding="utf-8") as f:
+                self.ledger = json.load(f)
+
+    @property
+    def shards(self) -> dict[str, dict]:
+        """Ledger entries of the shards by shard id."""
+        return self.ledger["shards"]
+
+    def save(self) -> None:
+        """Persist the ledger."""
+        with open(f"{self.ledger_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(self.ledger, f, indent=4)
+        os.replace(f"{self.ledger_path}.tmp", self.ledger_path)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def request_key(self, request: dict) -> tuple[str, str]:
+        """Identify a request by custom_id and the hash of its body."""
+        return request["custom_id"], prompt_key(
+            request["body"], self.gpt.prompt_version or ""
+        )
+
+    def read_requests(self, shard_id: str) -> list[dict]:
+        """Read the requests of a shard."""
+        with open(
+            self._path(self.shards[shard_id]["file"]), "r", encoding="utf-8"
+        ) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def output_path(self, shard_id: str) -> Optional[str]:
+        """Get the path of the output file of a finished shard, if any."""
+        output = self.shards[shard_id].get("output")
+        if not output or not os.path.exists(self._path(output)):
+            return None
+        return self._path(output)
+
+    def iter_output(self, shard_id: str) -> Iterator[dict]:
+        """Read the output lines of a finished shard one at a time."""
+        path = self.output_path(shard_id)
+        if path:
+            yield from iter_jsonl(path)
+
+    def add_shards(self, requests: list[dict], attempt: int = 1) -> list[str]:
+        """Pack requests into shard files below the batch caps and add them."""
+
+        shard_ids = []
+        lines, tokens, size = [], 0, 0
+
+        def flush() -> None:
+            shard_id = f"shard_{len(self.shards):05d}"
+            name = f"{shard_id}.jsonl"
+            with open(self._path(name), "w", encoding="utf-8") as f:
+                f.writelines(lines)
+            self.shards[shard_id] = {
+                "file": name,
+                "requests": len(lines),
+                "tokens": tokens,
+                "attempt": attempt,
+                "batch_id": None,
+                "status": "pending",
+                "output": None,
+            }
+            shard_ids.append(shard_id)
+
+        for request in requests:
+            line = json.dumps(request) + "\n"
+            request_tokens = estimate_tokens(request["body"])
+            if lines and (
+                len(lines) >= self.max_requests
+                or size + len(line.encode()) > self.max_bytes
+                or tokens + request_tokens > self.max_tokens
+            ):
+                flush()
+                lines, tokens, size = [], 0, 0
+            lines.append(line)
+            tokens += request_tokens
+            size += len(line.encode())
+        if lines:
+            flush()
+
+        self.save()
+        return shard_ids
+
+    def submit(self, shard_id: str) -> None:
+        """Upload a shard and create its batch.
+
+        The file id is saved before the batch is created, so a shard left
+        submitting by a crash is matched to the batch created from its file
+        instead of being submitted twice.
+        """
+        shard = self.shards[shard_id]
+        if shard["status"] == "submitting":
+            # batch listings are newest first, allow for clock skew
+            shard["batch_id"] = self.gpt.find_batch(
+                shard["input_file_id"], shard["uploaded_at"] - 600
+            )
+        else:
+            shard["input_file_id"] = self.gpt.upload_batch(self._path(shard["file"]))
+            shard["uploaded_at"] = time.time()
+            shard["status"] = "submitting"
+            self.save()
+        if not shard["batch_id"]:
+            shard["batch_id"] = self.gpt.create_batch(shard["input_file_id"])
+        shard["status"] = "validating"
+        self.save()
+
+    def download(self, shard_id: str, file_id: Optional[str]) -> None:
+        """Save the output file of a batch next to its shard."""
+        if not file_id:
+            return
+        name = f"{shard_id}.output.jsonl"
+        self.gpt.download_file(file_id, self._path(name))
+        self.shards[shard_id]["output"] = name
+
+    def finish(self, shard_id: str, batch) -> None:
+        """Collect a batch that ended and reshard its failed requests."""
+
+        shard = self.shards[shard_id]
+        # expired and cancelled batches keep the output of finished requests
+        self.download(shard_id, batch.output_file_id)
+        shard["status"] = batch.status
+
+        requests = self.read_requests(shard_id)
+        self.gpt.cache_batch_output(requests, self.iter_output(shard_id))
+        path = self.output_path(shard_id)
+        succeeded = {
+            custom_id
+            for custom_id, result in (iter_batch_output(path) if path else [])
+            if result["status_code"] == 200
+        }
+        failed = [r for r in requests if r["custom_id"] not in succeeded]
+        shard["failed"] = len(failed)
+
+        if failed and shard["attempt"] < self.max_attempts:
+            print(f"{shard_id} {batch.status}, resubmitting {len(failed)} requests")
+            self.add_shards(failed, shard["attempt"] + 1)
+        elif failed:
+            print(f"{shard_id} gave up on {len(failed)} requests")
+        self.save()
+
+    def run(self, requests: list[dict], output_path: str) -> str:
+        """Run requests to completion and write the successful output lines.
+
+        Requests answered by the response cache are not sent, and requests
+        already in a shard of the ledger are not sharded again. The output
+        lines of the given requests are streamed into output_path, which is
+        returned.
+        """
+
+        pending, cached = self.gpt.filter_cached(requests)
+        known = {
+            self.request_key(request)
+            for shard_id in self.shards
+            for request in self.read_requests(shard_id)
+        }
+        new = [request for request in pending if self.request_key(request) not in known]
+        if new:
+            self.add_shards(new)
+        print(f"{len(new)} new requests, {len(self.shards)} shards in the ledger")
+
+        interval = self.poll_interval
+
+        while True:
+            queued = [s for s, e in self.shards.items() if e["status"] in ACTIVE]
+            waiting = [
+                s
+                for s, e in self.shards.items()
+                if e["status"] in ("pending", "submitting")
+            ]
+            if not queued and not waiting:
+                break
+
+            # submit while the unfinished shards fit the enqueued token quota
+            enqueued = sum(self.shards[s]["tokens"] for s in queued)
+            for shard_id in waiting:
+                tokens = self.shards[shard_id]["tokens"]
+                if queued and enqueued + tokens > self.queue_tokens:
+                    break
+                self.submit(shard_id)
+                queued.append(shard_id)
+                enqueued += tokens
+
+            # back off while no shard changes its status
+            time.sleep(interval)
+            interval = min(interval * 1.5, self.max_poll_interval)
+            for shard_id in queued:
+                batch = self.gpt.client.batches.retrieve(
+                    self.shards[shard_id]["batch_id"]
+                )
+                if batch.status == self.shards[shard_id]["status"]:
+                    continue
+                interval = self.poll_interval
+                if batch.status in BATCH_TERMINAL:
+                    self.finish(shard_id, batch)
+                else:
+                    self.shards[shard_id]["status"] = batch.status
+                    self.save()
+
+        # finished shards also fill the response cache, so a rerun finds the
+        # same answers in both and every custom_id is written once, shards of
+        # earlier prompts under the same custom_id are left out
+        current = {self.request_key(request) for request in requests}
+        written = set()
+        with open(f"{output_path}.tmp", "w", encoding="utf-8") as f:
+            for line in cached:
+                f.write(json.dumps(line) + "\n")
+                written.add(line["custom_id"])
+            for shard_id in self.shards:
+                keys = {
+                    request["custom_id"]: self.request_key(request)
+                    for request in self.read_requests(shard_id)
+                }
+                for line in self.iter_output(shard_id):
+                    if (
+                        (line.get("response") or {}).get("status_code") == 200
+                        and keys.get(line["custom_id"]) in current
+                        and line["custom_id"] not in written
+                    ):
+                        f.write(json.dumps(line) + "\n")
+                        written.add(line["custom_id"])
+        os.replace(f"{output_path}.tmp", output_path)
+        return output_path
+
+
+class BatchResults:
+    """Parsed batch results keyed by custom_id in a single SQLite file.
+
+    Output files are loaded line by line, so results of any size are
+    available by custom_id without reading the whole file into memory.
+    """
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        self._db = sqlite3.connect(self.path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "custom_id TEXT PRIMARY KEY, status_code INTEGER, content TEXT, "
+            "logprobs BLOB, error TEXT)"
+        )
+        self._db.commit()
+
+    def load(self, output_path: str, chunk_size: int = 1000) -> int:
+        """Add the results of a batch output file, returns the number of lines."""
+
+        def rows() -> Iterator[tuple]:
+            for custom_id, result in iter_batch_output(output_path):
+                yield (
+                    custom_id,
+                    result["status_code"],
+                    result["content"],
+                    (
+                        zlib.compress(json.dumps(result["logprobs"]).encode())
+                        if result["logprobs"] is not None
+                        else None
+                    ),
+                    json.dumps(result["error"]) if result["error"] else None,
+                )
+
+        count = 0
+        chunk = []
+        for row in rows():
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                count += self._insert(chunk)
+                chunk = []
+        return count + self._insert(chunk)
+
+    def _insert(self, rows: list[tuple]) -> int:
+        self._db.executemany(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", rows
+        )
+        self._db.commit()
+        return len(rows)
+
+    def _parse(self, row: tuple) -> dict:
+        status_code, content, logprobs, error = row
+        return {
+            "status_code": status_code,
+            "content": content,
+            "logprobs": json.loads(zlib.decompress(logprobs)) if logprobs else None,
+            "error": json.loads(error) if error else None,
+        }
+
+    def __getitem__(self, custom_id: str) -> dict:
+        row = self._db.execute(
+            "SELECT status_code, content, logprobs, error FROM results "
+            "WHERE custom_id = ?",
+            (custom_id,),
+        ).fetchone()
+        if row is None:
+            raise KeyError(custom_id)
+        return self._parse(row)
+
+    def __contains__(self, custom_id: str) -> bool:
+        return (
+            self._db.execute(
+                "SELECT 1 FROM results WHERE custom_id = ?", (custom_id,)
+            ).fetchone()
+            is not None
+        )
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def items(self) -> Iterator[tuple[str, dict]]:
+        """Iterate over the results in custom_id order."""
+        for custom_id, *row in self._db.execute(
+            "SELECT custom_id, status_code, content, logprobs, error FROM results "
+            "ORDER BY custom_id"
+        ):
+            yield custom_id, self._parse(tuple(row))
@@ -0,0 +1,143 @@
+"""Local index from timestamps to Ethereum blocks."""
+
+import asyncio
+import os
+from typing import Iterable, Optional
+
+import numpy as np
+
+from governenv.rpc import RPCPool
+
+SAMPLE_DTYPE = np.dtype([("block", "<i8"), ("timestamp", "<i8")])
+
+
+class BlockIndex:
+    """Sampled (block, timestamp) pairs of the chain in an append-only log.
+
+    A timestamp resolves to the last block mined at or before it. A binary
+    search brackets the timestamp between known samples, and the timestamp is
+    resolved locally once the bracket is two adjacent blocks. Otherwise the
+    block is guessed by interpolation inside the bracket, falling back to
+    bisection after a few rounds, and the guesses of all pending timestamps
+    are fetched together in batched header requests. Every header is appended
+    to the log, a record torn by a crash is dropped on load.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        grid: int = 10_000,
+        batch_size: int = 100,
+        interpolation_rounds: int = 4,
+    ):
+        self.path = str(path)
+        self.grid = grid
+        self.batch_size = batch_size
+        self.interpolation_rounds = interpolation_rounds
+        self.blocks = np.empty(0, dtype=np.int64)
+        self.timestamps = np.empty(0, dtype=np.int64)
+
+        if os.path.exists(self.path):
+            size = os.path.getsize(self.path)
+            complete = size - size % SAMPLE_DTYPE.itemsize
+            if complete < size:
+                with open(self.path, "r+b") as f:
+                    f.truncate(complete)
+            self._merge(np.fromfile(self.path, dtype=SAMPLE_DTYPE))
+
+    def __len__(self) -> int:
+        return len(self.blocks)
+
+    def _merge(self, samples: np.ndarray) -> None:
+        """Merge samples into the sorted arrays."""
+        blocks, first = np.unique(
+            np.concatenate([self.blocks, samples["block"]]), return_index=True
+        )
+        self.timestamps = np.concatenate([self.timestamps, samples["timestamp"]])[first]
+        self.blocks = blocks
+
+    def add(self, samples: Iterable[tuple[int, int]]) -> None:
+        """Append (block, timestamp) samples to the log and the index."""
+        samples = np.array(list(samples), dtype=SAMPLE_DTYPE)
+        with open(self.path, "ab") as f:
+            f.write(samples.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self._merge(samples)
+
+    def bracket(self, timestamp: int) -> tuple[int, int]:
+        """Get the indices of the samples around a timestamp, -1 if outside."""
+        i = int(np.searchsorted(self.timestamps, timestamp, side="right")) - 1
+        if i < 0 or i + 1 >= len(self.blocks):
+            return -1, -1
+        return i, i + 1
+
+    def lookup(self, timestamp: int) -> Optional[int]:
+        """Resolve a timestamp from the samples alone, None if not resolvable."""
+        lo, hi = self.bracket(timestamp)
+        if lo < 0 or self.blocks[hi] != self.blocks[lo] + 1:
+            return None
+        return int(self.blocks[lo])
+
+    async def fetch(self, pool: RPCPool, blocks: list[int]) -> None:
+        """Fetch the headers of blocks in concurrent batches and add them."""
+
+        async def fetch_batch(batch: list[int]) -> list[tuple[int, int]]:
+            headers = await pool.batch(
+                [("eth_getBlockByNumber", [hex(b), False]) for b in batch]
+            )
+            return [(int(h["number"], 16), int(h["timestamp"], 16)) for h in headers]
+
+        batches = await asyncio.gather(
+            *(
+                fetch_batch(blocks[i : i + self.batch_size])
+                for i in range(0, len(blocks), self.batch_size)
+            )
+        )
+        if blocks:
+            self.add(sample for batch in batches for sample in batch)
+
+    async def resolve(self, pool: RPCPool, timestamps: Iterable[int]) -> dict[int, int]:
+        """Resolve timestamps to blocks, fetching only the headers still needed.
+
+        Timestamps before the first block or after the head are left out.
+        """
+
+        head = await pool.block_number()
+        known = set(self.blocks.tolist())
+        await self.fetch(
+            pool,
+            [b for b in [*range(0, head, self.grid), head] if b not in known],
+        )
+
+        resolved = {}
+        pending = set(int(ts) for ts in timestamps)
+        rounds = 0
+        while pending:
+            wanted = set()
+            for ts in list(pending):
+                lo, hi = self.bracket(ts)
+                if lo < 0:
+                    pending.discard(ts)
+                    continue
+                lo_block, hi_block = int(self.blocks[lo]), int(self.blocks[hi])
+                if hi_block == lo_block + 1:
+                    resolved[ts] = lo_block
+                    pending.discard(ts)
+                    continue
+
+                if rounds < self.interpolation_rounds:
+                    lo_ts, hi_ts = self.timestamps[lo], self.timestamps[hi]
+                    guess = lo_block + int(
+                        (ts - lo_ts) * (hi_block - lo_block) / (hi_ts - lo_ts)
+                    )
+                else:
+                    guess = (lo_block + hi_block) // 2
+                # a guess and its successor close the bracket if it was exact
+                guess = min(max(guess, lo_block + 1), hi_block - 1)
+                wanted.update(b for b in (guess, guess + 1) if b < hi_block)
+
+            await self.fetch(pool, sorted(wanted))
+            rounds += 1
+
+        return resolved
@@ -0,0 +1,112 @@
+"""Append-only gzip JSONL files with resume checkpoints."""
+
+import os
+import gzip
+import json
+import shutil
+import zlib
+from typing import Any, Iterator, Optional
+
+
+class JsonlCheckpoint:
+    """Gzip JSONL file with a sidecar checkpoint of cursor, row count and offset.
+
+    Every append writes one complete gzip member before atomically replacing
+    the checkpoint, so bytes past the checkpointed offset can only come from
+    an interrupted write and are cut on load.
+    """
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        self.ckpt_path = f"{self.path}.ckpt"
+        self.cursor: Optional[Any] = None
+        self.rows = 0
+        self.offset = 0
+
+    def load(self) -> bool:
+        """Load the checkpoint, return False if the file has none."""
+
+        if not os.path.exists(self.path):
+            return True
+        if not os.path.exists(self.ckpt_path):
+            return False
+
+        with open(self.ckpt_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        self.cursor = state["cursor"]
+        self.rows = state["rows"]
+        self.offset = state["offset"]
+
+        # Cut a partially written member after the checkpoint
+        size = os.path.getsize(self.path)
+        if size < self.offset:
+            raise ValueError(f"{self.path} is shorter than its checkpoint")
+        if size > self.offset:
+            print(f"Truncating {size - self.offset} bytes after checkpoint")
+            os.truncate(self.path, self.offset)
+        return True
+
+    def recover(self) -> Iterator[dict]:
+        """Stream the rows of a file without checkpoint, repairing a cut tail."""
+
+        count = 0
+        try:
+            with gzip.open(self.path, "rt") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        raise EOFError("Incomplete last line")
+                    count += 1
+                    yield json.loads(line)
+        except (EOFError, gzip.BadGzipFile, zlib.error) as e:
+            print(f"Repairing {self.path} after {count} rows: {e}")
+            self._rewrite(count)
+
+        self.rows = count
+        self.offset = os.path.getsize(self.path)
+
+    def _rewrite(self, count: int) -> None:
+        """Rewrite the file keeping only its first count rows."""
+
+        tmp_path = f"{self.path}.tmp"
+        with gzip.open(self.path, "rt") as src, gzip.open(tmp_path, "wt") as dst:
+            for _ in range(count):
+                dst.write(src.readline())
+        os.replace(tmp_path, self.path)
+
+    def save(self) -> None:
+        """Atomically replace the checkpoint file."""
+
+        tmp_path = f"{self.ckpt_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"cursor": self.cursor, "rows": self.rows, "offset": self.offset}, f
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.ckpt_path)
+
+    def append(self, rows: list[dict], cursor: Any) -> None:
+        """Append rows as one gzip member and checkpoint the cursor."""
+
+        if rows:
+            data = "".join(json.dumps(row) + "\n" for row in rows).encode()
+            with open(self.path, "ab") as f:
+                f.write(gzip.compress(data))
+                f.flush()
+                os.fsync(f.fileno())
+                self.offset = f.tell()
+        self.rows += len(rows)
+        self.cursor = cursor
+        self.save()
+
+    def extend(self, src_path: str, rows: int, cursor: Any) -> None:
+        """Append a complete gzip file holding rows rows and checkpoint the cursor."""
+
+        with open(src_path, "rb") as src, open(self.path, "ab") as dst:
+            shutil.copyfileobj(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+            self.offset = dst.tell()
+        self.rows += rows
+        self.cursor = cursor
+        self.save()
@@ -6,6 +6,7 @@ from governenv.settings import (
     PROJECT_ROOT,
     SNAPSHOT_API_KEY,
     INFURA_API_KEY,
+    INFURA_API_KEYS,
     DATA_DIR,
     PROCESSED_DATA_DIR,
 )
@@ -26,13 +27,24 @@ KAIKO_PRICE_PATH = DATA_DIR / "kaiko_price.json.gz"
 BITCOIN_NODES_GEO_PATH = DATA_DIR / "bitnodes_country_data.jsonl.gz"
 IMPROVEMENT_PROPOSALS_DIR = DATA_DIR / "ImprovementProposals"
 REFERENCE_CLIENTS_DIR = DATA_DIR / "ReferenceClients"
+LOG_DENSITY_PATH = DATA_DIR / "log_density.json"
+DELEGATION_LOG_DENSITY_PATH = DATA_DIR / "delegation_log_density.json"
+BLOCK_INDEX_PATH = DATA_DIR / "block_index.bin"
+REPLAY_DIR = DATA_DIR / "replay"
+TOKEN_METADATA_PATH = DATA_DIR / "token_metadata.json"
+INDEX_CONSTITUENTS_PATH = DATA_DIR / "coingecko" / "index_constituents.csv"
+LLM_CACHE_PATH = DATA_DIR / "llm_cache.sqlite"
+TRANSFER_STATE_PATH = PROCESSED_DATA_DIR / "transfer_state.json"
 
 
 # DATA CUTOFF DATES
 DATA_CUTOFF_DATE = "2025-09-01"
 
 # Transfer Data Update
-CURRENT_BLOCK = 23514780
+# block the transfer files of the one-off fetch before the incremental sync end at
+LEGACY_TRANSFER_END_BLOCK = 23514780
+# blocks below the head refetched on every sync, on top of the finalized tag
+REORG_TAIL = 64
 DUST_THRESHOLD = 1
 WHALE_THRESHOLD = 0.05
 
@@ -42,11 +54,42 @@ GRAPH_SNAPSHOT_ENDPOINT = "https://gateway.thegraph.com/api/subgraphs/id/\
 4YgtogVaqoM8CErHWDK8mKQ825BcVdKB8vBYmb4avAQo"
 INFURA_API_BASE = "https://mainnet.infura.io/v3/"
 INFURA_ENDPOINT = f"{INFURA_API_BASE}{INFURA_API_KEY}"
+INFURA_ENDPOINTS = [
+    f"{INFURA_API_BASE}{key}" for key in [INFURA_API_KEY, *INFURA_API_KEYS] if key
+]
+
+# API Rate Limits (requests per second)
+# hosts without an entry are the Discourse forums linked from proposals, kept
+# at the request every 5 seconds the discussion fetch made before
+DEFAULT_RATE_LIMIT = 0.2
+HOST_RATE_LIMITS = {
+    "hub.snapshot.org": 2.0,
+    "gateway.thegraph.com": 5.0,
+    "api.llama.fi": 2.0,
+    "coins.llama.fi": 2.0,
+    "pro-api.llama.fi": 10.0,
+    "pro-api.coingecko.com": 8.0,
+    "api.etherscan.io": 5.0,
+    "api.openai.com": 5.0,
+}
+
+# OpenAI chat completion limits per minute (usage tier 2 of gpt-4o)
+OPENAI_RPM = 5_000
+OPENAI_TPM = 450_000
+
+# OpenAI batch limits: requests and bytes per batch file, enqueued tokens per org
+OPENAI_BATCH_MAX_REQUESTS = 50_000
+OPENAI_BATCH_MAX_BYTES = 200 * 1024**2
+OPENAI_BATCH_QUEUE_TOKENS = 20_000_000
 
 # Snapshot Contract Address
 SNAPSHOT_DELEGATION_ADDRESS = "0x469788fE6E9E9681C6ebF3bF78e7Fd26Fc015446"
 SNAPSHOT_DELEGATION_START_BLOCK = 11225329
 
+# Multicall3, deployed at the same address on every chain
+MULTICALL3_ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"
+MULTICALL3_START_BLOCK = 14353601
+
 # Event Study Parameters
 EST_LOWER = -250
 EST_UPPER = -20
@@ -1,8 +1,12 @@
 """Script to interact with DefiLlama API."""
 
-import time
+import hashlib
 import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import cached_property
+from pathlib import Path
 from typing import Literal, Optional
 
 import pandas as pd
@@ -10,11 +14,102 @@ import requests
 from tqdm import tqdm
 from tenacity import retry, stop_after_attempt, wait_exponential
 
+from governenv import httpclient
 from governenv.constants import DATA_DIR
 from governenv.settings import DEFILLAMA_API_KEY
 
 os.makedirs(DATA_DIR / "defillama", exist_ok=True)
 
+# refresh interval of protocol lists and data, doubled per unchanged refetch
+MAX_AGE = 24 * 3600
+MAX_BACKOFF = 5
+MAX_WORKERS = 8
+
+
+def content_hash(data) -> str:
+    """Hash the canonical JSON form of a response."""
+    return hashlib.sha256(
+        json.dumps(data, sort_keys=True, separators=(",", ":")).encode()
+    ).hexdigest()
+
+
+def is_stale(path: str, max_age: int = MAX_AGE) -> bool:
+    """Check whether a cached file is missing or older than max_age seconds."""
+    return not os.path.exists(path) or time.time() - os.path.getmtime(path) > max_age
+
+
+class FetchManifest:
+    """Fetched-at time and content hash of every protocol file in a directory.
+
+    A protocol is due again once its age exceeds the refresh interval, which
+    doubles (up to 2**MAX_BACKOFF) each time a refetch returned the same
+    content, so protocols that stopped updating are polled rarely. Files of
+    earlier runs without an entry are adopted with their modification time.
+    """
+
+    def __init__(self, directory: str | Path):
+        self.directory = Path(directory)
+        self.path = self.directory / "manifest.json"
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def adopt(self, protocol: str) -> None:
+        """Record a file fetched before the manifest existed."""
+        path = self.directory / f"{protocol}.json"
+        if protocol in self.entries or not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        self.entries[protocol] = {
+            "fetched_at": os.path.getmtime(path),
+            "hash": content_hash(data),
+            "unchanged": 0,
+        }
+
+    def due(self, protocols, max_age: int = MAX_AGE) -> list[str]:
+        """Get the protocols never fetched or stale."""
+        now = time.time()
+        due = []
+        for protocol in protocols:
+            self.adopt(protocol)
+            entry = self.entries.get(protocol)
+            if entry is None or now - entry["fetched_at"] > max_age * 2 ** min(
+                entry["unchanged"], MAX_BACKOFF
+            ):
+                due.append(protocol)
+        return due
+
+    def update(self, protocol: str, data) -> bool:
+        """Record a fetch and save its data if the content changed.
+
+        An empty response is not recorded, so the manifest never holds a hash
+        the file on disk does not match and the protocol stays due.
+        """
+        if not data:
+            return False
+        digest = content_hash(data)
+        entry = self.entries.get(protocol, {"hash": None, "unchanged": 0})
+        changed = digest != entry["hash"]
+        self.entries[protocol] = {
+            "fetched_at": time.time(),
+            "hash": digest,
+            "unchanged": 0 if changed else entry["unchanged"] + 1,
+        }
+        path = self.directory / f"{protocol}.json"
+        if changed:
+            with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=4)
+            os.replace(f"{path}.tmp", path)
+        return changed
+
+    def save(self) -> None:
+        """Persist the manifest."""
+        with open(f"{self.path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, indent=4)
+        os.replace(f"{self.path}.tmp", self.path)
+
 
 class DefiLlama:
     """Class to interact with DefiLlama API."""
@@ -22,21 +117,30 @@ class DefiLlama:
     BASE_URL = "https://api.llama.fi"
     PRO_URL = "https://pro-api.llama.fi"
 
-    def __init__(self):
-        self.protocols = self._get_protocols()
-        self.fee_protocols = self._get_fee_protocols()
+    def __init__(self, max_age: int = MAX_AGE):
+        self.max_age = max_age
         # self.user_protocols = self._get_user_protocols()
         self.user_protocols = {}
 
+    @cached_property
+    def protocols(self) -> pd.DataFrame:
+        """List of DeFi protocols, loaded on first use."""
+        return self._get_protocols()
+
+    @cached_property
+    def fee_protocols(self) -> pd.DataFrame:
+        """List of protocols with fee data, loaded on first use."""
+        return self._get_fee_protocols()
+
     # Method to fetch list
     def _get_protocols(
         self, save_path: str = DATA_DIR / "defillama_protocols.csv"
     ) -> pd.DataFrame:
         """Fetch the list of DeFi protocols."""
-        if os.path.exists(save_path):
+        if not is_stale(save_path, self.max_age):
             return pd.read_csv(save_path)
         url = f"{self.BASE_URL}/protocols"
-        response = requests.get(url, timeout=60)
+        response = httpclient.get(url, timeout=60)
         response.raise_for_status()
         data = response.json()
         ptc = pd.DataFrame(data)
@@ -45,10 +149,10 @@ class DefiLlama:
 
     def _get_fee_protocols(self) -> pd.DataFrame:
         """Fetch the list of protocols with fee data."""
-        if os.path.exists(DATA_DIR / "defillama_fee_protocols.csv"):
+        if not is_stale(DATA_DIR / "defillama_fee_protocols.csv", self.max_age):
             return pd.read_csv(DATA_DIR / "defillama_fee_protocols.csv")
         url = f"{self.BASE_URL}/overview/fees"
-        response = requests.get(url, timeout=60)
+        response = httpclient.get(url, timeout=60)
         response.raise_for_status()
         data = response.json()
         ptc = pd.DataFrame(data["protocols"])
@@ -65,7 +169,7 @@ class DefiLlama:
             return data
 
         url = f"{self.PRO_URL}/{DEFILLAMA_API_KEY}/api/activeUsers"
-        response = requests.get(url, timeout=60)
+        response = httpclient.get(url, timeout=60)
         response.raise_for_status()
         data = response.json()
         with open(
@@ -74,30 +178,36 @@ class DefiLlama:
             json.dump(data, f, indent=4)
         return data
 
-    # Fetch protocol TVL
-    def _get_protocol_tvl(
-        self,
-        protocol: str,
-        save_path: str,
-    ) -> None:
-        """Fetch the TVL data for a specific protocol."""
-        # to avoid rate limiting
-        time.sleep(1)
-
-        # fetch data
-        try:
-            url = f"{self.BASE_URL}/protocol/{protocol}"
-            response = requests.get(url, timeout=30)
-            response.raise_for_status()
-            data = response.json()
-            with open(save_path / f"{protocol}.json", "w", encoding="utf-8") as f:
-                json.dump(data, f, indent=4)
-        except requests.RequestException as e:
-            time.sleep(5)
-            print(f"Error fetching TVL data for {protocol}: {e}")
+    def _refresh(self, urls: dict[str, str], path: str, desc: str) -> None:
+        """Refetch the due protocols concurrently and record them in the manifest.
+
+        The requests are throttled per host by the shared limiter in httpclient.
+        """
+        manifest = FetchManifest(path)
+        due = manifest.due(urls, self.max_age)
+        print(f"Refreshing {len(due)} of {len(urls)} protocols with {desc} data")
+
+        changed = 0
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {
+                executor.submit(httpclient.get, urls[protocol], timeout=60): protocol
+                for protocol in due
+            }
+            try:
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    protocol = futures[future]
+                    try:
+                        response = future.result()
+                        response.raise_for_status()
+                        changed += manifest.update(protocol, response.json())
+                    except requests.RequestException as e:
+                        print(f"Error fetching {desc} data for {protocol}: {e}")
+            finally:
+                manifest.save()
+        print(f"{changed} of {len(due)} refetched protocols changed")
 
     def get_protocol_tvls(self) -> None:
-        """Fetch TVL data for all protocols."""
+        """Fetch TVL data for the protocols never fetched or stale."""
         path = DATA_DIR / "defillama" / "tvls"
         os.makedirs(path, exist_ok=True)
 
@@ -113,76 +223,34 @@ class DefiLlama:
         )
         ptc_to_fetch = set(ptc_without_parent) | set(ptc_with_parent)
 
-        # interrupt and resume support
-        if os.path.exists(path):
-            existing_files = os.listdir(path)
-            existing_protocols = {f.replace(".json", "") for f in existing_files}
-            ptc_to_fetch = ptc_to_fetch - existing_protocols
-
-        for protocol in tqdm(ptc_to_fetch, total=len(ptc_to_fetch)):
-            self._get_protocol_tvl(protocol, path)
-
-    # Fetch protocol fee
-    def _get_protocol_fee(
-        self,
-        protocol: str,
-        save_path: str,
-    ) -> None:
-        """Fetch the fee data for a specific protocol."""
-        # to avoid rate limiting
-        time.sleep(2)
-
-        # fetch data
-        try:
-            url = f"{self.BASE_URL}/summary/fees/{protocol}"
-            response = requests.get(url, timeout=60)
-            response.raise_for_status()
-            data = response.json()
-            with open(save_path / f"{protocol}.json", "w", encoding="utf-8") as f:
-                json.dump(data, f, indent=4)
-        except requests.RequestException as e:
-            time.sleep(5)
-            print(f"Error fetching fee data for {protocol}: {e}")
+        self._refresh(
+            {
+                protocol: f"{self.BASE_URL}/protocol/{protocol}"
+                for protocol in sorted(ptc_to_fetch)
+            },
+            path,
+            "TVL",
+        )
 
     def get_protocol_fees(self) -> None:
-        """Fetch fee data for all protocols."""
+        """Fetch fee data for the protocols never fetched or stale."""
         path = DATA_DIR / "defillama" / "fees"
         os.makedirs(path, exist_ok=True)
 
-        protocol_fees = self.fee_protocols["slug"].tolist()
-        # interrupt and resume support
-        if os.path.exists(path):
-            existing_files = os.listdir(path)
-            existing_protocols = {f.replace(".json", "") for f in existing_files}
-            protocol_fees = set(protocol_fees) - existing_protocols
-
-        for protocol in tqdm(protocol_fees, total=len(protocol_fees)):
-            self._get_protocol_fee(protocol, path)
-
-    # Fetch protocol users
-    def _get_protocol_user(
-        self,
-        protocol_id: str,
-        save_path: str,
-        type_str: Literal["users", "txs", "gas", "newusers"],
-    ) -> None:
-        """Fetch the list of protocols with user data."""
-
-        url = (
-            f"{self.PRO_URL}/{DEFILLAMA_API_KEY}/api/userData/{type_str}/{protocol_id}"
+        protocol_fees = set(self.fee_protocols["slug"].tolist())
+        self._refresh(
+            {
+                protocol: f"{self.BASE_URL}/summary/fees/{protocol}"
+                for protocol in sorted(protocol_fees)
+            },
+            path,
+            "fee",
         )
-        response = requests.get(url, timeout=60)
-        response.raise_for_status()
-        data = response.json()
-        os.makedirs(save_path, exist_ok=True)
-        if data:
-            with open(save_path / f"{protocol_id}.json", "w", encoding="utf-8") as f:
-                json.dump(data, f, indent=4)
 
     def get_protocol_users(
         self, type_str: Literal["users", "txs", "gas", "newusers"]
     ) -> None:
-        """Fetch user data for all protocols."""
+        """Fetch user data for the protocols never fetched or stale."""
         path = DATA_DIR / "defillama" / "users" / type_str
         os.makedirs(path, exist_ok=True)
 
@@ -198,14 +266,15 @@ class DefiLlama:
 
         id_protocol_users = set(id_protocol_users) | set(id_parent_protocol_users)
 
-        # interrupt and resume support
-        if os.path.exists(path):
-            existing_files = os.listdir(path)
-            existing_protocols = {f.replace(".json", "") for f in existing_files}
-            id_protocol_users = id_protocol_users - existing_protocols
-
-        for protocol in tqdm(id_protocol_users, total=len(id_protocol_users)):
-            self._get_protocol_user(protocol, path, type_str)
+        self._refresh(
+            {
+                protocol: f"{self.PRO_URL}/{DEFILLAMA_API_KEY}/api/userData/"
+                + f"{type_str}/{protocol}"
+                for protocol in sorted(id_protocol_users)
+            },
+            path,
+            type_str,
+        )
 
     # Fetch block by timestamp
     @retry(
@@ -216,7 +285,6 @@ class DefiLlama:
         Function to get the block by timestamp
         """
 
-        time.sleep(1)
         length = 0
         result = {"timestamp": None, "height": None}
 
@@ -225,7 +293,7 @@ class DefiLlama:
             #     f"{self.PRO_URL}/{DEFILLAMA_API_KEY}/coins/block/ethereum/{timestamp}",
             #     timeout=60,
             # ).json()
-            result = requests.get(
+            result = httpclient.get(
                 f"https://coins.llama.fi/block/ethereum/{timestamp}",
                 timeout=60,
             ).json()
@@ -2,9 +2,13 @@
 
 import os
 
-import requests
 from tenacity import retry, stop_after_attempt, wait_exponential
 
+from governenv import httpclient
+
+# maximum number of addresses per getcontractcreation call
+CREATION_BATCH_SIZE = 5
+
 
 class Etherscan:
     """Class for Etherscan API interaction."""
@@ -27,11 +31,51 @@ class Etherscan:
             "contractaddresses": contract_address,
             "apikey": self.api_key,
         }
-        response = requests.get(self.base_url, params=params, timeout=60)
+        response = httpclient.get(self.base_url, params=params, timeout=60)
         data = response.json()
         results[contract_address] = data["result"]
         return results
 
+    @retry(
+        wait=wait_exponential(multiplier=1, min=4, max=10), stop=stop_after_attempt(3)
+    )
+    def _get_contract_creations(self, addresses: list[str], chain_id: str) -> dict:
+        """Get the creation information of up to five contracts in one call."""
+
+        params = {
+            "chainid": chain_id,
+            "module": "contract",
+            "action": "getcontractcreation",
+            "contractaddresses": ",".join(addresses),
+            "apikey": self.api_key,
+        }
+        response = httpclient.get(self.base_url, params=params, timeout=60)
+        response.raise_for_status()
+        data = response.json()
+        # a batch without any contract answers with a message instead of a list
+        if not isinstance(data["result"], list):
+            if data.get("message", "").startswith("No data"):
+                return {}
+            raise RuntimeError(f"Etherscan error: {data['result']}")
+        return {info["contractAddress"].lower(): info for info in data["result"]}
+
+    def get_contract_creations(
+        self, addresses: list[str], chain_id: str = "1"
+    ) -> dict[str, dict]:
+        """Get the creation information of contracts, five addresses per call.
+
+        Addresses that are not contracts are left out.
+        """
+
+        results = {}
+        for i in range(0, len(addresses), CREATION_BATCH_SIZE):
+            results.update(
+                self._get_contract_creations(
+                    addresses[i : i + CREATION_BATCH_SIZE], chain_id
+                )
+            )
+        return results
+
 
 if __name__ == "__main__":
     ETHERSCAN_API_KEY = os.getenv("ETHERSCAN_API_KEY")
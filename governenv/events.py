@@ -0,0 +1,245 @@
+"""Batch decoders for raw event logs of known signatures."""
+
+from collections import defaultdict
+from typing import Any, Callable, Iterable, Optional
+
+import numpy as np
+from web3 import Web3
+from web3._utils.events import get_event_data
+
+from governenv.rpc import format_log
+from governenv.utils import to_dict
+
+TRANSFER_TOPIC = Web3.keccak(text="Transfer(address,address,uint256)").to_0x_hex()
+SET_DELEGATE_TOPIC = Web3.keccak(
+    text="SetDelegate(address,bytes32,address)"
+).to_0x_hex()
+CLEAR_DELEGATE_TOPIC = Web3.keccak(
+    text="ClearDelegate(address,bytes32,address)"
+).to_0x_hex()
+
+# event names of the Snapshot delegation types
+DELEGATION_EVENTS = {"set": "SetDelegate", "clear": "ClearDelegate"}
+
+
+def _hex_bytes(strings: Iterable[str], start: int, end: int, width: int) -> np.ndarray:
+    """Slice the same hex span out of every string into an (n, width) byte array."""
+    buffer = bytes.fromhex("".join(s[start:end] for s in strings))
+    return np.frombuffer(buffer, dtype=np.uint8).reshape(-1, width)
+
+
+def to_hex(array: np.ndarray) -> list[str]:
+    """Convert an (n, width) byte array to 0x-prefixed hex strings."""
+    width = 2 * array.shape[1]
+    h = array.tobytes().hex()
+    return ["0x" + h[i : i + width] for i in range(0, len(h), width)]
+
+
+def limbs_to_int(limbs: np.ndarray) -> list[int]:
+    """Convert (n, 4) big-endian uint64 limbs to exact Python integers."""
+    h = limbs.astype(">u8").tobytes().hex()
+    return [int(h[i : i + 64], 16) for i in range(0, len(h), 64)]
+
+
+def log_columns(logs: list[dict[str, Any]]) -> dict[str, np.ndarray]:
+    """Decode the position and origin columns shared by every log."""
+    return {
+        "blockNumber": np.array([int(l["blockNumber"], 16) for l in logs], np.int64),
+        "transactionIndex": np.array(
+            [int(l["transactionIndex"], 16) for l in logs], np.int32
+        ),
+        "logIndex": np.array([int(l["logIndex"], 16) for l in logs], np.int32),
+        "transactionHash": _hex_bytes((l["transactionHash"] for l in logs), 2, 66, 32),
+        "blockHash": _hex_bytes((l["blockHash"] for l in logs), 2, 66, 32),
+        "address": _hex_bytes((l["address"] for l in logs), 2, 42, 20),
+    }
+
+
+def decode_transfer(logs: list[dict[str, Any]]) -> dict[str, np.ndarray]:
+    """Decode ERC-20 Transfer logs: from and to are topics 1 and 2, amount is data."""
+    columns = log_columns(logs)
+    columns["from"] = _hex_bytes((l["topics"][1] for l in logs), 26, 66, 20)
+    columns["to"] = _hex_bytes((l["topics"][2] for l in logs), 26, 66, 20)
+    columns["amount"] = np.frombuffer(
+        _hex_bytes((l["data"] for l in logs), 2, 66, 32).tobytes(), dtype=">u8"
+    ).reshape(-1, 4)
+    return columns
+
+
+def decode_delegate(logs: list[dict[str, Any]]) -> dict[str, np.ndarray]:
+    """Decode SetDelegate and ClearDelegate logs, all three arguments are topics."""
+    columns = log_columns(logs)
+    columns["delegator"] = _hex_bytes((l["topics"][1] for l in logs), 26, 66, 20)
+    columns["id"] = _hex_bytes((l["topics"][2] for l in logs), 2, 66, 32)
+    columns["delegate"] = _hex_bytes((l["topics"][3] for l in logs), 26, 66, 20)
+    return columns
+
+
+# topic0 -> (event name, argument names, topic count, data hex length, decoder)
+DECODERS: dict[str, tuple[str, list[str], int, int, Callable]] = {
+    TRANSFER_TOPIC: ("Transfer", ["from", "to", "amount"], 3, 66, decode_transfer),
+    SET_DELEGATE_TOPIC: (
+        "SetDelegate",
+        ["delegator", "id", "delegate"],
+        4,
+        2,
+        decode_delegate,
+    ),
+    CLEAR_DELEGATE_TOPIC: (
+        "ClearDelegate",
+        ["delegator", "id", "delegate"],
+        4,
+        2,
+        decode_delegate,
+    ),
+}
+
+
+EVENT_ARGS = {name: args for name, args, _, _, _ in DECODERS.values()}
+
+# fixed-width record layouts, the emitting contract is stored once per chunk
+LOG_DTYPE = [
+    ("blockNumber", "<i8"),
+    ("transactionIndex", "<i4"),
+    ("logIndex", "<i4"),
+    ("transactionHash", "u1", (32,)),
+    ("blockHash", "u1", (32,)),
+]
+DELEGATE_DTYPE = np.dtype(
+    LOG_DTYPE
+    + [("delegator", "u1", (20,)), ("id", "u1", (32,)), ("delegate", "u1", (20,))]
+)
+EVENT_DTYPES = {
+    "Transfer": np.dtype(
+        LOG_DTYPE
+        + [("from", "u1", (20,)), ("to", "u1", (20,)), ("amount", ">u8", (4,))]
+    ),
+    "SetDelegate": DELEGATE_DTYPE,
+    "ClearDelegate": DELEGATE_DTYPE,
+}
+
+
+def _signature(abi: dict) -> str:
+    """Get the canonical signature of an event ABI."""
+    return f"{abi['name']}({','.join(i['type'] for i in abi['inputs'])})"
+
+
+def decode_logs(
+    logs: list[dict[str, Any]], event_abis: Iterable[dict] = ()
+) -> tuple[dict[str, dict[str, np.ndarray]], list[dict]]:
+    """Decode a batch of raw JSON-RPC logs.
+
+    Logs of a known signature and layout are decoded together into columns
+    keyed by event name. Any other log falls back to the generic ABI decoder
+    with event_abis and is returned as a get_event_data dict.
+    """
+
+    abis = {Web3.keccak(text=_signature(abi)).to_0x_hex(): abi for abi in event_abis}
+    fast, slow = defaultdict(list), []
+    for log in logs:
+        spec = DECODERS.get(log["topics"][0] if log["topics"] else None)
+        if spec and len(log["topics"]) == spec[2] and len(log["data"]) == spec[3]:
+            fast[log["topics"][0]].append(log)
+        else:
+            slow.append(log)
+
+    columns = {
+        DECODERS[topic][0]: DECODERS[topic][4](group) for topic, group in fast.items()
+    }
+
+    codec = Web3().codec
+    generic = []
+    for log in slow:
+        abi = abis.get(log["topics"][0] if log["topics"] else None)
+        if abi is None:
+            raise ValueError(f"No ABI to decode log {log['transactionHash']}")
+        generic.append(to_dict(get_event_data(codec, abi, format_log(log))))
+
+    return columns, generic
+
+
+def to_records(name: str, columns: dict[str, np.ndarray]) -> np.ndarray:
+    """Pack decoded columns into a structured array of the event's record layout."""
+    dtype = EVENT_DTYPES[name]
+    records = np.empty(len(columns["blockNumber"]), dtype=dtype)
+    for field in dtype.names:
+        records[field] = columns[field]
+    return records
+
+
+def rows_to_columns(name: str, rows: list[dict]) -> dict[str, np.ndarray]:
+    """Convert get_event_data dicts of an event to decoded columns."""
+
+    def hex_column(values: list[str], width: int) -> np.ndarray:
+        buffer = bytes.fromhex("".join(v[2:].rjust(2 * width, "0") for v in values))
+        return np.frombuffer(buffer, dtype=np.uint8).reshape(-1, width)
+
+    dtype = EVENT_DTYPES[name]
+    columns = {
+        field: np.array([row[field] for row in rows], dtype=dtype[field])
+        for field in ("blockNumber", "transactionIndex", "logIndex")
+    }
+    for field in ("transactionHash", "blockHash"):
+        columns[field] = hex_column([row[field] for row in rows], 32)
+    for arg in EVENT_ARGS[name]:
+        values = [row["args"][arg] for row in rows]
+        if arg == "amount":
+            columns[arg] = np.frombuffer(
+                b"".join(v.to_bytes(32, "big") for v in values), dtype=">u8"
+            ).reshape(-1, 4)
+        else:
+            columns[arg] = hex_column(values, dtype[arg].shape[0])
+    return columns
+
+
+def decode_records(
+    logs: list[dict[str, Any]], event_abis: Iterable[dict] = ()
+) -> dict[str, np.ndarray]:
+    """Decode a batch of raw JSON-RPC logs into the records of every event."""
+
+    columns, generic = decode_logs(logs, event_abis)
+    rows = defaultdict(list)
+    for row in generic:
+        rows[row["event"]].append(row)
+
+    records = {}
+    for name in set(columns) | set(rows):
+        parts = [to_records(name, columns[name])] if name in columns else []
+        if rows[name]:
+            parts.append(to_records(name, rows_to_columns(name, rows[name])))
+        records[name] = np.concatenate(parts)
+    return records
+
+
+def columns_to_rows(
+    name: str, columns: dict[str, np.ndarray], address: Optional[str] = None
+) -> list[dict]:
+    """Convert decoded columns or records back to get_event_data style dicts.
+
+    Records do not carry the emitting contract, so pass its address.
+    """
+
+    args = {
+        arg: limbs_to_int(columns[arg]) if arg == "amount" else to_hex(columns[arg])
+        for arg in EVENT_ARGS[name]
+    }
+    fields = {
+        "logIndex": columns["logIndex"].tolist(),
+        "transactionIndex": columns["transactionIndex"].tolist(),
+        "transactionHash": to_hex(columns["transactionHash"]),
+        "address": (
+            to_hex(columns["address"])
+            if address is None
+            else [address] * len(columns["blockNumber"])
+        ),
+        "blockHash": to_hex(columns["blockHash"]),
+        "blockNumber": columns["blockNumber"].tolist(),
+    }
+    return [
+        {
+            "args": {arg: values[i] for arg, values in args.items()},
+            "event": name,
+            **{field: values[i] for field, values in fields.items()},
+        }
+        for i in range(len(fields["blockNumber"]))
+    ]
@@ -4,12 +4,19 @@ import os
 import gzip
 import json
 import datetime
-import time
-from typing import Optional
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterator, Optional
 
-import requests
+from governenv import httpclient
+from governenv.checkpoint import JsonlCheckpoint
 from governenv.constants import SNAPSHOT_ENDPOINT
 
+# Most ids of one timestamp a cursor leaves out with id_not_in. The Snapshot
+# hub has no id_gt to walk a timestamp in id order, so a larger burst of rows
+# sharing one timestamp cannot be paged past.
+MAX_CURSOR_IDS = 5000
+
 
 def query_structurer(series: str, spec: str, arg: str = "") -> str:
     """Structure a GraphQL query."""
@@ -23,6 +30,19 @@ def query_structurer(series: str, spec: str, arg: str = "") -> str:
     return q
 
 
+def where_structurer(**filters: Any) -> str:
+    """Structure a GraphQL where clause, quoting string and list values."""
+
+    return (
+        "{"
+        + ", ".join(
+            f"{k}: {json.dumps(v) if isinstance(v, (str, list)) else v}"
+            for k, v in filters.items()
+        )
+        + "}"
+    )
+
+
 def graphdata(
     *q, url: str = SNAPSHOT_ENDPOINT, headers: Optional[dict[str, str]] = None
 ) -> dict:
@@ -30,13 +50,129 @@ def graphdata(
 
     # pack all subqueries into one big query concatenated with linebreak '\n'
     query = "{" + "\n".join(q) + "}"
-    r = requests.post(url, json={"query": query}, headers=headers, timeout=60)
+    r = httpclient.post(url, json={"query": query}, headers=headers, timeout=60)
 
     response_json = json.loads(r.text)
-    time.sleep(0.5)
     return response_json
 
 
+def _write_rows(f, rows: list[dict]) -> None:
+    """Write rows to an open JSONL file."""
+
+    if rows:
+        f.write("\n".join([json.dumps(row) for row in rows]) + "\n")
+
+
+def _keyset_arg(
+    time_var: str,
+    cursor: dict[str, Any],
+    batch_size: int = 1000,
+    **filters: Any,
+) -> str:
+    """Structure the query arguments for a (time_var, ids) keyset cursor.
+
+    A cursor {"time": t, "ids": ids} walks the rows with time_var >= t in time
+    order, leaving out the ids already fetched at t. Without ids it walks the
+    rows with time_var > t. More than MAX_CURSOR_IDS ids raise a ValueError
+    instead of growing the query without bound.
+    """
+
+    if len(cursor.get("ids") or []) > MAX_CURSOR_IDS:
+        raise ValueError(
+            f"More than {MAX_CURSOR_IDS} rows share {time_var} {cursor['time']}, "
+            + "too many to leave out with id_not_in"
+        )
+
+    if cursor.get("ids"):
+        where = {f"{time_var}_gte": cursor["time"], "id_not_in": cursor["ids"]}
+    else:
+        where = {f"{time_var}_gt": cursor["time"]}
+
+    return (
+        f'first: {batch_size}, orderBy: "{time_var}", orderDirection: asc, where: '
+        + where_structurer(**where, **filters)
+    )
+
+
+def _cursor_after(
+    time_var: str, cursor: Optional[dict[str, Any]], rows: list[dict]
+) -> dict[str, Any]:
+    """Get the cursor after a non-empty page of rows."""
+
+    last_created = rows[-1][time_var]
+    ids = [row["id"] for row in rows if row[time_var] == last_created]
+    # A burst of one timestamp spanning pages keeps the ids of earlier pages
+    if cursor and cursor["time"] == last_created:
+        ids = (cursor.get("ids") or []) + ids
+    return {"time": last_created, "ids": ids}
+
+
+def _keyset_advance(
+    time_var: str,
+    cursor: dict[str, Any],
+    rows: list[dict],
+    batch_size: int = 1000,
+) -> tuple[list[dict], Optional[dict[str, Any]]]:
+    """Return the rows of a page and the next cursor, None when done."""
+
+    if len(rows) < batch_size:
+        return rows, None
+
+    # The last timestamp may continue on the next page, which starts at it
+    # again without the ids already fetched
+    return rows, _cursor_after(time_var, cursor, rows)
+
+
+def _checkpoint_cursor(
+    time_var: str,
+    cursor: Optional[dict[str, Any]],
+    rows: list[dict],
+) -> Optional[dict[str, Any]]:
+    """Get the cursor to resume from after a page, also once the walk ends."""
+
+    if rows:
+        return _cursor_after(time_var, cursor, rows)
+    return cursor
+
+
+def _paginate(
+    series: str,
+    query_template: str,
+    time_var: str = "created",
+    start: int = 0,
+    end_point: str = SNAPSHOT_ENDPOINT,
+    headers: Optional[dict[str, str]] = None,
+    batch_size: int = 1000,
+    cursor: Optional[dict[str, Any]] = None,
+    **filters: Any,
+) -> Iterator[tuple[list[dict], Optional[dict[str, Any]]]]:
+    """Yield pages of rows with the cursor after each page.
+
+    The walk starts at time_var >= start unless a cursor is given.
+    """
+
+    if cursor is None:
+        cursor = {"time": start - 1, "ids": []}
+
+    while cursor is not None:
+        # Query data
+        reservepara_query = query_structurer(
+            series,
+            query_template,
+            arg=_keyset_arg(time_var, cursor, batch_size, **filters),
+        )
+        res = graphdata(reservepara_query, url=end_point, headers=headers)
+
+        # Pagination check
+        if "data" not in set(res):
+            raise ValueError("Error in fetching data")
+
+        rows, cursor = _keyset_advance(
+            time_var, cursor, res["data"][series], batch_size
+        )
+        yield rows, cursor
+
+
 def query_single(
     save_path: str,
     series: str,
@@ -62,65 +198,186 @@ def query_single(
             raise ValueError("Error in fetching data")
 
 
-def query(
-    save_path: str,
+def _time_bound(
+    series: str,
+    time_var: str,
+    start: int,
+    end_point: str,
+    headers: Optional[dict[str, str]],
+    direction: str = "asc",
+) -> Optional[int]:
+    """Get the earliest (asc) or latest (desc) time_var value at or after start."""
+
+    res = graphdata(
+        query_structurer(
+            series,
+            time_var,
+            arg=f'first: 1, orderBy: "{time_var}", orderDirection: {direction}, '
+            + "where: "
+            + where_structurer(**{f"{time_var}_gte": start}),
+        ),
+        url=end_point,
+        headers=headers,
+    )
+    if "data" not in set(res):
+        raise ValueError("Error in fetching data")
+    rows = res["data"][series]
+    return rows[0][time_var] if rows else None
+
+
+def _query_slice(
+    slice_path: str,
+    series: str,
+    query_template: str,
+    headers: Optional[dict[str, str]],
+    time_var: str,
+    end_point: str,
+    batch_size: int,
+    start: int,
+    end: Optional[int],
+    cursor: Optional[dict[str, Any]] = None,
+) -> tuple[str, int, Optional[dict[str, Any]]]:
+    """Fetch the [start, end) time slice into its own gzip file.
+
+    Return the file path, its row count and the cursor to resume after it.
+    """
+
+    count = 0
+    filters = {} if end is None else {f"{time_var}_lt": end}
+    with gzip.open(slice_path, "wt") as f:
+        for rows, _ in _paginate(
+            series,
+            query_template,
+            time_var=time_var,
+            start=start,
+            end_point=end_point,
+            headers=headers,
+            batch_size=batch_size,
+            cursor=cursor,
+            **filters,
+        ):
+            _write_rows(f, rows)
+            count += len(rows)
+            cursor = _checkpoint_cursor(time_var, cursor, rows)
+    return slice_path, count, cursor
+
+
+def _query_parallel(
+    ckpt: JsonlCheckpoint,
     series: str,
     query_template: str,
+    cursor: Optional[dict[str, Any]] = None,
     headers: Optional[dict[str, str]] = None,
     time_var: str = "created",
     end_point: str = SNAPSHOT_ENDPOINT,
     batch_size: int = 1000,
+    n_slices: int = 8,
 ):
-    """Query data and save to a file."""
-
-    # Interrupt and resume
-    if os.path.exists(save_path):
-        with gzip.open(save_path, "rt") as f:
-            lines = f.readlines()
-            if lines:
-                # Get the last created timestamp and add 1 to avoid duplication
-                last_created = json.loads(lines[-1])[time_var] + 1
-            else:
-                last_created = 0
-    else:
-        last_created = 0
+    """Query data in concurrent time slices and append them to a file in order.
 
-    # Fetch data
-    with gzip.open(save_path, "at") as f:
+    The first slice continues from cursor, the others start fresh at their
+    lower bound.
+    """
+
+    start = cursor["time"] if cursor else 0
 
-        while True:
-            # Query data
-            reservepara_query = query_structurer(
+    # Only slice the range actually covered by rows
+    first = _time_bound(series, time_var, start, end_point, headers)
+    if first is None:
+        return
+    last = _time_bound(series, time_var, start, end_point, headers, "desc")
+
+    # Split [first, last] into disjoint slices, the last one is open-ended
+    step = max((last - first) // n_slices, 1)
+    bounds = [first + i * step for i in range(n_slices)] + [None]
+
+    with ThreadPoolExecutor(max_workers=n_slices) as executor:
+        futures = [
+            executor.submit(
+                _query_slice,
+                f"{ckpt.path}.slice{i}",
                 series,
                 query_template,
-                arg=f'first: {batch_size}, orderBy: "{time_var}", '
-                + f"orderDirection: asc, where: {{{time_var}_gte: {last_created}}}",
+                headers,
+                time_var,
+                end_point,
+                batch_size,
+                bounds[i],
+                bounds[i + 1],
+                cursor if i == 0 else None,
             )
-            res = graphdata(reservepara_query, url=end_point, headers=headers)
-            # Pagination check
-            if "data" in set(res):
-                if res["data"][series]:
-                    # Process fetched rows
-                    rows = res["data"][series]
-                    length = len(rows)
-
-                    # Update last_created timestamp
-                    last_created = rows[-1][time_var]
-                    print(f"Fetched {datetime.datetime.fromtimestamp(last_created)}")
-
-                    if length == batch_size:
-                        # Remove the last_created update from the write operation
-                        rows = [row for row in rows if row[time_var] != last_created]
-                        # Write remaining rows to file
-                        f.write("\n".join([json.dumps(row) for row in rows]) + "\n")
-                    else:
-                        # Write rows to file and break the loop
-                        f.write("\n".join([json.dumps(row) for row in rows]) + "\n")
-                        break
-                else:
-                    break
-            else:
-                raise ValueError("Error in fetching data")
+            for i in range(n_slices)
+        ]
+
+        # Merge slices in order as soon as every earlier slice is done,
+        # gzip members can be concatenated as-is
+        for future in futures:
+            slice_path, count, cursor = future.result()
+            ckpt.extend(slice_path, count, cursor or ckpt.cursor)
+            os.remove(slice_path)
+            print(f"Merged {slice_path}")
+
+
+def query(
+    save_path: str,
+    series: str,
+    query_template: str,
+    headers: Optional[dict[str, str]] = None,
+    time_var: str = "created",
+    end_point: str = SNAPSHOT_ENDPOINT,
+    batch_size: int = 1000,
+    n_slices: int = 1,
+):
+    """Query data and save to a file.
+
+    With n_slices > 1 the remaining time range is fetched in parallel slices
+    sharing the rate limit of the endpoint host.
+    """
+
+    # Interrupt and resume from the checkpoint
+    ckpt = JsonlCheckpoint(save_path)
+    seen = set()
+    if ckpt.load():
+        cursor = ckpt.cursor
+    else:
+        # No checkpoint yet: stream the file once, the last timestamp may be
+        # partially written so walk it again without the ids already on disk
+        cursor, last_created = None, None
+        for row in ckpt.recover():
+            if row[time_var] != last_created:
+                last_created, seen = row[time_var], set()
+            seen.add(row["id"])
+        if last_created is not None:
+            cursor = {"time": last_created, "ids": sorted(seen)}
+
+    if n_slices > 1:
+        _query_parallel(
+            ckpt,
+            series,
+            query_template,
+            cursor=cursor,
+            headers=headers,
+            time_var=time_var,
+            end_point=end_point,
+            batch_size=batch_size,
+            n_slices=n_slices,
+        )
+        return
+
+    # Fetch data, one gzip member and checkpoint per page
+    for rows, _ in _paginate(
+        series,
+        query_template,
+        time_var=time_var,
+        end_point=end_point,
+        headers=headers,
+        batch_size=batch_size,
+        cursor=cursor,
+    ):
+        if rows:
+            print(f"Fetched {datetime.datetime.fromtimestamp(rows[-1][time_var])}")
+        cursor = _checkpoint_cursor(time_var, cursor, rows)
+        ckpt.append(rows, cursor)
 
 
 def query_id(
@@ -136,43 +393,78 @@ def query_id(
     """Query data give id and save to a file."""
 
     os.makedirs(save_path, exist_ok=True)
-    last_created = 0
 
     tmp_path = f"{save_path}/{idx}.jsonl.tmp"
     final_path = f"{save_path}/{idx}.jsonl"
 
     with open(tmp_path, "w", encoding="utf-8") as f:
-        while True:
-            # Query data
-            reservepara_query = query_structurer(
-                series,
-                query_template,
-                arg=f'first: {batch_size}, orderBy: "{time_var}", '
-                + f'orderDirection: asc, where: {{{time_var}_gte: {last_created}, {idx_var}: "{idx}"}}',
-            )
-            res = graphdata(reservepara_query, url=end_point)
-
-            # Pagination check
-            if "data" in set(res):
-                if res["data"][series]:
-                    # Process fetched rows
-                    rows = res["data"][series]
-                    length = len(rows)
-
-                    # Update last_created timestamp
-                    last_created = rows[-1][time_var]
-                    if length == batch_size:
-                        # Remove the last_created update from the write operation
-                        rows = [row for row in rows if row[time_var] != last_created]
-                        # Write remaining rows to file
-                        f.write("\n".join([json.dumps(row) for row in rows]) + "\n")
-                    else:
-                        # Write rows to file and break the loop
-                        f.write("\n".join([json.dumps(row) for row in rows]) + "\n")
-                        break
-                else:
-                    break
-            else:
-                raise ValueError("Error in fetching data")
+        for rows, _ in _paginate(
+            series,
+            query_template,
+            time_var=time_var,
+            end_point=end_point,
+            batch_size=batch_size,
+            **{idx_var: idx},
+        ):
+            _write_rows(f, rows)
 
     os.rename(tmp_path, final_path)
+
+
+def query_ids(
+    save_path: str,
+    ids: list[str],
+    idx_var: str,
+    series: str,
+    query_template: str,
+    time_var: str = "created",
+    end_point: str = SNAPSHOT_ENDPOINT,
+    batch_size: int = 1000,
+    group_size: int = 20,
+):
+    """Query data for many ids with aliased subqueries and save one file per id.
+
+    Up to group_size ids share one request, ids whose page came back full are
+    re-queued with their cursor until exhausted.
+    """
+
+    os.makedirs(save_path, exist_ok=True)
+
+    queue = deque(ids)
+    cursors = {idx: {"time": -1, "ids": []} for idx in ids}
+
+    while queue:
+        group = [queue.popleft() for _ in range(min(group_size, len(queue)))]
+
+        # Query data, one aliased subquery per id
+        res = graphdata(
+            *[
+                f"a{i}: "
+                + query_structurer(
+                    series,
+                    query_template,
+                    arg=_keyset_arg(
+                        time_var, cursors[idx], batch_size, **{idx_var: idx}
+                    ),
+                )
+                for i, idx in enumerate(group)
+            ],
+            url=end_point,
+        )
+        if "data" not in set(res):
+            raise ValueError("Error in fetching data")
+
+        for i, idx in enumerate(group):
+            tmp_path = f"{save_path}/{idx}.jsonl.tmp"
+            mode = "w" if cursors[idx]["time"] == -1 else "a"
+            rows, cursor = _keyset_advance(
+                time_var, cursors[idx], res["data"][f"a{i}"], batch_size
+            )
+            with open(tmp_path, mode, encoding="utf-8") as f:
+                _write_rows(f, rows)
+
+            if cursor is None:
+                os.rename(tmp_path, f"{save_path}/{idx}.jsonl")
+            else:
+                cursors[idx] = cursor
+                queue.append(idx)
@@ -0,0 +1,212 @@
+"""Shared HTTP layer: pooled sessions, per-host rate limits and retries."""
+
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from governenv.constants import DEFAULT_RATE_LIMIT, HOST_RATE_LIMITS
+from governenv.replay import ReplayMiss, get_cache, request_key
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Thread-safe token bucket that adapts its rate to 429 responses.
+
+    The rate is halved on every 429 and recovers additively on success, up to
+    the configured rate. A Retry-After header pauses the bucket for all
+    threads sharing it.
+    """
+
+    def __init__(self, rate: float, burst: int = 1, min_rate: float = 0.05):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Block until a token is available."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self.tokens = min(
+                        self.burst, self.tokens + (now - self.updated) * self.rate
+                    )
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.paused_until - now
+            time.sleep(wait)
+
+    def penalize(self, retry_after: Optional[float] = None) -> None:
+        """Slow down after a rate limit response."""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+            if retry_after:
+                self.paused_until = max(
+                    self.paused_until, time.monotonic() + retry_after
+                )
+
+    def reward(self) -> None:
+        """Speed up again after a successful response."""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+_LOCK = threading.Lock()
+_LIMITERS: dict[str, TokenBucket] = {}
+_SESSIONS: dict[str, requests.Session] = {}
+
+
+def get_limiter(host: str) -> TokenBucket:
+    """Get the shared token bucket of a host."""
+    with _LOCK:
+        if host not in _LIMITERS:
+            _LIMITERS[host] = TokenBucket(
+                HOST_RATE_LIMITS.get(host, DEFAULT_RATE_LIMIT)
+            )
+        return _LIMITERS[host]
+
+
+def get_session(host: str) -> requests.Session:
+    """Get the keep-alive session of a host."""
+    with _LOCK:
+        if host not in _SESSIONS:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=32)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _SESSIONS[host] = session
+        return _SESSIONS[host]
+
+
+def retry_after(response: requests.Response) -> Optional[float]:
+    """Parse the Retry-After header in seconds."""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def cached_response(url: str, meta: dict, body: bytes) -> requests.Response:
+    """Rebuild a response recorded in the replay cache."""
+    response = requests.Response()
+    response.status_code = meta["status"]
+    response.headers = CaseInsensitiveDict(meta["headers"])
+    response.encoding = meta["encoding"]
+    response.url = url
+    response._content = body
+    return response
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    """Send a request, or answer it from the replay cache if enabled.
+
+    Only successful responses are recorded, streamed ones are never cached
+    and raise ReplayMiss in replay mode.
+    """
+
+    cache = get_cache()
+    if not cache.enabled:
+        return send(method, url, **kwargs)
+
+    # params are folded into the URL so secret query params get masked
+    key = request_key(
+        method,
+        requests.Request(method, url, params=kwargs.get("params")).prepare().url,
+        {k: kwargs.get(k) for k in ("json", "data")},
+    )
+    if kwargs.get("stream"):
+        if cache.mode == "replay":
+            raise ReplayMiss(key)
+        return send(method, url, **kwargs)
+
+    cached = cache.lookup(key)
+    if cached is not None:
+        return cached_response(url, *cached)
+
+    response = send(method, url, **kwargs)
+    if response.ok:
+        cache.store(
+            key,
+            response.content,
+            status=response.status_code,
+            headers={"Content-Type": response.headers.get("Content-Type", "")},
+            encoding=response.encoding,
+        )
+    return response
+
+
+def send(
+    method: str,
+    url: str,
+    retries: int = 5,
+    backoff: float = 2.0,
+    timeout: float = 60,
+    **kwargs,
+) -> requests.Response:
+    """Send a rate limited request with the shared retry policy.
+
+    Connection errors, timeouts, 429 and 5xx responses are retried with
+    exponential backoff. The last response is returned as is, so callers keep
+    their own raise_for_status handling.
+    """
+
+    host = urlparse(url).netloc
+    limiter = get_limiter(host)
+    session = get_session(host)
+
+    for attempt in range(retries):
+        limiter.acquire()
+        try:
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries - 1:
+                raise
+            time.sleep(backoff**attempt)
+            continue
+
+        if response.status_code not in RETRY_STATUS:
+            limiter.reward()
+            return response
+        if attempt == retries - 1:
+            return response
+
+        # the bucket pauses for Retry-After, other errors back off locally
+        if response.status_code == 429:
+            limiter.penalize(retry_after(response))
+        else:
+            time.sleep(backoff**attempt)
+
+    return response
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    """Send a GET request through the shared HTTP layer."""
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    """Send a POST request through the shared HTTP layer."""
+    return request("POST", url, **kwargs)
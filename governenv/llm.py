@@ -2,14 +2,37 @@
 Class for the LLM model
 """
 
+import asyncio
+import json
+import math
+import os
 import time
-from typing import Optional
+from functools import lru_cache
+from typing import Any, Callable, Iterable, Iterator, Optional
 
-from openai import OpenAI
-from tenacity import retry, stop_after_attempt, wait_exponential
+import tiktoken
+from openai import AsyncOpenAI, OpenAI, RateLimitError
+from openai.types.chat import ChatCompletion
+from tenacity import (
+    retry,
+    retry_if_not_exception_type,
+    stop_after_attempt,
+    wait_exponential,
+)
+from tqdm import tqdm
 
+from governenv.constants import OPENAI_RPM, OPENAI_TPM
+from governenv.httpclient import get_limiter
+from governenv.llmcache import ResponseCache
+from governenv.prompts import PROMPT_VERSION
+from governenv.replay import ReplayMiss, get_cache, request_key
 from governenv.settings import OPENAI_API_KEY
 
+# completion tokens budgeted per request, the answers are short JSON objects
+COMPLETION_TOKENS = 100
+MAX_IN_FLIGHT = 64
+BATCH_TERMINAL = {"completed", "failed", "expired", "cancelled"}
+
 
 def build_batch(
     custom_idx: str,
@@ -74,6 +97,147 @@ def build_batch(
     }
 
 
+def iter_jsonl(path: str) -> Iterator[dict]:
+    """Read a JSONL file one line at a time."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_batch_output(path: str) -> Iterator[tuple[str, dict]]:
+    """Parse a batch output file line by line into custom_id and result.
+
+    The result holds the status code, the content and logprobs of the first
+    choice, and the error of a failed request.
+    """
+    for line in iter_jsonl(path):
+        response = line.get("response") or {}
+        body = response.get("body") or {}
+        choice = (body.get("choices") or [{}])[0]
+        yield line["custom_id"], {
+            "status_code": response.get("status_code"),
+            "content": (choice.get("message") or {}).get("content"),
+            "logprobs": (choice.get("logprobs") or {}).get("content"),
+            "error": line.get("error") or body.get("error"),
+        }
+
+
+def field_probs(content: str, logprobs: list[dict]) -> dict[str, float]:
+    """Get the probability of true for every boolean field of a JSON answer.
+
+    The value token of a field is located by its character offset in the
+    answer, and its probability is taken as that of the sampled token.
+    """
+
+    starts = []
+    offset = 0
+    for token in logprobs:
+        starts.append(offset)
+        offset += len(token["token"])
+
+    probs = {}
+    for field, value in json.loads(content).items():
+        if not isinstance(value, bool):
+            continue
+        # skip the key, the colon and whitespace to the start of the value
+        start = content.index(json.dumps(field)) + len(json.dumps(field))
+        while content[start] in ": \t\r\n":
+            start += 1
+        i = next(i for i in reversed(range(len(starts))) if starts[i] <= start)
+        prob = math.exp(logprobs[i]["logprob"])
+        probs[field] = prob if value else 1 - prob
+    return probs
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str) -> Optional[tiktoken.Encoding]:
+    """Get the tokenizer of a model, None if it cannot be loaded."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        try:
+            return tiktoken.get_encoding("o200k_base")
+        except Exception:
+            return None
+
+
+def estimate_tokens(
+    params: dict[str, Any], completion_tokens: int = COMPLETION_TOKENS
+) -> int:
+    """Estimate the tokens a chat request counts against the TPM or batch limits.
+
+    Falls back to four characters per token without the tokenizer files.
+    """
+
+    encoding = _encoding(params["model"])
+
+    def count(content: str | list[dict]) -> int:
+        # image messages carry their text in parts
+        if not isinstance(content, str):
+            content = " ".join(part.get("text", "") for part in content)
+        return len(encoding.encode(content)) if encoding else len(content) // 4 + 1
+
+    tokens = sum(count(m["content"]) + 4 for m in params["messages"]) + 3
+    if "response_format" in params:
+        tokens += count(json.dumps(params["response_format"]))
+    return tokens + completion_tokens
+
+
+class MinuteBudget:
+    """Requests and tokens per minute of the OpenAI API, refilled continuously.
+
+    A request waits until both budgets cover it, waiters are served in order
+    so large requests are not starved. The token debit is corrected with the
+    usage of the response, and a rate limit response pauses the budget.
+    """
+
+    def __init__(self, rpm: int = OPENAI_RPM, tpm: int = OPENAI_TPM):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self.updated
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+        self.updated = now
+
+    async def acquire(self, tokens: int) -> None:
+        """Wait until the budgets cover a request of tokens."""
+        tokens = min(tokens, self.tpm)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if (
+                    now >= self.paused_until
+                    and self.requests >= 1
+                    and self.tokens >= tokens
+                ):
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+                wait = max(
+                    self.paused_until - now,
+                    (1 - self.requests) * 60 / self.rpm,
+                    (tokens - self.tokens) * 60 / self.tpm,
+                )
+                await asyncio.sleep(max(wait, 0.01))
+
+    def settle(self, estimated: int, used: int) -> None:
+        """Correct the token debit of a request with its reported usage."""
+        self.tokens = min(self.tpm, self.tokens + estimated - used)
+
+    def pause(self, seconds: float) -> None:
+        """Stop granting requests for seconds after a rate limit response."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
 class ChatGPT:
     """
     ChatGPT class to interact with the OpenAI API
@@ -83,9 +247,20 @@ class ChatGPT:
         self,
         model: str = "gpt-4o",
         api_key: str | None = OPENAI_API_KEY,
+        prompt_version: str | None = PROMPT_VERSION,
     ):
         self.client = OpenAI(api_key=api_key)
+        self.aclient = AsyncOpenAI(api_key=api_key)
         self.model = model
+        self.limiter = get_limiter("api.openai.com")
+        self.budget = MinuteBudget()
+        self.prompt_version = prompt_version
+        # responses are reused across runs unless prompt_version is None
+        self.cache = (
+            ResponseCache(version=prompt_version)
+            if prompt_version is not None
+            else None
+        )
 
     def _build_prompt(
         self,
@@ -103,10 +278,7 @@ class ChatGPT:
 
         return prompt
 
-    @retry(
-        stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10)
-    )
-    def __call__(
+    def _build_params(
         self,
         message: str,
         instruction: str | None = None,
@@ -114,9 +286,10 @@ class ChatGPT:
         temperature: float = 0,
         logprobs: bool = False,
         top_logprobs: int | None = None,
-    ) -> str | tuple[str, dict[str, float]]:
-        time.sleep(2)
-
+    ) -> dict[str, Any]:
+        """
+        Function to build the chat completion parameters
+        """
         params = {
             "model": self.model,
             "messages": self._build_prompt(message, instruction),
@@ -133,7 +306,15 @@ class ChatGPT:
             params["logprobs"] = logprobs
             params["top_logprobs"] = top_logprobs
 
-        response = self.client.chat.completions.create(**params).choices[0]
+        return params
+
+    def _parse(
+        self, completion: dict, logprobs: bool = False
+    ) -> str | tuple[str, dict[str, float]]:
+        """
+        Function to extract the answer of a completion
+        """
+        response = ChatCompletion.model_validate(completion).choices[0]
         if logprobs:
             return (
                 response.message.content,
@@ -141,41 +322,224 @@ class ChatGPT:
             )
         return response.message.content
 
-    def send_batch(
+    def _cache_key(self, params: dict[str, Any]) -> str:
+        return request_key("POST", f"{self.client.base_url}chat/completions", params)
+
+    # a response missing from a replay will not appear on a retry
+    @retry(
+        retry=retry_if_not_exception_type(ReplayMiss),
+        stop=stop_after_attempt(3),
+        wait=wait_exponential(multiplier=1, min=4, max=10),
+    )
+    def __call__(
         self,
-        batch_path: str,
-    ) -> str:
-        """Function to send a batch request to the GPT-4o API."""
-        batch_input_file = self.client.files.create(
-            file=open(batch_path, "rb"),
-            purpose="batch",
+        message: str,
+        instruction: str | None = None,
+        json_schema: dict | None = None,
+        temperature: float = 0,
+        logprobs: bool = False,
+        top_logprobs: int | None = None,
+    ) -> str | tuple[str, dict[str, float]]:
+        params = self._build_params(
+            message, instruction, json_schema, temperature, logprobs, top_logprobs
         )
-        batch_input_file_id = batch_input_file.id
 
+        def send() -> dict:
+            self.limiter.acquire()
+            try:
+                return self.client.chat.completions.create(**params).model_dump()
+            except RateLimitError:
+                self.limiter.penalize()
+                raise
+
+        completion = self.cache.get(params) if self.cache else None
+        if completion is None:
+            completion = get_cache().fetch_json(self._cache_key(params), send)
+            if self.cache:
+                self.cache.put(params, completion)
+        return self._parse(completion, logprobs)
+
+    @retry(
+        retry=retry_if_not_exception_type(ReplayMiss),
+        stop=stop_after_attempt(5),
+        wait=wait_exponential(multiplier=1, min=4, max=30),
+    )
+    async def acall(
+        self,
+        message: str,
+        instruction: str | None = None,
+        json_schema: dict | None = None,
+        temperature: float = 0,
+        logprobs: bool = False,
+        top_logprobs: int | None = None,
+    ) -> str | tuple[str, dict[str, float]]:
+        """
+        Async version of __call__, paced by the requests and tokens per minute
+        """
+        params = self._build_params(
+            message, instruction, json_schema, temperature, logprobs, top_logprobs
+        )
+
+        completion = self.cache.get(params) if self.cache else None
+        if completion is not None:
+            return self._parse(completion, logprobs)
+
+        cache = get_cache()
+        key = self._cache_key(params)
+        cached = cache.lookup(key) if cache.enabled else None
+        if cached is not None:
+            return self._parse(json.loads(cached[1]), logprobs)
+
+        estimated = estimate_tokens(params)
+        await self.budget.acquire(estimated)
+        try:
+            completion = await self.aclient.chat.completions.create(**params)
+        except RateLimitError:
+            self.budget.pause(10)
+            raise
+        self.budget.settle(estimated, completion.usage.total_tokens)
+
+        completion = completion.model_dump()
+        if cache.enabled:
+            cache.store(key, json.dumps(completion).encode())
+        if self.cache:
+            self.cache.put(params, completion)
+        return self._parse(completion, logprobs)
+
+    async def amap(
+        self,
+        jobs: dict[str, dict[str, Any]],
+        on_result: Callable[[str, Any], None],
+        max_in_flight: int = MAX_IN_FLIGHT,
+    ) -> list[str]:
+        """
+        Run acall with the keyword arguments of every job concurrently and hand
+        each result to on_result as it completes. Failed jobs are reported and
+        skipped, so a rerun only repeats them; their keys are returned.
+        """
+        semaphore = asyncio.Semaphore(max_in_flight)
+
+        async def run(key: str, kwargs: dict[str, Any]) -> tuple[str, Any, Any]:
+            async with semaphore:
+                try:
+                    return key, await self.acall(**kwargs), None
+                except Exception as e:
+                    return key, None, e
+
+        failed = []
+        tasks = [run(key, kwargs) for key, kwargs in jobs.items()]
+        for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+            key, result, error = await task
+            if error is not None:
+                print(f"Failed to get a response for {key}: {error}")
+                failed.append(key)
+                continue
+            on_result(key, result)
+
+        if self.cache:
+            print(f"Response cache: {self.cache.stats()}")
+        return failed
+
+    def filter_cached(self, requests: list[dict]) -> tuple[list[dict], list[dict]]:
+        """
+        Split batch requests into those to send and batch output lines of the
+        requests answered by the response cache
+        """
+        if not self.cache:
+            return requests, []
+
+        pending, cached = [], []
+        for request in requests:
+            completion = self.cache.get(request["body"])
+            if completion is None:
+                pending.append(request)
+                continue
+            cached.append(
+                {
+                    "custom_id": request["custom_id"],
+                    "response": {"status_code": 200, "body": completion},
+                    "error": None,
+                }
+            )
+        print(f"Response cache: {len(cached)} of {len(requests)} requests answered")
+        return pending, cached
+
+    def cache_batch_output(self, requests: list[dict], output: Iterable[dict]) -> None:
+        """
+        Store the successful responses of a batch under their request bodies
+        """
+        if not self.cache:
+            return
+        bodies = {request["custom_id"]: request["body"] for request in requests}
+        for line in output:
+            response = line.get("response") or {}
+            if response.get("status_code") == 200 and line["custom_id"] in bodies:
+                self.cache.put(bodies[line["custom_id"]], response["body"])
+
+    def upload_batch(self, batch_path: str) -> str:
+        """Upload a batch request file, returns its file id."""
+        with open(batch_path, "rb") as f:
+            return self.client.files.create(file=f, purpose="batch").id
+
+    def create_batch(self, input_file_id: str) -> str:
+        """Create a batch of an uploaded request file, returns its batch id."""
         batch = self.client.batches.create(
-            input_file_id=batch_input_file_id,
+            input_file_id=input_file_id,
             endpoint="/v1/chat/completions",
             completion_window="24h",
         )
         return batch.id
 
-    def retrieve_batch(self, batch_id: str) -> dict:
-        """Function to retrieve the status of a batch request."""
+    def find_batch(self, input_file_id: str, since: float = 0) -> Optional[str]:
+        """Get the id of a batch created from a file after since, if any."""
+        for batch in self.client.batches.list(limit=100):
+            if batch.created_at < since:
+                break
+            if batch.input_file_id == input_file_id:
+                return batch.id
+        return None
+
+    def send_batch(
+        self,
+        batch_path: str,
+    ) -> str:
+        """Function to send a batch request to the GPT-4o API."""
+        return self.create_batch(self.upload_batch(batch_path))
+
+    def wait_batch(
+        self,
+        batch_id: str,
+        interval: float = 10,
+        factor: float = 1.5,
+        max_interval: float = 600,
+    ):
+        """Poll a batch with exponential backoff until it ends."""
         while True:
             current_batch = self.client.batches.retrieve(batch_id)
-            status = current_batch.status
-            print(f"Batch status: {status}")
-            if status in ("completed", "failed", "cancelled", "expired"):
-                break
-            time.sleep(10)  # Wait before polling again
+            print(f"Batch status: {current_batch.status}")
+            if current_batch.status in BATCH_TERMINAL:
+                return current_batch
+            time.sleep(interval)
+            interval = min(interval * factor, max_interval)
 
-        if status != "completed":
-            raise RuntimeError(f"Batch ended with status: {status}")
+    def download_file(
+        self, file_id: str, save_path: str, chunk_size: int = 1 << 20
+    ) -> None:
+        """Stream a file of the OpenAI API to disk without holding it in memory."""
+        with self.client.files.with_streaming_response.content(file_id) as response:
+            with open(f"{save_path}.tmp", "wb") as f:
+                for chunk in response.iter_bytes(chunk_size):
+                    f.write(chunk)
+        os.replace(f"{save_path}.tmp", save_path)
 
-        # Download output file
-        output_file_id = current_batch.output_file_id
+    def retrieve_batch(self, batch_id: str, save_path: str) -> str:
+        """Wait for a batch and stream its output file to save_path."""
+        current_batch = self.wait_batch(batch_id)
+        if current_batch.status != "completed":
+            raise RuntimeError(f"Batch ended with status: {current_batch.status}")
 
-        return self.client.files.content(output_file_id).content
+        self.download_file(current_batch.output_file_id, save_path)
+        return save_path
 
 
 if __name__ == "__main__":
@@ -0,0 +1,109 @@
+"""Persistent cache of chat completions keyed by a hash of the prompt."""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Optional
+
+from governenv.constants import LLM_CACHE_PATH
+
+# request fields that determine the completion
+KEY_FIELDS = (
+    "model",
+    "messages",
+    "response_format",
+    "temperature",
+    "logprobs",
+    "top_logprobs",
+)
+
+
+def prompt_key(body: dict[str, Any], version: str) -> str:
+    """Hash the fields of a chat completion request and the prompt version."""
+    material = {field: body.get(field) for field in KEY_FIELDS}
+    # disabled logprobs are sent as False or left out, both mean the same
+    material["logprobs"] = bool(material["logprobs"])
+    if not material["logprobs"]:
+        material["top_logprobs"] = None
+    return hashlib.sha256(
+        json.dumps([version, material], sort_keys=True, separators=(",", ":")).encode()
+    ).hexdigest()
+
+
+class ResponseCache:
+    """Chat completions in a single SQLite file, compressed with zlib.
+
+    Every entry is tagged with the prompt version it was made under. The
+    version is part of the key, so bumping it misses all earlier entries,
+    and invalidate drops the entries of a version from the file.
+    """
+
+    def __init__(self, path: str = LLM_CACHE_PATH, version: str = "1"):
+        self.path = str(path)
+        self.version = str(version)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, version TEXT, model TEXT, "
+            "created REAL, response BLOB)"
+        )
+        self._db.commit()
+
+    def key(self, body: dict[str, Any]) -> str:
+        """Get the cache key of a request body."""
+        return prompt_key(body, self.version)
+
+    def get(self, body: dict[str, Any]) -> Optional[dict]:
+        """Get the cached completion of a request body, None on a miss."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT response FROM responses WHERE key = ?", (self.key(body),)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, body: dict[str, Any], completion: dict) -> None:
+        """Store the completion of a request body."""
+        blob = zlib.compress(json.dumps(completion, separators=(",", ":")).encode())
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (self.key(body), self.version, body.get("model"), time.time(), blob),
+            )
+            self._db.commit()
+
+    def invalidate(self, version: Optional[str] = None) -> int:
+        """Delete the entries of a prompt version, by default all but the current."""
+        with self._lock:
+            if version is None:
+                cursor = self._db.execute(
+                    "DELETE FROM responses WHERE version != ?", (self.version,)
+                )
+            else:
+                cursor = self._db.execute(
+                    "DELETE FROM responses WHERE version = ?", (str(version),)
+                )
+            self._db.commit()
+            self._db.execute("VACUUM")
+        return cursor.rowcount
+
+    def stats(self) -> dict[str, Any]:
+        """Get the hits and misses of this session and the stored entries."""
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+        }
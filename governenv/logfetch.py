@@ -0,0 +1,57 @@
+"""Shared engine to fetch event logs over block ranges."""
+
+from typing import Any
+
+from governenv.planner import RangePlanner
+from governenv.rpc import RPCError, RPCPool
+
+
+def split_blocks(
+    gaps: list[tuple[int, int]], step: int, finalized: int = -1
+) -> list[tuple[int, int]]:
+    """Split block intervals into ranges on the step grid, with a cut after
+    the finalized block so the unfinalized tail is its own range."""
+
+    block_ranges = []
+    for gap_start, gap_end in gaps:
+        b = gap_start
+        while b <= gap_end:
+            e = min(gap_end, (b // step + 1) * step - 1)
+            if b <= finalized < e:
+                e = finalized
+            block_ranges.append((b, e))
+            b = e + 1
+
+    return block_ranges
+
+
+async def fetch_logs(
+    pool: RPCPool,
+    planner: RangePlanner,
+    key: str,
+    params: dict[str, Any],
+    from_block: int,
+    to_block: int,
+) -> list[dict[str, Any]]:
+    """Fetch the raw logs of a filter in windows sized by the log density of key."""
+
+    logs = []
+    start = from_block
+    while start <= to_block:
+        end = min(to_block, start + planner.window(key) - 1)
+        try:
+            batch = await pool.get_logs(
+                {**params, "fromBlock": hex(start), "toBlock": hex(end)}
+            )
+        except RPCError as e:
+            if not e.too_many_results or start == end:
+                raise
+            # retry the same start with a window sized by the raised density
+            planner.overflow(key, end - start + 1)
+            continue
+
+        planner.observe(key, end - start + 1, len(batch))
+        logs.extend(batch)
+        start = end + 1
+
+    return logs
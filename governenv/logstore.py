@@ -0,0 +1,197 @@
+"""Columnar on-disk store of decoded event logs."""
+
+import json
+import os
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from governenv.events import EVENT_DTYPES
+
+
+def merge_intervals(intervals: Iterable[tuple[int, int]]) -> list[tuple[int, int]]:
+    """Merge inclusive block intervals that overlap or touch."""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def subtract_intervals(
+    start: int, end: int, covered: list[tuple[int, int]]
+) -> list[tuple[int, int]]:
+    """Get the parts of [start, end] outside merged inclusive intervals."""
+    gaps = []
+    for covered_start, covered_end in covered:
+        if covered_end < start:
+            continue
+        if covered_start > end:
+            break
+        if covered_start > start:
+            gaps.append((start, covered_start - 1))
+        start = max(start, covered_end + 1)
+    if start <= end:
+        gaps.append((start, end))
+    return gaps
+
+
+class LogStore:
+    """Decoded logs of one contract and event, one chunk per block range.
+
+    Every chunk is a structured array in the event's fixed-width record layout
+    saved as .npy, so readers can memory-map it instead of parsing text. The
+    manifest lists the block range and row count of every chunk, ranges
+    without logs are kept in the manifest only. A chunk is only added once
+    its range was fetched completely, so the chunks are the coverage of the
+    store. Chunks above the finalized block are flagged, so a later sync can
+    drop and refetch them in case of a reorg.
+    """
+
+    def __init__(self, directory: str, address: str, event: str = "Transfer"):
+        self.directory = str(directory)
+        self.dtype = EVENT_DTYPES[event]
+        self.manifest_path = os.path.join(self.directory, "manifest.json")
+        self.manifest = {
+            "address": address,
+            "event": event,
+            "dtype": np.lib.format.dtype_to_descr(self.dtype),
+            "chunks": {},
+        }
+
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                self.manifest = json.load(f)
+
+    @property
+    def address(self) -> str:
+        """Address of the contract emitting the logs."""
+        return self.manifest["address"]
+
+    @property
+    def event(self) -> str:
+        """Name of the stored event."""
+        return self.manifest["event"]
+
+    def chunks(self) -> list[dict]:
+        """Get the manifest entries of all chunks in block order."""
+        return sorted(self.manifest["chunks"].values(), key=lambda c: c["fromBlock"])
+
+    def coverage(self, final: bool = False) -> list[tuple[int, int]]:
+        """Get the merged block intervals covered by the (finalized) chunks."""
+        return merge_intervals(
+            (c["fromBlock"], c["toBlock"])
+            for c in self.chunks()
+            if not final or c.get("final", True)
+        )
+
+    def missing(self, from_block: int, to_block: int) -> list[tuple[int, int]]:
+        """Get the block intervals of [from_block, to_block] not yet covered."""
+        return subtract_intervals(from_block, to_block, self.coverage())
+
+    def verify(self, from_block: int, to_block: int) -> list[str]:
+        """Check the chunks cover the block range once with the recorded rows.
+
+        Returns a description of every gap, overlap, missing file and row
+        count mismatch, empty if the coverage is sound.
+        """
+
+        problems = []
+        last = None
+        for chunk in self.chunks():
+            if last and chunk["fromBlock"] <= last["toBlock"]:
+                problems.append(
+                    f"overlap {last['fromBlock']}-{last['toBlock']} "
+                    + f"and {chunk['fromBlock']}-{chunk['toBlock']}"
+                )
+            if not last or chunk["toBlock"] > last["toBlock"]:
+                last = chunk
+
+            if not chunk["file"]:
+                continue
+            path = os.path.join(self.directory, chunk["file"])
+            if not os.path.exists(path):
+                problems.append(f"missing file {chunk['file']}")
+            elif len(np.load(path, mmap_mode="r")) != chunk["rows"]:
+                problems.append(f"row count mismatch in {chunk['file']}")
+
+        problems.extend(
+            f"gap {start}-{end}" for start, end in self.missing(from_block, to_block)
+        )
+        return problems
+
+    def write(
+        self, from_block: int, to_block: int, records: np.ndarray, final: bool = True
+    ) -> None:
+        """Save the records of a block range and add the chunk to the manifest."""
+
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{from_block}_{to_block}"
+        chunk = {
+            "fromBlock": from_block,
+            "toBlock": to_block,
+            "rows": len(records),
+            "file": None,
+            "final": final,
+        }
+        if len(records):
+            chunk["file"] = f"{name}.npy"
+            path = os.path.join(self.directory, chunk["file"])
+            with open(f"{path}.tmp", "wb") as f:
+                np.save(f, records.astype(self.dtype, copy=False))
+            os.replace(f"{path}.tmp", path)
+
+        self.manifest["chunks"][name] = chunk
+        self.save()
+
+    def drop_unfinalized(self) -> None:
+        """Remove the chunks not finalized when fetched, so they are fetched again."""
+
+        dropped = [
+            self.manifest["chunks"].pop(name)
+            for name, chunk in list(self.manifest["chunks"].items())
+            if not chunk.get("final", True)
+        ]
+        if not dropped:
+            return
+        self.save()
+        for chunk in dropped:
+            if chunk["file"]:
+                os.remove(os.path.join(self.directory, chunk["file"]))
+
+    def save(self) -> None:
+        """Persist the manifest."""
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, indent=4)
+        os.replace(tmp_path, self.manifest_path)
+
+    def read(
+        self, from_block: int = 0, to_block: int = -1, mmap: bool = True
+    ) -> Iterator[np.ndarray]:
+        """Yield the records of the non-empty chunks overlapping a block range.
+
+        The range is inclusive, a negative to_block means no upper bound.
+        """
+        for chunk in self.chunks():
+            if not chunk["file"] or chunk["toBlock"] < from_block:
+                continue
+            if 0 <= to_block < chunk["fromBlock"]:
+                break
+            yield np.load(
+                os.path.join(self.directory, chunk["file"]),
+                mmap_mode="r" if mmap else None,
+            )
+
+    def load(self, from_block: int = 0, to_block: int = -1) -> np.ndarray:
+        """Load the records of a block range into one array."""
+        parts = list(self.read(from_block, to_block))
+        if not parts:
+            return np.empty(0, dtype=self.dtype)
+        records = np.concatenate(parts)
+        mask = records["blockNumber"] >= from_block
+        if to_block >= 0:
+            mask &= records["blockNumber"] <= to_block
+        return records[mask]
@@ -0,0 +1,147 @@
+"""Batched contract reads through Multicall3."""
+
+import asyncio
+from typing import Optional
+
+from eth_abi import decode, encode
+from web3 import Web3
+
+from governenv.constants import MULTICALL3_ADDRESS, MULTICALL3_START_BLOCK
+from governenv.rpc import RPCError, RPCPool
+
+AGGREGATE3_SELECTOR = Web3.keccak(text="aggregate3((address,bool,bytes)[])")[:4]
+
+# ERC20 view functions without arguments
+ERC20_SELECTORS = {
+    "decimals": Web3.keccak(text="decimals()")[:4],
+    "symbol": Web3.keccak(text="symbol()")[:4],
+    "totalSupply": Web3.keccak(text="totalSupply()")[:4],
+}
+BALANCE_OF_SELECTOR = Web3.keccak(text="balanceOf(address)")[:4]
+
+
+def balance_of_call(token: str, holder: str) -> tuple[str, bytes]:
+    """Build the call of an ERC20 balanceOf."""
+    return token, BALANCE_OF_SELECTOR + encode(["address"], [holder])
+
+
+def decode_uint(data: Optional[bytes]) -> Optional[int]:
+    """Decode a uint256 return value, None for a failed or empty call."""
+    if not data or len(data) < 32:
+        return None
+    return decode(["uint256"], data)[0]
+
+
+def decode_symbol(data: Optional[bytes]) -> Optional[str]:
+    """Decode a string symbol, or the bytes32 symbol of early tokens."""
+    if not data:
+        return None
+    if len(data) == 32:
+        return data.rstrip(b"\0").decode("utf-8", errors="replace")
+    try:
+        return decode(["string"], data)[0]
+    except Exception:
+        return None
+
+
+async def aggregate3(
+    pool: RPCPool,
+    calls: list[tuple[str, bytes]],
+    block: int | str = "latest",
+    batch_size: int = 500,
+) -> list[Optional[bytes]]:
+    """Run (target, calldata) calls in Multicall3 aggregate3 eth_calls.
+
+    Every call may fail on its own, the return data of a failed call is None.
+    The calls are split into eth_calls of batch_size sent concurrently.
+    """
+
+    async def run_batch(batch: list[tuple[str, bytes]]) -> list[Optional[bytes]]:
+        data = AGGREGATE3_SELECTOR + encode(
+            ["(address,bool,bytes)[]"],
+            [[(Web3.to_checksum_address(t), True, d) for t, d in batch]],
+        )
+        result = await pool.call(
+            "eth_call",
+            [
+                {"to": MULTICALL3_ADDRESS, "data": "0x" + data.hex()},
+                hex(block) if isinstance(block, int) else block,
+            ],
+        )
+        returned = decode(["(bool,bytes)[]"], bytes.fromhex(result[2:]))[0]
+        return [data if success else None for success, data in returned]
+
+    batches = await asyncio.gather(
+        *(
+            run_batch(calls[i : i + batch_size])
+            for i in range(0, len(calls), batch_size)
+        )
+    )
+    return [data for batch in batches for data in batch]
+
+
+async def token_metadata(
+    pool: RPCPool, tokens: list[str], block: int | str = "latest"
+) -> dict[str, dict]:
+    """Fetch decimals, symbol and totalSupply of ERC20 tokens.
+
+    Values the token does not implement are None.
+    """
+
+    calls = [
+        (token, ERC20_SELECTORS[name]) for token in tokens for name in ERC20_SELECTORS
+    ]
+    results = await aggregate3(pool, calls, block)
+
+    metadata = {}
+    for i, token in enumerate(tokens):
+        decimals, symbol, total_supply = results[3 * i : 3 * i + 3]
+        total_supply = decode_uint(total_supply)
+        metadata[token] = {
+            "decimals": decode_uint(decimals),
+            "symbol": decode_symbol(symbol),
+            # as string, token supplies overflow JSON number precision
+            "totalSupply": None if total_supply is None else str(total_supply),
+        }
+    return metadata
+
+
+async def balances_of(
+    pool: RPCPool,
+    token: str,
+    holders: list[str],
+    block: int,
+    batch_size: int = 500,
+) -> list[Optional[int]]:
+    """Fetch the ERC20 balances of holders at a block, None for failed calls.
+
+    Blocks before the Multicall3 deployment fall back to JSON-RPC batches of
+    plain eth_calls, where a reverted call or an empty "0x" result is None.
+    """
+
+    calls = [balance_of_call(token, holder) for holder in holders]
+    if block >= MULTICALL3_START_BLOCK:
+        results = await aggregate3(pool, calls, block, batch_size)
+        return [decode_uint(data) for data in results]
+
+    batches = await asyncio.gather(
+        *(
+            pool.batch(
+                [
+                    ("eth_call", [{"to": t, "data": "0x" + d.hex()}, hex(block)])
+                    for t, d in calls[i : i + batch_size // 5]
+                ],
+                return_errors=True,
+            )
+            for i in range(0, len(calls), batch_size // 5)
+        )
+    )
+    return [
+        (
+            None
+            if isinstance(result, RPCError) or not result or result == "0x"
+            else decode_uint(bytes.fromhex(result[2:]))
+        )
+        for batch in batches
+        for result in batch
+    ]
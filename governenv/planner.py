@@ -0,0 +1,62 @@
+"""Block-range planner for eth_getLogs based on observed log density."""
+
+import os
+import json
+from typing import Optional
+
+
+class RangePlanner:
+    """Size eth_getLogs windows from the log density learned per token.
+
+    The density (logs per block) is a moving average of previous responses,
+    raised at once when a window overflows the provider limit. Windows are
+    sized to return about target logs and the densities are persisted, so
+    reruns start with well-sized windows.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        target: int = 8000,
+        limit: int = 10000,
+        max_window: int = 100000,
+        alpha: float = 0.5,
+    ):
+        self.path = path
+        self.target = target
+        self.limit = limit
+        self.max_window = max_window
+        self.alpha = alpha
+        self.density: dict[str, float] = {}
+
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.density = json.load(f)
+
+    def window(self, key: str) -> int:
+        """Get the number of blocks for the next request of a key."""
+        density = self.density.get(key)
+        if not density:
+            return self.max_window
+        return max(1, min(self.max_window, int(self.target / density)))
+
+    def observe(self, key: str, blocks: int, logs: int) -> None:
+        """Update the density after a successful request."""
+        observed = logs / blocks
+        density = self.density.get(key)
+        self.density[key] = (
+            observed if density is None else density + self.alpha * (observed - density)
+        )
+
+    def overflow(self, key: str, blocks: int) -> None:
+        """Raise the density after a window returned too many logs."""
+        self.density[key] = max(2 * self.density.get(key, 0), self.limit / blocks)
+
+    def save(self) -> None:
+        """Persist the densities."""
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.density, f, indent=4)
+        os.replace(tmp_path, self.path)
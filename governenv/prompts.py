@@ -2,6 +2,11 @@
 Prompts, instructions, and json schemas
 """
 
+from governenv.constants import CRITERIA
+
+# Version of the prompts below, bump it to stop reusing cached responses
+PROMPT_VERSION = "1"
+
 # Prompts
 TOPIC_PROMPT = """Given the following DAO governance proposal, determine whether \
 it is directly relevant to {topic}.\
@@ -30,6 +35,32 @@ Discussion:
 (End of Discussion)
 """
 
+# the criteria come after the thread, so the windows of a proposal share the
+# instructions, post and leading discussion as a cacheable prompt prefix
+DISCUSSION_CRITERIA_PROMPT = """You are given a DAO governance proposal ("Post") and its \
+associated discussion thread ("Discussion"). Your task is to evaluate the \
+**Discussion** according to each of the criteria listed after it.
+
+Instructions:
+- The Post and Discussion entries are numbered.
+- If a discussion entry is a reply to another entry, this is indicated in parentheses (e.g., "reply to 5").
+- User roles such as [moderator], [admin], or [staff] may appear in square brackets.
+- Focus your evaluation strictly on the Discussion, not on the Post itself.
+- Evaluate every criterion on its own.
+
+Post:
+{post}
+(End of Post)
+
+Discussion:
+{discussion}
+(End of Discussion)
+
+Criteria:
+{criteria}
+(End of Criteria)
+"""
+
 STANCE_PROMPT = """You are a governance analyst and political economy researcher studying \
 decentralized autonomous organizations (DAOs). You are given a DAO governance proposal \
 ("Post") and its associated discussion thread ("Discussion").Your task is to objectively \
@@ -95,6 +126,10 @@ Your response should follow this format: '{"result": <true/false>}'."""
 DISCUSSION_INSTRUCT = """You are an expert in decentralized autonomous organizations (DAOs). \
 Your response should follow this format: '{"result": <true/false>}'."""
 
+DISCUSSION_CRITERIA_INSTRUCT = """You are an expert in decentralized autonomous \
+organizations (DAOs). Your response should have one field per criterion, named as \
+in the list, e.g. '{"support": <true/false>, "professionalism": <true/false>, ...}'."""
+
 # JSON Schemas
 JSON_SCHEMA = {
     "name": "dao",
@@ -111,6 +146,25 @@ JSON_SCHEMA = {
     "strict": True,
 }
 
+# criterion names as used in the custom ids and columns, e.g. "technical_depth"
+CRITERIA_FIELDS = {
+    criterion.lower().replace(" ", "_"): criterion for criterion in CRITERIA
+}
+CRITERIA_LIST = "\n".join(
+    f"- {field}: {criterion}" for field, criterion in CRITERIA_FIELDS.items()
+)
+
+JSON_SCHEMA_CRITERIA = {
+    "name": "dao_criteria",
+    "schema": {
+        "type": "object",
+        "properties": {field: {"type": "boolean"} for field in CRITERIA_FIELDS},
+        "required": list(CRITERIA_FIELDS),
+        "additionalProperties": False,
+    },
+    "strict": True,
+}
+
 
 JSON_SCHEMA_STANCE = {
     "name": "dao_stance",
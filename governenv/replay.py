@@ -0,0 +1,193 @@
+"""Content-addressed record/replay cache of HTTP and JSON-RPC responses.
+
+Streamed HTTP responses are never recorded, so replay mode raises ReplayMiss
+for them. The Batch API calls of ChatGPT (file uploads, batch creation,
+polling and output downloads) go through the OpenAI SDK and bypass this cache
+in every mode; a replay of a batch run relies on the response cache in
+governenv.llmcache and the output files already on disk.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Callable, Optional
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+
+from governenv.constants import REPLAY_DIR
+from governenv.settings import (
+    ALCHEMY_API_KEY,
+    COINGECKO_API_KEY,
+    DEFILLAMA_API_KEY,
+    ETHERSCAN_API_KEY,
+    INFURA_API_KEY,
+    INFURA_API_KEYS,
+    REPLAY_MODE,
+    SNAPSHOT_API_KEY,
+    THEGRAPH_API_KEY,
+)
+
+MODES = ("off", "record", "replay", "read-through")
+
+# secrets are masked out of the keys, so recordings replay under other keys
+SECRETS = [
+    key
+    for key in [
+        ALCHEMY_API_KEY,
+        COINGECKO_API_KEY,
+        DEFILLAMA_API_KEY,
+        ETHERSCAN_API_KEY,
+        INFURA_API_KEY,
+        *INFURA_API_KEYS,
+        SNAPSHOT_API_KEY,
+        THEGRAPH_API_KEY,
+    ]
+    if key
+]
+SECRET_PARAMS = {"apikey", "api_key", "x_cg_pro_api_key"}
+
+# JSON-RPC requests whose answer moves with the chain head
+VOLATILE_TAGS = {"latest", "pending", "safe", "finalized"}
+
+
+class ReplayMiss(KeyError):
+    """Request without a recorded response in replay mode."""
+
+
+def canonical_url(url: str) -> str:
+    """Normalize a URL to its request identity, with secrets masked."""
+    parts = urlparse(url)
+    query = sorted(
+        (k, "" if k.lower() in SECRET_PARAMS else v)
+        for k, v in parse_qsl(parts.query, keep_blank_values=True)
+    )
+    url = urlunparse(parts._replace(query=urlencode(query), fragment=""))
+    for secret in SECRETS:
+        url = url.replace(secret, "")
+    return url
+
+
+def request_key(method: str, url: str, body: Any = None) -> str:
+    """Hash a request by method, canonical URL and canonical body."""
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", errors="replace")
+    material = json.dumps(
+        [method.upper(), canonical_url(url), body],
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(material.encode()).hexdigest()
+
+
+def rpc_volatile(payload: Any) -> bool:
+    """Whether a JSON-RPC payload asks for the moving chain head."""
+    calls = payload if isinstance(payload, list) else [payload]
+    return any(
+        call["method"] == "eth_blockNumber"
+        or any(p in VOLATILE_TAGS for p in call["params"] if isinstance(p, str))
+        for call in calls
+    )
+
+
+class ReplayCache:
+    """Request/response cache shared by every client of the project.
+
+    Responses are stored once per content hash under blobs/, and every
+    request key points to its blob from a small entry under requests/, so
+    identical responses to different requests share their bytes on disk.
+    The modes are:
+
+    - off: every call goes to the network.
+    - record: every call goes to the network and its response is stored.
+    - replay: responses come from the cache only, a miss raises ReplayMiss.
+    - read-through: cached responses are reused, misses are fetched and stored.
+    """
+
+    def __init__(self, directory: str = REPLAY_DIR, mode: str = REPLAY_MODE):
+        if mode not in MODES:
+            raise ValueError(f"Unknown replay mode {mode}, expected one of {MODES}")
+        self.directory = str(directory)
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the cache is consulted at all."""
+        return self.mode != "off"
+
+    def _path(self, kind: str, digest: str) -> str:
+        return os.path.join(self.directory, kind, digest[:2], digest)
+
+    def _write(self, path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def load(self, key: str) -> Optional[tuple[dict, bytes]]:
+        """Get the metadata and body recorded for a request key."""
+        entry_path = self._path("requests", key)
+        if not os.path.exists(entry_path):
+            return None
+        with open(entry_path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+        blob_path = self._path("blobs", entry["blob"])
+        if not os.path.exists(blob_path):
+            return None
+        with open(blob_path, "rb") as f:
+            return entry, f.read()
+
+    def store(self, key: str, body: bytes, **meta: Any) -> None:
+        """Record the body of a request key, deduplicated by content hash."""
+        digest = hashlib.sha256(body).hexdigest()
+        blob_path = self._path("blobs", digest)
+        if not os.path.exists(blob_path):
+            self._write(blob_path, body)
+        self._write(
+            self._path("requests", key),
+            json.dumps({**meta, "blob": digest}).encode(),
+        )
+
+    def lookup(self, key: str, volatile: bool = False) -> Optional[tuple[dict, bytes]]:
+        """Get the recorded response of a request the mode allows to reuse.
+
+        Volatile requests are only reused in replay mode.
+        """
+        if self.mode == "record" or (volatile and self.mode == "read-through"):
+            return None
+        cached = self.load(key)
+        with self._lock:
+            if cached is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if cached is None and self.mode == "replay":
+            raise ReplayMiss(key)
+        return cached
+
+    def fetch_json(
+        self, key: str, send: Callable[[], Any], volatile: bool = False
+    ) -> Any:
+        """Get a JSON response from the cache or send the request and record it."""
+        cached = self.lookup(key, volatile) if self.enabled else None
+        if cached is not None:
+            return json.loads(cached[1])
+        data = send()
+        if self.enabled:
+            self.store(key, json.dumps(data).encode())
+        return data
+
+
+_CACHE: Optional[ReplayCache] = None
+
+
+def get_cache() -> ReplayCache:
+    """Get the process-wide cache configured by REPLAY_MODE."""
+    global _CACHE
+    if _CACHE is None:
+        _CACHE = ReplayCache()
+    return _CACHE
@@ -0,0 +1,266 @@
+"""Async JSON-RPC endpoint pool with per-key health scoring."""
+
+import asyncio
+import itertools
+import json
+import time
+from typing import Any, Optional
+
+import aiohttp
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.datastructures import AttributeDict
+
+from governenv.replay import get_cache, request_key, rpc_volatile
+
+QUOTA_MESSAGES = ("rate limit", "exceeded", "too many requests")
+TOO_MANY_RESULTS = -32005
+
+
+class RPCError(Exception):
+    """JSON-RPC error response."""
+
+    def __init__(self, code: int, message: str):
+        super().__init__(f"{code}: {message}")
+        self.code = code
+        self.message = message
+
+    @property
+    def too_many_results(self) -> bool:
+        """Whether the range returned more logs than the provider allows."""
+        return self.code == TOO_MANY_RESULTS and not self.quota
+
+    @property
+    def quota(self) -> bool:
+        """Whether the key hit its rate or daily quota."""
+        return any(m in self.message.lower() for m in QUOTA_MESSAGES)
+
+
+def strip_ids(payload: Any) -> Any:
+    """Drop the envelope of JSON-RPC messages, keeping their content."""
+    if isinstance(payload, list):
+        return [strip_ids(item) for item in payload]
+    return {k: v for k, v in payload.items() if k not in ("id", "jsonrpc")}
+
+
+def attach_ids(payload: Any, body: Any) -> Any:
+    """Answer a payload with responses recorded in request order."""
+    if isinstance(payload, list):
+        return [attach_ids(call, item) for call, item in zip(payload, body)]
+    return {"jsonrpc": "2.0", "id": payload["id"], **body}
+
+
+class KeyHealth:
+    """Latency, error rate and quota state of one endpoint."""
+
+    def __init__(self, url: str, alpha: float = 0.2):
+        self.url = url
+        self.alpha = alpha
+        self.latency = 1.0
+        self.error_rate = 0.0
+        self.exhausted_until = 0.0
+        self.in_flight = 0
+
+    def available(self, now: float) -> bool:
+        """Whether the key is out of its quota backoff."""
+        return now >= self.exhausted_until
+
+    def score(self) -> float:
+        """Expected cost of sending the next request to this key, lower is better."""
+        return self.latency * (1 + 10 * self.error_rate) * (1 + self.in_flight)
+
+    def record(self, latency: float, error: bool) -> None:
+        """Update the moving averages after a response."""
+        self.latency += self.alpha * (latency - self.latency)
+        self.error_rate += self.alpha * (float(error) - self.error_rate)
+
+    def exhaust(self, backoff: float) -> None:
+        """Route work away from the key for backoff seconds."""
+        self.exhausted_until = time.monotonic() + backoff
+
+
+class RPCPool:
+    """Long-lived pool of JSON-RPC endpoints shared by many concurrent tasks.
+
+    Every call goes to the healthiest key with free capacity. Keys that hit
+    their quota are parked with an exponential backoff while the others keep
+    serving.
+    """
+
+    def __init__(
+        self,
+        urls: list[str],
+        per_key: int = 4,
+        retries: int = 5,
+        timeout: float = 60,
+    ):
+        self.keys = [KeyHealth(url) for url in urls if url]
+        if not self.keys:
+            raise ValueError("No RPC endpoint given")
+        self.per_key = per_key
+        self.retries = retries
+        self.timeout = timeout
+        self._ids = itertools.count()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._free: Optional[asyncio.Condition] = None
+
+    async def __aenter__(self) -> "RPCPool":
+        self._session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            connector=aiohttp.TCPConnector(limit=len(self.keys) * self.per_key),
+        )
+        self._free = asyncio.Condition()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self._session.close()
+
+    async def _acquire(self) -> KeyHealth:
+        """Wait for the healthiest key with free capacity."""
+        async with self._free:
+            while True:
+                now = time.monotonic()
+                candidates = [
+                    k
+                    for k in self.keys
+                    if k.available(now) and k.in_flight < self.per_key
+                ]
+                if candidates:
+                    key = min(candidates, key=KeyHealth.score)
+                    key.in_flight += 1
+                    return key
+                wake = min(k.exhausted_until for k in self.keys) - now
+                try:
+                    await asyncio.wait_for(self._free.wait(), max(wake, 0.1))
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _release(self, key: KeyHealth) -> None:
+        async with self._free:
+            key.in_flight -= 1
+            self._free.notify()
+
+    async def _send(self, payload: Any, return_errors: bool = False) -> Any:
+        """Post a JSON-RPC payload, or answer it from the replay cache if enabled.
+
+        Responses are recorded without ids and in request order, so a replayed
+        batch does not depend on the ids or the endpoint of the recording.
+        """
+
+        cache = get_cache()
+        if not cache.enabled:
+            return await self._post(payload, return_errors)
+
+        key = request_key("POST", self.keys[0].url, strip_ids(payload))
+        cached = cache.lookup(key, rpc_volatile(payload))
+        if cached is not None:
+            return attach_ids(payload, json.loads(cached[1]))
+
+        body = await self._post(payload, return_errors)
+        if isinstance(body, list):
+            by_id = {item["id"]: item for item in body}
+            recorded = [by_id[call["id"]] for call in payload]
+        else:
+            recorded = body
+        cache.store(key, json.dumps(strip_ids(recorded)).encode())
+        return body
+
+    async def _post(self, payload: Any, return_errors: bool = False) -> Any:
+        """Post a JSON-RPC payload, retrying transient failures on other keys.
+
+        With return_errors, error responses other than quota errors are
+        returned in the body instead of raised.
+        """
+
+        for attempt in range(self.retries):
+            key = await self._acquire()
+            start = time.monotonic()
+            try:
+                async with self._session.post(key.url, json=payload) as response:
+                    if response.status == 429:
+                        raise RPCError(429, "too many requests")
+                    response.raise_for_status()
+                    body = await response.json(content_type=None)
+                for item in body if isinstance(body, list) else [body]:
+                    if "error" in item:
+                        error = RPCError(
+                            item["error"]["code"], item["error"]["message"]
+                        )
+                        if error.quota or not return_errors:
+                            raise error
+                key.record(time.monotonic() - start, False)
+                return body
+            except RPCError as e:
+                key.record(time.monotonic() - start, True)
+                if not e.quota:
+                    raise
+                key.exhaust(2 ** (attempt + 2))
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                key.record(time.monotonic() - start, True)
+                if attempt == self.retries - 1:
+                    raise
+            finally:
+                await self._release(key)
+        raise RPCError(429, f"Request failed on every key after {self.retries} tries")
+
+    async def call(self, method: str, params: list) -> Any:
+        """Send a JSON-RPC request."""
+        payload = {
+            "jsonrpc": "2.0",
+            "method": method,
+            "params": params,
+            "id": next(self._ids),
+        }
+        return (await self._send(payload))["result"]
+
+    async def batch(
+        self, calls: list[tuple[str, list]], return_errors: bool = False
+    ) -> list[Any]:
+        """Send several JSON-RPC requests in one batch, results in call order.
+
+        With return_errors, a failed call gives its RPCError in place of the
+        result instead of failing the whole batch.
+        """
+        payload = [
+            {"jsonrpc": "2.0", "method": method, "params": params, "id": i}
+            for i, (method, params) in enumerate(calls)
+        ]
+        results = {
+            item["id"]: (
+                RPCError(item["error"]["code"], item["error"]["message"])
+                if "error" in item
+                else item["result"]
+            )
+            for item in await self._send(payload, return_errors)
+        }
+        return [results[i] for i in range(len(calls))]
+
+    async def get_logs(self, params: dict[str, Any]) -> list[dict[str, Any]]:
+        """Fetch raw logs for an eth_getLogs filter."""
+        return await self.call("eth_getLogs", [params])
+
+    async def block_number(self) -> int:
+        """Fetch the current block number."""
+        return int(await self.call("eth_blockNumber", []), 16)
+
+    async def finalized_block(self) -> int:
+        """Fetch the number of the latest finalized block."""
+        block = await self.call("eth_getBlockByNumber", ["finalized", False])
+        return int(block["number"], 16)
+
+
+def format_log(log: dict[str, Any]) -> AttributeDict:
+    """Format a raw JSON-RPC log the way web3's get_logs does."""
+    return AttributeDict(
+        {
+            "address": Web3.to_checksum_address(log["address"]),
+            "topics": [HexBytes(t) for t in log["topics"]],
+            "data": HexBytes(log["data"]),
+            "blockNumber": int(log["blockNumber"], 16),
+            "blockHash": HexBytes(log["blockHash"]),
+            "transactionIndex": int(log["transactionIndex"], 16),
+            "transactionHash": HexBytes(log["transactionHash"]),
+            "logIndex": int(log["logIndex"], 16),
+            "removed": log.get("removed", False),
+        }
+    )
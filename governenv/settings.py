@@ -22,6 +22,9 @@ PROCESSED_DATA_DIR = (
 os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(PROCESSED_DATA_DIR, exist_ok=True)
 
+# Record/replay cache of external calls: off, record, replay or read-through
+REPLAY_MODE = os.environ.get("REPLAY_MODE", "off")
+
 # API Keys and Secrets
 HEADERS = os.environ.get("HEADERS")
 KAIKO_API_KEY = os.environ.get("KAIKO_API_KEY")
@@ -13,7 +13,6 @@ from hexbytes import HexBytes
 import jellyfish
 import numpy as np
 import pandas as pd
-import requests
 
 from eth_abi.codec import ABICodec
 from web3 import Web3
@@ -22,6 +21,7 @@ from web3._utils.filters import construct_event_filter_params
 from web3.datastructures import AttributeDict
 from web3.providers import HTTPProvider
 
+from governenv import httpclient
 from governenv.constants import EXKW, WHALE_THRESHOLD
 
 
@@ -236,7 +236,7 @@ def get_block_by_timestamp(target_block: int) -> Optional[int]:
     result = {"timestamp": None, "height": None}
 
     while length == 0:
-        result = requests.get(
+        result = httpclient.get(
             f"https://coins.llama.fi/block/ethereum/{target_block}", timeout=60
         ).json()
         length = len(result)
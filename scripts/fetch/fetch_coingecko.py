@@ -1,13 +1,22 @@
 """Script to fetch data from Coingecko API."""
 
-import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional
+import argparse
 import json
+import math
 import os
-import requests
+import time
 import pandas as pd
 from tqdm import tqdm
+from governenv import httpclient
 from governenv.settings import COINGECKO_API_KEY
-from governenv.constants import DATA_DIR
+from governenv.constants import DATA_DIR, INDEX_CONSTITUENTS_PATH, PROCESSED_DATA_DIR
+
+DAY_MS = 86_400_000
+INDEX_SIZE = 500
+MAX_WORKERS = 8
+CHART_SERIES = ["prices", "market_caps", "total_volumes"]
 
 
 class CoinGecko:
@@ -24,13 +33,76 @@ class CoinGecko:
         if os.path.exists(DATA_DIR / "coingecko_coins.csv"):
             return pd.read_csv(DATA_DIR / "coingecko_coins.csv")
         url = f"{self.BASE_URL}/coins/list"
-        response = requests.get(url, headers=self.HEADERS, timeout=60)
+        response = httpclient.get(url, headers=self.HEADERS, timeout=60)
         response.raise_for_status()
         data = response.json()
         coins_df = pd.DataFrame(data)
         coins_df.to_csv(DATA_DIR / "coingecko_coins.csv", index=False)
         return coins_df
 
+    def get_top_coins(self, size: int = INDEX_SIZE) -> list[str]:
+        """Fetch the ids of the largest coins by market cap today."""
+        coin_ids = []
+        for page in range(1, math.ceil(size / 250) + 1):
+            response = httpclient.get(
+                f"{self.BASE_URL}/coins/markets",
+                headers=self.HEADERS,
+                params={
+                    "vs_currency": "usd",
+                    "order": "market_cap_desc",
+                    "per_page": 250,
+                    "page": page,
+                },
+                timeout=30,
+            )
+            response.raise_for_status()
+            coin_ids.extend(coin["id"] for coin in response.json())
+        return coin_ids[:size]
+
+    def _save_index_constituents(self, coin_ids: list[str]) -> None:
+        os.makedirs(os.path.dirname(INDEX_CONSTITUENTS_PATH), exist_ok=True)
+        pd.DataFrame({"id": sorted(coin_ids)}).to_csv(
+            f"{INDEX_CONSTITUENTS_PATH}.tmp", index=False
+        )
+        os.replace(f"{INDEX_CONSTITUENTS_PATH}.tmp", INDEX_CONSTITUENTS_PATH)
+
+    def get_index_constituents(
+        self, charts_dir: str = DATA_DIR / "coingecko" / "market_charts"
+    ) -> list[str]:
+        """Get the persisted coins of the crypto index.
+
+        The list is seeded once from the charts fetched by earlier runs, or
+        the largest coins today on a fresh checkout, and only grows through
+        add_index_constituents, so coins that fall out of the top ranks keep
+        their history in the index.
+        """
+        if os.path.exists(INDEX_CONSTITUENTS_PATH):
+            return pd.read_csv(INDEX_CONSTITUENTS_PATH)["id"].tolist()
+
+        coin_ids = (
+            [f[:-5] for f in os.listdir(charts_dir) if f.endswith(".json")]
+            if os.path.exists(charts_dir)
+            else []
+        ) or self.get_top_coins()
+        self._save_index_constituents(coin_ids)
+        return sorted(coin_ids)
+
+    def add_index_constituents(self, coin_ids: list[str]) -> list[str]:
+        """Add coins to the persisted index constituents."""
+        constituents = sorted(set(self.get_index_constituents()) | set(coin_ids))
+        self._save_index_constituents(constituents)
+        return constituents
+
+    def get_consumed_coins(self) -> list[str]:
+        """Get the coins used downstream: space tokens and index constituents."""
+        coin_ids = set(self.get_index_constituents())
+        spaces_path = PROCESSED_DATA_DIR / "spaces_gecko.csv"
+        if os.path.exists(spaces_path):
+            coin_ids |= set(pd.read_csv(spaces_path)["coingecko"].dropna())
+        else:
+            print("spaces_gecko.csv not found, fetching the index constituents only")
+        return sorted(coin_ids)
+
     # Fetch market chart data
     def _get_coin_market_chart(
         self,
@@ -40,23 +112,45 @@ class CoinGecko:
         interval: str = "daily",
         save_path: str = None,
     ) -> None:
-        """Fetch the market chart data for a specific coin."""
+        """Fetch the market chart data for a specific coin.
+
+        A stored chart is extended with the days after its last daily point
+        instead of being fetched again.
+        """
+
+        stored, last = None, None
+        if os.path.exists(save_path):
+            with open(save_path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            # the last point is the intraday price at fetch time, not a day close
+            daily = [p[0] for p in stored["prices"] if p[0] % DAY_MS == 0]
+            if daily:
+                last = max(daily)
+                days = math.ceil((time.time() * 1000 - last) / DAY_MS) + 1
 
         url = f"{self.BASE_URL}/coins/{coin_id}/market_chart"
         query_string = {"vs_currency": vs_currency, "days": days, "interval": interval}
-        response = requests.get(
+        response = httpclient.get(
             url, headers=self.HEADERS, params=query_string, timeout=10
         )
         response.raise_for_status()
         data = response.json()
-        with open(save_path, "w", encoding="utf-8") as f:
+
+        if last is not None:
+            data = {
+                col: [p for p in stored[col] if p[0] <= last]
+                + [p for p in data[col] if p[0] > last]
+                for col in CHART_SERIES
+            }
+        with open(f"{save_path}.tmp", "w", encoding="utf-8") as f:
             json.dump(data, f, indent=4)
+        os.replace(f"{save_path}.tmp", save_path)
 
     # Fetch coin data
     def _get_coin_data(self, coin_id: str, save_path: str) -> None:
         """Fetch the data for a specific coin."""
         url = f"{self.BASE_URL}/coins/{coin_id}"
-        response = requests.get(url, headers=self.HEADERS, timeout=30)
+        response = httpclient.get(url, headers=self.HEADERS, timeout=30)
         response.raise_for_status()
         data = response.json()
         with open(save_path, "w", encoding="utf-8") as f:
@@ -64,49 +158,75 @@ class CoinGecko:
 
     def get_coins_market_charts(
         self,
+        coin_ids: Optional[list[str]] = None,
         vs_currency: str = "usd",
         days: int | str = "max",
         interval: str = "daily",
         save_dir: str = DATA_DIR / "coingecko" / "market_charts",
     ) -> None:
-        """Fetch market chart data for multiple coins."""
+        """Fetch or extend the market chart data of the consumed coins."""
         os.makedirs(save_dir, exist_ok=True)
-        coin_ids = self.coins_list["id"].tolist()
-        for coin_id in tqdm(coin_ids):
-            save_path = save_dir / f"{coin_id}.json"
-            if os.path.exists(save_path):
-                continue
-            try:
-                self._get_coin_market_chart(
+        if coin_ids is None:
+            coin_ids = self.get_consumed_coins()
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {
+                executor.submit(
+                    self._get_coin_market_chart,
                     coin_id=coin_id,
                     vs_currency=vs_currency,
                     days=days,
                     interval=interval,
-                    save_path=save_path,
-                )
-            except:
-                print(f"Failed to fetch market chart for {coin_id}")
-                time.sleep(10)
+                    save_path=save_dir / f"{coin_id}.json",
+                ): coin_id
+                for coin_id in coin_ids
+            }
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                try:
+                    future.result()
+                except Exception:
+                    print(f"Failed to fetch market chart for {futures[future]}")
 
     def get_coins_data(
         self,
+        coin_ids: Optional[list[str]] = None,
         save_dir: str = DATA_DIR / "coingecko" / "coins",
     ) -> None:
-        """Fetch data for multiple coins."""
+        """Fetch data for the consumed coins not fetched yet."""
         os.makedirs(save_dir, exist_ok=True)
-        coin_ids = self.coins_list["id"].tolist()
-        for coin_id in tqdm(coin_ids):
-            save_path = save_dir / f"{coin_id}.json"
-            if os.path.exists(save_path):
-                continue
-            try:
-                self._get_coin_data(coin_id=coin_id, save_path=save_path)
-            except:
-                print(f"Failed to fetch data for {coin_id}")
-                time.sleep(10)
+        if coin_ids is None:
+            coin_ids = self.get_consumed_coins()
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {
+                executor.submit(
+                    self._get_coin_data,
+                    coin_id=coin_id,
+                    save_path=save_dir / f"{coin_id}.json",
+                ): coin_id
+                for coin_id in coin_ids
+                if not os.path.exists(save_dir / f"{coin_id}.json")
+            }
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                try:
+                    future.result()
+                except Exception:
+                    print(f"Failed to fetch data for {futures[future]}")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch Coingecko coin data.")
+    parser.add_argument(
+        "--add",
+        nargs="*",
+        default=[],
+        help="Coin ids to add to the index constituents before fetching.",
+    )
+    args = parser.parse_args()
+
     coingecko = CoinGecko()
-    coingecko.get_coins_market_charts()
-    coingecko.get_coins_data()
+    if args.add:
+        coingecko.add_index_constituents(args.add)
+    consumed_coins = coingecko.get_consumed_coins()
+    coingecko.get_coins_market_charts(consumed_coins)
+    coingecko.get_coins_data(consumed_coins)
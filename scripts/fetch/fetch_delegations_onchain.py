@@ -1,78 +1,182 @@
 """
-Script to fetch new pool data
+Script to fetch the Snapshot delegation events
 """
 
+import argparse
+import asyncio
 import gzip
 import json
-import time
+import os
 
-from web3 import Web3
-from web3.providers import HTTPProvider
+import numpy as np
 from tqdm import tqdm
 
 from governenv.constants import (
     ABI_DIR,
-    INFURA_ENDPOINT,
+    INFURA_ENDPOINTS,
+    DELEGATION_LOG_DENSITY_PATH,
+    REORG_TAIL,
     SNAPSHOT_DELEGATION_ADDRESS,
     SNAPSHOT_DELEGATION_START_BLOCK,
     DATA_DIR,
 )
-from governenv.utils import _fetch_events_for_all_contracts, to_dict
+from governenv.events import (
+    CLEAR_DELEGATE_TOPIC,
+    DELEGATION_EVENTS,
+    EVENT_DTYPES,
+    SET_DELEGATE_TOPIC,
+    decode_records,
+    rows_to_columns,
+    to_records,
+)
+from governenv.logfetch import fetch_logs, split_blocks
+from governenv.logstore import LogStore, merge_intervals
+from governenv.planner import RangePlanner
+from governenv.rpc import RPCPool
+
+STEP = 100_000
+PER_KEY = 4
 
-w3 = Web3(HTTPProvider(INFURA_ENDPOINT))
 
+def delegation_store(delegation_type: str) -> LogStore:
+    """Open the columnar store of a delegation event"""
+    return LogStore(
+        DATA_DIR / "delegation" / f"{delegation_type}_delegate",
+        SNAPSHOT_DELEGATION_ADDRESS.lower(),
+        DELEGATION_EVENTS[delegation_type],
+    )
 
-def current_block() -> int:
-    """Get the current block number"""
-    return w3.eth.block_number
 
+def legacy_events(delegation_type: str) -> list[dict]:
+    """Read the gzip JSONL file of earlier full runs, empty if there is none"""
 
-def split_blocks(start_block: int, end_block: int, step: int) -> list[tuple[int, int]]:
-    """Split blocks into smaller chunks"""
-    if step <= 0:
-        raise ValueError("step must be positive")
-    if start_block > end_block:
+    path = DATA_DIR / f"snapshot_{delegation_type}_delegate_onchain.jsonl.gz"
+    if not os.path.exists(path):
         return []
-    blocks: list[tuple[int, int]] = []
-    s = start_block
-    while s <= end_block:
-        e = min(s + step - 1, end_block)
-        blocks.append((s, e))
-        s = e + 1
-    return blocks
-
-
-with open(ABI_DIR / "snapshot_delegation.json", "r", encoding="utf-8") as fh:
-    abi = json.load(fh)
-contract = w3.eth.contract(address=SNAPSHOT_DELEGATION_ADDRESS, abi=abi)
-
-tip = current_block()
-event_dict = {
-    "set_delegate": contract.events.SetDelegate,
-    "clear_delegate": contract.events.ClearDelegate,
-}
-
-for name, delegate_event in event_dict.items():
-    with gzip.open(
-        f"{DATA_DIR}/snapshot_{name}_onchain.jsonl.gz", "wt", encoding="utf-8"
-    ) as f:
-        for start, end in tqdm(
-            split_blocks(
-                SNAPSHOT_DELEGATION_START_BLOCK,
-                tip,
-                100_000,
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def migrate_jsonl(stores: dict[str, LogStore]) -> None:
+    """Import the gzip JSONL files of earlier full runs into the empty stores"""
+
+    if all(store.chunks() for store in stores.values()):
+        return
+    events = {t: legacy_events(t) for t in stores}
+    if not all(events.values()):
+        return
+
+    # the files were written in one pass each and end at an unknown block past
+    # their last event, so both are cut at the earlier of the two last events
+    end = min(max(e["blockNumber"] for e in rows) for rows in events.values())
+    for delegation_type, store in stores.items():
+        if store.chunks():
+            continue
+        name = DELEGATION_EVENTS[delegation_type]
+        rows = [e for e in events[delegation_type] if e["blockNumber"] <= end]
+        store.write(
+            SNAPSHOT_DELEGATION_START_BLOCK,
+            end,
+            to_records(name, rows_to_columns(name, rows)),
+        )
+
+
+async def fetch_delegation_range(
+    pool: RPCPool,
+    planner: RangePlanner,
+    event_abis: list[dict],
+    stores: dict[str, LogStore],
+    from_block: int,
+    to_block: int,
+    finalized: int,
+) -> bool:
+    """Fetch both delegation events of a block range in the same calls"""
+
+    try:
+        logs = await fetch_logs(
+            pool,
+            planner,
+            SNAPSHOT_DELEGATION_ADDRESS.lower(),
+            {
+                "address": SNAPSHOT_DELEGATION_ADDRESS,
+                "topics": [[SET_DELEGATE_TOPIC, CLEAR_DELEGATE_TOPIC]],
+            },
+            from_block,
+            to_block,
+        )
+    except Exception as e:
+        print(f"Error fetch delegations for block range {from_block}-{to_block}: {e}")
+        return False
+
+    records = decode_records(logs, event_abis)
+    for delegation_type, store in stores.items():
+        name = DELEGATION_EVENTS[delegation_type]
+        events = records.get(name, np.empty(0, EVENT_DTYPES[name]))
+        # only the parts the store misses, the other store may cover the rest
+        for start, end in store.missing(from_block, to_block):
+            store.write(
+                start,
+                end,
+                events[
+                    (events["blockNumber"] >= start) & (events["blockNumber"] <= end)
+                ],
+                final=to_block <= finalized,
             )
-        ):
-            time.sleep(2)
-            events = to_dict(
-                _fetch_events_for_all_contracts(
-                    w3,
-                    delegate_event,
-                    {},
-                    start,
-                    end,
-                )
+    return True
+
+
+async def fetch_delegations(event_abis: list[dict], tail: int = REORG_TAIL) -> None:
+    """Sync the delegation events up to the chain head"""
+
+    planner = RangePlanner(DELEGATION_LOG_DENSITY_PATH, max_window=STEP)
+    stores = {t: delegation_store(t) for t in DELEGATION_EVENTS}
+    async with RPCPool(INFURA_ENDPOINTS, per_key=PER_KEY) as pool:
+        head = await pool.block_number()
+        finalized = min(await pool.finalized_block(), head - tail)
+
+        migrate_jsonl(stores)
+        for store in stores.values():
+            store.drop_unfinalized()
+
+        # a range is fetched once for both events if either store misses it,
+        # and each store only keeps the parts it misses
+        gaps = merge_intervals(
+            gap
+            for store in stores.values()
+            for gap in store.missing(SNAPSHOT_DELEGATION_START_BLOCK, head)
+        )
+        tasks = [
+            fetch_delegation_range(
+                pool, planner, event_abis, stores, *block_range, finalized
             )
-            for event in events:
-                event["args"]["id"] = "0x" + event["args"]["id"].hex()
-                f.write(json.dumps(event) + "\n")
+            for block_range in split_blocks(gaps, STEP, finalized)
+        ]
+
+        print(f"Fetching {len(tasks)} block ranges up to block {head}")
+        try:
+            for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+                await task
+        finally:
+            planner.save()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Sync Snapshot delegation events.")
+    parser.add_argument(
+        "--tail",
+        type=int,
+        default=REORG_TAIL,
+        help="Blocks below the head treated as unfinalized and refetched next sync.",
+    )
+    args = parser.parse_args()
+
+    with open(ABI_DIR / "snapshot_delegation.json", "r", encoding="utf-8") as fh:
+        abi = json.load(fh)
+    delegation_abis = [
+        item
+        for item in abi
+        if item["type"] == "event" and item["name"] in DELEGATION_EVENTS.values()
+    ]
+
+    asyncio.run(fetch_delegations(delegation_abis, args.tail))
@@ -1,17 +1,20 @@
 """Script to fetch discussion."""
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import re
 import json
 import os
-import time
 
 import pandas as pd
 import numpy as np
-import requests
 from tqdm import tqdm
 
+from governenv import httpclient
 from governenv.constants import DATA_DIR, PROCESSED_DATA_DIR, SHUT_DOWN, SPECIAL
 
+POSTS_PER_REQUEST = 20
+MAX_HOST_WORKERS = 16
 
 os.makedirs(DATA_DIR / "discussion", exist_ok=True)
 
@@ -22,6 +25,101 @@ def check_forum_link(link: str) -> bool:
     return len(parts := link.split("/")) > 3 and parts[3] == "t"
 
 
+def missing_post_ids(thread: dict) -> list[int]:
+    """Get the ids in the post stream of a thread that are not loaded yet.
+
+    Ids the forum did not return when asked, deleted or hidden posts, are
+    recorded as unavailable and not asked for again.
+    """
+    skip = {post["id"] for post in thread["post_stream"]["posts"]}
+    skip |= set(thread["post_stream"].get("unavailable", []))
+    return [i for i in thread["post_stream"].get("stream", []) if i not in skip]
+
+
+def complete_thread(host: str, discussion_id: str, thread: dict) -> bool:
+    """Fetch the missing posts of a thread in batches, True if all succeeded."""
+
+    posts = thread["post_stream"]["posts"]
+    unavailable = thread["post_stream"].setdefault("unavailable", [])
+    missing = missing_post_ids(thread)
+    for i in range(0, len(missing), POSTS_PER_REQUEST):
+        batch = missing[i : i + POSTS_PER_REQUEST]
+        res = httpclient.get(
+            f"https://{host}/t/{discussion_id}/posts.json",
+            params={"post_ids[]": batch},
+            timeout=10,
+        )
+        if res.status_code != 200:
+            return False
+        returned = res.json()["post_stream"]["posts"]
+        posts.extend(returned)
+        returned_ids = {post["id"] for post in returned}
+        unavailable.extend(post_id for post_id in batch if post_id not in returned_ids)
+
+    # keep the posts in stream order
+    order = {post_id: i for i, post_id in enumerate(thread["post_stream"]["stream"])}
+    posts.sort(key=lambda post: order.get(post["id"], len(order)))
+    return True
+
+
+def fetch_thread(host: str, space: str, discussion_id: str, proposal_id: str) -> None:
+    """Fetch a complete discussion thread and save it."""
+
+    file_path = DATA_DIR / "discussion" / space / f"{discussion_id}.json"
+    if file_path.exists():
+        with open(file_path, "r", encoding="utf-8") as f:
+            thread = json.load(f)
+        # files of earlier runs may only hold the first chunk of posts
+        if not missing_post_ids(thread):
+            return
+    else:
+        URL = f"https://{host}/t/{discussion_id}.json?track_visit=true&forceLoad=true"
+        try:
+            res = httpclient.get(URL, timeout=10)
+        except Exception as e:
+            print(
+                f"Error fetching discussion {discussion_id} for proposal {proposal_id}: {e}"
+            )
+            return
+
+        if res.status_code != 200:
+            print(
+                f"Failed to fetch discussion {discussion_id} for proposal {proposal_id}"
+            )
+            return
+        # requests.JSONDecodeError of an HTML error page is a ValueError
+        try:
+            thread = res.json()
+        except ValueError as e:
+            print(f"Invalid JSON of discussion {discussion_id}: {e}")
+            return
+
+        # Check if discussion exists
+        if "post_stream" not in thread:
+            print(f"Discussion {discussion_id} not found, skipping.")
+            return
+
+    try:
+        complete = complete_thread(host, discussion_id, thread)
+    except Exception as e:
+        print(f"Error fetching posts of discussion {discussion_id}: {e}")
+        complete = False
+    if not complete and file_path.exists():
+        return
+
+    # save partial threads too, the next run fetches the missing posts
+    with open(f"{file_path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(thread, f, ensure_ascii=False, indent=4)
+    os.replace(f"{file_path}.tmp", file_path)
+
+
+def fetch_host(host: str, host_threads: list[tuple[str, str, str]], pbar: tqdm) -> None:
+    """Fetch the threads of one forum host one after another."""
+    for space, discussion_id, proposal_id in host_threads:
+        fetch_thread(host, space, discussion_id, proposal_id)
+        pbar.update(1)
+
+
 def can_int(x) -> bool:
     """Check if x can be converted to int."""
     try:
@@ -82,7 +180,8 @@ df_proposals = df_proposals.loc[
 
 df_proposals.to_csv(PROCESSED_DATA_DIR / "proposals_discussion.csv", index=False)
 
-# Fetch balancer forum discussion
+# Fetch the forum threads, one worker per host under the host's rate limit
+threads = defaultdict(list)
 for space in df_proposals["space"].unique():
     os.makedirs(DATA_DIR / "discussion" / space, exist_ok=True)
 
@@ -90,45 +189,24 @@ for space in df_proposals["space"].unique():
         print(f"Skipping {space} as the forum is shut down.")
         continue
 
-    for idx, row in tqdm(
-        df_proposals.loc[df_proposals["space"] == space].iterrows(),
-        total=len(df_proposals.loc[df_proposals["space"] == space]),
-        desc=f"Fetching discussions for {space}",
-    ):
-        header = row["discussion_root"]
-
+    for _, row in df_proposals.loc[df_proposals["space"] == space].iterrows():
         # Handle special cases
         if row["discussion"] in SPECIAL:
             discussion_id = SPECIAL[row["discussion"]]
         else:
             discussion_id = row["discussion"].split("/")[5]
-
-        # Fetch discussion JSON
-        file_path = DATA_DIR / "discussion" / space / f"{discussion_id}.json"
-        if file_path.exists():
-            continue
-        time.sleep(5)
-
-        URL = f"https://{header}/t/{discussion_id}.json?track_visit=true&forceLoad=true"
-        try:
-            res = requests.get(URL, timeout=10)
-        except Exception as e:
-            print(
-                f"Error fetching discussion {discussion_id} for proposal {row['id']}: {e}"
-            )
-            continue
-
-        if res.status_code != 200:
-            print(
-                f"Failed to fetch discussion {discussion_id} for proposal {row['id']}"
-            )
-            continue
-        res = res.json()
-
-        # Check if discussion exists
-        if "post_stream" not in res:
-            print(f"Discussion {discussion_id} not found, skipping.")
-            continue
-
-        with open(file_path, "w", encoding="utf-8") as f:
-            json.dump(res, f, ensure_ascii=False, indent=4)
+        threads[row["discussion_root"]].append((space, discussion_id, row["id"]))
+
+with (
+    tqdm(
+        total=sum(len(v) for v in threads.values()), desc="Fetching discussions"
+    ) as pbar,
+    ThreadPoolExecutor(
+        max_workers=max(1, min(MAX_HOST_WORKERS, len(threads)))
+    ) as executor,
+):
+    for future in as_completed(
+        executor.submit(fetch_host, host, host_threads, pbar)
+        for host, host_threads in threads.items()
+    ):
+        future.result()
@@ -41,6 +41,7 @@ query(
     end_point=SNAPSHOT_ENDPOINT,
     time_var="created",
     batch_size=1000,
+    n_slices=8,
 )
 
 # # Fetch delegation data from Snapshot API
@@ -1,178 +1,321 @@
 """Script to fetch governance token transfer"""
 
 from ast import literal_eval
-import time
+from collections import defaultdict
+from typing import Optional
+import argparse
+import asyncio
+import glob
 import os
 import json
-from typing import Optional
-import multiprocessing
 
-import glob
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
-from web3 import HTTPProvider, Web3
-from web3.exceptions import Web3RPCError
+from web3 import Web3
 
 from governenv.constants import (
     PROCESSED_DATA_DIR,
     ABI_DIR,
     DATA_DIR,
-    INFURA_API_BASE,
-    CURRENT_BLOCK,
+    INFURA_ENDPOINTS,
+    LOG_DENSITY_PATH,
+    REORG_TAIL,
     STAKING_TOKEN,
 )
-from governenv.utils import (
-    _fetch_events_for_all_contracts,
-    to_dict,
+from governenv.events import (
+    TRANSFER_TOPIC,
+    EVENT_DTYPES,
+    decode_records,
+    rows_to_columns,
+    to_records,
 )
+from governenv.logfetch import fetch_logs, split_blocks
+from governenv.logstore import LogStore
+from governenv.planner import RangePlanner
+from governenv.rpc import RPCError, RPCPool
 
-INFURA_API_KEYS = os.getenv("INFURA_API_KEYS", "").split(",")
 STEP = 100000
+PER_KEY = 4
+MAX_GROUP = 50
 
 
-def split_blocks(
-    start: int, end: int, step: int, address: str
-) -> list[tuple[int, int]]:
-    """
-    Split the blocks into start and end ranges
-    """
-
-    min_block = (start // step) * step
-    max_block = (end // step) * step
-
-    block_ranges = []
-    for b in range(min_block, max_block + step, step):
-        if b < start:
-            if os.path.exists(
-                f"{DATA_DIR}/transfer/{address}/{start}_{b + step - 1}.jsonl"
-            ):
-                continue
-            block_ranges.append((start, b + step - 1))
-        elif b + step > end:
-            if os.path.exists(f"{DATA_DIR}/transfer/{address}/{b}_{end}.jsonl"):
-                continue
-            block_ranges.append((b, end))
-        else:
-            if os.path.exists(
-                f"{DATA_DIR}/transfer/{address}/{b}_{b + step - 1}.jsonl"
-            ):
-                continue
-            block_ranges.append((b, b + step - 1))
-
-    return block_ranges
+def decode_transfers(logs: list[dict], event_abi: dict) -> np.ndarray:
+    """Decode raw transfer logs to records, in batch where the layout is standard"""
+    records = decode_records(logs, [event_abi])
+    return records.get("Transfer", np.empty(0, EVENT_DTYPES["Transfer"]))
 
 
-def fetch_transfer_multiprocess(
+async def fetch_transfer(
+    pool: RPCPool,
+    planner: RangePlanner,
+    event_abi: dict,
     from_block: int,
     to_block: int,
     address: str,
-    api_queue: multiprocessing.Queue,
-    path: str,
-    abi: dict[str, str],
-) -> None:
-    """Fetch the transfer events for all governance tokens using multiprocessing"""
-    http = api_queue.get()
-    fetch_transfer(
+) -> np.ndarray:
+    """Fetch the transfer records of a token in windows sized by its log density"""
+
+    logs = await fetch_logs(
+        pool,
+        planner,
+        address,
+        {"address": Web3.to_checksum_address(address), "topics": [TRANSFER_TOPIC]},
         from_block,
         to_block,
-        address,
-        http,
-        path,
-        abi,
     )
-    api_queue.put(http)
+    return decode_transfers(logs, event_abi)
 
 
-def fetch_transfer(
-    from_block: int,
-    to_block: int,
-    address: str,
-    http: str,
-    path: str,
-    abi: dict[str, str],
-    is_main: bool = True,
-    temp_data: Optional[list] = None,
-) -> bool:
-    """Fetch the transfer events for all governance tokens"""
-    if temp_data is None:
-        temp_data = []
+async def fetch_transfer_multi(
+    pool: RPCPool,
+    planner: RangePlanner,
+    event_abi: dict,
+    group: list[tuple[str, int, int]],
+) -> dict[str, np.ndarray]:
+    """Fetch the transfer records of several tokens in one call, keyed by token"""
 
-    success = True
+    from_block = min(g[1] for g in group)
+    to_block = max(g[2] for g in group)
+    try:
+        logs = await pool.get_logs(
+            {
+                "address": [Web3.to_checksum_address(g[0]) for g in group],
+                "topics": [TRANSFER_TOPIC],
+                "fromBlock": hex(from_block),
+                "toBlock": hex(to_block),
+            }
+        )
+    except RPCError as e:
+        if not e.too_many_results:
+            raise
+        # split the group by tokens, a single token falls back to windows
+        if len(group) == 1:
+            address, from_block, to_block = group[0]
+            return {
+                address: await fetch_transfer(
+                    pool, planner, event_abi, from_block, to_block, address
+                )
+            }
+        half = len(group) // 2
+        left, right = await asyncio.gather(
+            fetch_transfer_multi(pool, planner, event_abi, group[:half]),
+            fetch_transfer_multi(pool, planner, event_abi, group[half:]),
+        )
+        return left | right
 
-    # Initialize web3
-    w3 = Web3(HTTPProvider(http))
-    checksum = Web3.to_checksum_address(address)
-    contract = w3.eth.contract(address=checksum, abi=abi)
-    transfer_event = contract.events.Transfer
+    # fan the raw logs out to their tokens
+    raw_logs = {address: [] for address, _, _ in group}
+    ranges = {address: (start, end) for address, start, end in group}
+    for log in logs:
+        address = log["address"].lower()
+        start, end = ranges[address]
+        if start <= int(log["blockNumber"], 16) <= end:
+            raw_logs[address].append(log)
+    for address, start, end in group:
+        planner.observe(address, end - start + 1, len(raw_logs[address]))
 
-    try:
-        time.sleep(1)
-        events = _fetch_events_for_all_contracts(
-            w3,
-            transfer_event,
-            {"address": Web3.to_checksum_address(address)},
-            from_block,
-            to_block,
+    return {
+        address: decode_transfers(logs, event_abi) for address, logs in raw_logs.items()
+    }
+
+
+def migrate_jsonl(store: LogStore) -> None:
+    """Move the JSONL block ranges of earlier runs into the columnar store"""
+
+    for path in glob.glob(f"{store.directory}/*.jsonl"):
+        from_block, to_block = map(int, os.path.basename(path)[:-6].split("_"))
+        with open(path, "r", encoding="utf-8") as f:
+            events = [json.loads(line) for line in f]
+        records = (
+            to_records("Transfer", rows_to_columns("Transfer", events))
+            if events
+            else np.empty(0, EVENT_DTYPES["Transfer"])
         )
-        temp_data.extend(to_dict(events))
-    except Web3RPCError as e:
+        store.write(from_block, to_block, records)
+        os.remove(path)
+
+
+async def fetch_transfer_range(
+    pool: RPCPool,
+    planner: RangePlanner,
+    semaphore: asyncio.Semaphore,
+    event_abi: dict,
+    from_block: int,
+    to_block: int,
+    store: LogStore,
+    finalized: int,
+) -> bool:
+    """Fetch one block range of a token and save it once complete"""
+
+    async with semaphore:
         try:
-            error_msg = json.loads(e.args[0].replace("'", '"'))
-            if error_msg.get("code") == -32005:
-                mid_block = (from_block + to_block) // 2
-                left_ok = fetch_transfer(
-                    from_block,
-                    mid_block,
-                    address,
-                    http,
-                    path,
-                    abi,
-                    False,
-                    temp_data,
-                )
-                right_ok = fetch_transfer(
-                    mid_block + 1,
-                    to_block,
-                    address,
-                    http,
-                    path,
-                    abi,
-                    False,
-                    temp_data,
-                )
-                success = left_ok and right_ok
-        except json.JSONDecodeError as e:
+            records = await fetch_transfer(
+                pool, planner, event_abi, from_block, to_block, store.address
+            )
+        except Exception as e:
             print(
-                f"Error fetch {address} events for block range {from_block}-{to_block}: {e}"
+                f"Error fetch {store.address} events for block range "
+                + f"{from_block}-{to_block}: {e}"
             )
-            success = False
+            return False
+
+    store.write(from_block, to_block, records, final=to_block <= finalized)
+    return True
+
+
+async def fetch_transfer_group(
+    pool: RPCPool,
+    planner: RangePlanner,
+    semaphore: asyncio.Semaphore,
+    event_abi: dict,
+    group: list[tuple[str, int, int]],
+    stores: dict[str, LogStore],
+    finalized: int,
+) -> bool:
+    """Fetch the same slot of several quiet tokens and save each token's range"""
+
+    async with semaphore:
+        try:
+            records = await fetch_transfer_multi(pool, planner, event_abi, group)
         except Exception as e:
             print(
-                f"Error fetch {address} events for block range {from_block}-{to_block}: {e}"
+                f"Error fetch events of {len(group)} tokens for block range "
+                + f"{group[0][1]}-{group[0][2]}: {e}"
             )
-            success = False
-    except Exception as e:
-        print(
-            f"Error fetch {address} events for block range {from_block}-{to_block}: {e}"
+            return False
+
+    for address, from_block, to_block in group:
+        stores[address].write(
+            from_block, to_block, records[address], final=to_block <= finalized
         )
-        success = False
+    return True
+
+
+def group_quiet_ranges(
+    planner: RangePlanner, ranges: list[tuple[str, int, int]]
+) -> list[list[tuple[str, int, int]]]:
+    """Pack ranges of the same slot into groups expected to fit one call,
+    with at most one range per token in a group, all tokens of known density"""
+
+    slots = defaultdict(list)
+    for address, from_block, to_block in ranges:
+        slots[from_block // STEP].append((address, from_block, to_block))
+
+    groups = []
+    for members in slots.values():
+        group, expected, addresses = [], 0.0, set()
+        for address, from_block, to_block in members:
+            logs = planner.density[address] * (to_block - from_block + 1)
+            if group and (
+                len(group) == MAX_GROUP
+                or expected + logs > planner.target
+                or address in addresses
+            ):
+                groups.append(group)
+                group, expected, addresses = [], 0.0, set()
+            group.append((address, from_block, to_block))
+            expected += logs
+            addresses.add(address)
+        groups.append(group)
+
+    return groups
 
-    if is_main and success:
-        with open(path, "w", encoding="utf-8") as f:
-            for item in temp_data:
-                f.write(json.dumps(item) + "\n")
 
-    return success
+async def fetch_all_transfers(
+    token_set: set[tuple[str, int, int]],
+    event_abi: dict,
+    end_block: Optional[int] = None,
+    tail: int = REORG_TAIL,
+) -> None:
+    """Sync the transfer events of all tokens up to the chain head over one
+    shared RPC pool, refetching the ranges that were not finalized yet"""
+
+    planner = RangePlanner(LOG_DENSITY_PATH, max_window=STEP)
+    async with RPCPool(INFURA_ENDPOINTS, per_key=PER_KEY) as pool:
+        # bound the ranges held in memory, the pool bounds requests in flight
+        semaphore = asyncio.Semaphore(2 * PER_KEY * len(pool.keys))
+
+        head = await pool.block_number()
+        finalized = min(await pool.finalized_block(), head - tail)
+        end_block = head if end_block is None else min(end_block, head)
+        print(f"Syncing to block {end_block}, finalized up to {finalized}")
+
+        # busy tokens and tokens of unknown density get windowed calls, which
+        # learn the density, tokens known to be quiet share calls per slot,
+        # one store per token is shared by all tasks writing its manifest
+        tasks, quiet, stores = [], [], {}
+        for address, _, start_block in token_set:
+            store = LogStore(f"{DATA_DIR}/transfer/{address}", address)
+            migrate_jsonl(store)
+            store.drop_unfinalized()
+            stores[address] = store
+            gaps = store.missing(start_block, end_block)
+            for block_range in split_blocks(gaps, STEP, finalized):
+                if address in planner.density and planner.window(address) >= STEP:
+                    quiet.append((address, *block_range))
+                    continue
+                tasks.append(
+                    fetch_transfer_range(
+                        pool,
+                        planner,
+                        semaphore,
+                        event_abi,
+                        *block_range,
+                        store,
+                        finalized,
+                    )
+                )
+        for group in group_quiet_ranges(planner, quiet):
+            tasks.append(
+                fetch_transfer_group(
+                    pool, planner, semaphore, event_abi, group, stores, finalized
+                )
+            )
+
+        print(
+            f"Fetching {len(tasks)} tasks ({len(quiet)} quiet ranges grouped) "
+            + f"for {len(token_set)} tokens"
+        )
+        try:
+            for i, task in enumerate(
+                tqdm(asyncio.as_completed(tasks), total=len(tasks))
+            ):
+                await task
+                if i % 100 == 0:
+                    planner.save()
+        finally:
+            planner.save()
+
+    # report tokens still missing ranges or with inconsistent chunks
+    for address, _, start_block in token_set:
+        problems = stores[address].verify(start_block, end_block)
+        if problems:
+            print(f"Coverage of {address}: {', '.join(problems[:5])}")
 
 
 if __name__ == "__main__":
 
-    finish_files = set(
-        file.split("/")[-1] for file in glob.glob(f"{DATA_DIR}/transfer/*")
+    parser = argparse.ArgumentParser(description="Sync governance token transfers.")
+    parser.add_argument(
+        "--end-block",
+        type=int,
+        default=None,
+        help="Last block to fetch, the chain head by default.",
+    )
+    parser.add_argument(
+        "--tail",
+        type=int,
+        default=REORG_TAIL,
+        help="Blocks below the head treated as unfinalized and refetched next sync.",
     )
+    args = parser.parse_args()
 
     with open(ABI_DIR / "erc20.json", "r", encoding="utf-8") as f:
         abi = json.load(f)
+    transfer_abi = next(
+        item for item in abi if item["type"] == "event" and item["name"] == "Transfer"
+    )
 
     df_proposals_with_sc = pd.read_csv(PROCESSED_DATA_DIR / "proposals_with_sc.csv")
     df_proposals_with_sc["address"] = df_proposals_with_sc["address"].apply(
@@ -189,36 +332,4 @@ if __name__ == "__main__":
     for staking_address, info in STAKING_TOKEN.items():
         token_set.add((info["address"], info["decimal"], info["blockNumber"]))
 
-    # token_set = [t for t in token_set if f"{t[0]}" not in finish_files]
-    for address, _, start_block in tqdm(token_set):
-        end_block = CURRENT_BLOCK
-        blocks = split_blocks(start_block, end_block, STEP, address)
-        print(f"Fetching transfer for {address} at blocks {blocks}")
-        with multiprocessing.Manager() as manager:
-            api_queue = manager.Queue()
-
-            for api_key in INFURA_API_KEYS:
-                api_queue.put(INFURA_API_BASE + api_key)
-
-            os.makedirs(f"{DATA_DIR}/transfer/{address}", exist_ok=True)
-
-            blocks = split_blocks(start_block, end_block, STEP, address)
-            if len(blocks) == 0:
-                continue
-
-            num_processes = min(len(INFURA_API_KEYS), os.cpu_count())
-
-            with multiprocessing.Pool(processes=num_processes) as pool:
-                pool.starmap(
-                    fetch_transfer_multiprocess,
-                    [
-                        (
-                            *block_range,
-                            address,
-                            api_queue,
-                            f"{DATA_DIR}/transfer/{address}/{block_range[0]}_{block_range[1]}.jsonl",
-                            abi,
-                        )
-                        for block_range in blocks
-                    ],
-                )
+    asyncio.run(fetch_all_transfers(token_set, transfer_abi, args.end_block, args.tail))
@@ -1,48 +1,56 @@
-"""Script to fetch block timestamps from DeFiLlama"""
+"""Script to map proposal timestamps to blocks with the local block index"""
 
+import asyncio
 import os
 import json
 import pandas as pd
-from tqdm import tqdm
 
-from governenv.defillama import DefiLlama
-from governenv.constants import PROCESSED_DATA_DIR
+from governenv.blockindex import BlockIndex
+from governenv.constants import BLOCK_INDEX_PATH, INFURA_ENDPOINTS, PROCESSED_DATA_DIR
+from governenv.rpc import RPCPool
 
 SAVE_PATH = PROCESSED_DATA_DIR / "snapshot_block.json"
 
-defillama = DefiLlama()
 
-df_proposals_with_sc = pd.read_csv(PROCESSED_DATA_DIR / "proposals_with_sc.csv")
+async def resolve_blocks(timestamps: set[int]) -> dict[int, int]:
+    """Resolve timestamps to blocks over the RPC pool"""
+    index = BlockIndex(BLOCK_INDEX_PATH)
+    async with RPCPool(INFURA_ENDPOINTS) as pool:
+        return await index.resolve(pool, timestamps)
 
 
-all_tasks = []
-for _, row in df_proposals_with_sc.iterrows():
+if __name__ == "__main__":
 
-    # fetch block numbers for start, end, created and their +/- 5 day timestamps
-    for col in ["start", "end", "created"]:
-        for col_name in [f"{col}_ts_-5d", f"{col}_ts_+5d"]:
-            all_tasks.append(row[col_name])
+    df_proposals_with_sc = pd.read_csv(PROCESSED_DATA_DIR / "proposals_with_sc.csv")
 
-    # fetch created block for voting power calculation
-    all_tasks.append(row["created_ts"])
+    all_tasks = []
+    for _, row in df_proposals_with_sc.iterrows():
 
-all_tasks = set(all_tasks)
+        # fetch block numbers for start, end, created and their +/- 5 day timestamps
+        for col in ["start", "end", "created"]:
+            for col_name in [f"{col}_ts_-5d", f"{col}_ts_+5d"]:
+                all_tasks.append(int(row[col_name]))
 
-if os.path.exists(SAVE_PATH):
-    with open(SAVE_PATH, "r", encoding="utf-8") as f:
-        snapshot_block = json.load(f)
-    fetched_ts = set(int(ts) for ts in snapshot_block.keys())
-    all_tasks = all_tasks - fetched_ts
-else:
-    snapshot_block = {}
+        # fetch created block for voting power calculation
+        all_tasks.append(int(row["created_ts"]))
 
-# Fetch block numbers for all unique timestamps
-for ts in tqdm(all_tasks):
-    try:
-        snapshot_block[ts] = defillama.get_block_by_timestamp(ts)
-    except Exception as e:
-        print(f"Failed to fetch block for timestamp {ts}: {e}")
+    all_tasks = set(all_tasks)
 
-# Save the results
-with open(SAVE_PATH, "w", encoding="utf-8") as f:
-    json.dump(snapshot_block, f, indent=4)
+    if os.path.exists(SAVE_PATH):
+        with open(SAVE_PATH, "r", encoding="utf-8") as f:
+            snapshot_block = json.load(f)
+        fetched_ts = set(int(ts) for ts in snapshot_block.keys())
+        all_tasks = all_tasks - fetched_ts
+    else:
+        snapshot_block = {}
+
+    # Resolve all unique timestamps, headers are logged as they arrive
+    resolved = asyncio.run(resolve_blocks(all_tasks))
+    for ts in all_tasks - set(resolved):
+        print(f"Failed to resolve block for timestamp {ts}")
+    snapshot_block.update({str(ts): block for ts, block in resolved.items()})
+
+    # Save the results
+    with open(f"{SAVE_PATH}.tmp", "w", encoding="utf-8") as f:
+        json.dump(snapshot_block, f, indent=4)
+    os.replace(f"{SAVE_PATH}.tmp", SAVE_PATH)
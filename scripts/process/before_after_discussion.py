@@ -1,54 +1,36 @@
 """Script to process before and after discussion data"""
 
-from collections import defaultdict
-import json
-
 import pandas as pd
 import numpy as np
 
 from scripts.process.nlp_discussion import df_proposals
+from governenv.batch import BatchResults
 from governenv.constants import PROCESSED_DATA_DIR, CRITERIA
+from governenv.llm import field_probs
 
+RESPONSE_DIR = PROCESSED_DATA_DIR / "discussion" / "response"
 
-def parse_string(s: str) -> tuple[str, str, str]:
-    """Function to parse the custom_id string into proposal_id, criterion, and type."""
-    hash_part, rest = s.split("_", 1)  # split first underscore
-    criterion, type_part = rest.rsplit("_", 1)  # split last underscore
-    return hash_part, criterion, type_part
-
-
-gpt_res = defaultdict(lambda: defaultdict(dict))
-
-with open(
-    PROCESSED_DATA_DIR / "discussion" / "response" / "before_after_discussion.jsonl",
-    "r",
-    encoding="utf-8",
-) as f:
-    batch_responses = [json.loads(line) for line in f.readlines()]
-
-for response in batch_responses:
-    proposal_id_criterion = response["custom_id"]
-    proposal_id, criterion, typ = parse_string(proposal_id_criterion)
-    res = response["response"]["body"]["choices"][0]["logprobs"]["content"][3]["token"]
-    logprob = response["response"]["body"]["choices"][0]["logprobs"]["content"][3][
-        "logprob"
-    ]
-    prob = np.exp(logprob)
-    gpt_res[proposal_id][criterion][typ] = prob if res == "true" else 1 - prob
+# stream the batch output into the keyed store, it is too large to load at
+# once with logprobs
+gpt_res = BatchResults(RESPONSE_DIR / "criteria.sqlite")
+gpt_res.load(RESPONSE_DIR / "criteria.jsonl")
 
 
 df_proposals_char = []
 for idx, row in df_proposals.iterrows():
     row_char = row.copy()
     proposal_id = row["id"]
+    discussion_data = {}
+    for typ in ["before", "after", "full"]:
+        if f"{proposal_id}_{typ}" in gpt_res:
+            result = gpt_res[f"{proposal_id}_{typ}"]
+            discussion_data[typ] = field_probs(result["content"], result["logprobs"])
     for criterion in CRITERIA:
         for typ in ["before", "after", "full"]:
             criterion = criterion.lower().replace(" ", "_")
-            discussion_data = gpt_res[str(proposal_id)]
-            if criterion in discussion_data and typ in discussion_data[criterion]:
-                row_char[f"{criterion}_{typ}"] = discussion_data[criterion][typ]
-            else:
-                row_char[f"{criterion}_{typ}"] = np.nan
+            row_char[f"{criterion}_{typ}"] = discussion_data.get(typ, {}).get(
+                criterion, np.nan
+            )
 
     df_proposals_char.append(row_char)
 
@@ -1,10 +1,10 @@
 """Script to use GPT to classify proposal topics."""
 
+import asyncio
 import json
 import os
 
 import pandas as pd
-from tqdm import tqdm
 
 from governenv.constants import PROCESSED_DATA_DIR, TOPICS
 from governenv.llm import ChatGPT
@@ -21,24 +21,26 @@ proposal_dict = {}
 for _, row in df_proposals.iterrows():
     proposal_dict[row["id"]] = row["title_body"]
 
+
+def save_topic(path: str, response: str) -> None:
+    """Save a classification as soon as it completes."""
+    with open(path, "w", encoding="utf-8") as fout:
+        json.dump(json.loads(response), fout)
+
+
+# skip the classifications saved by an earlier run
+jobs = {}
 for topic in TOPICS:
-    os.makedirs(f"{PROCESSED_DATA_DIR}/topic/{topic.replace(" ", "_")}", exist_ok=True)
-    for fid, proposal in tqdm(proposal_dict.items()):
-        if os.path.exists(
-            f"{PROCESSED_DATA_DIR}/topic/{topic.replace(' ', '_')}/{fid}.json"
-        ):
+    topic_dir = f"{PROCESSED_DATA_DIR}/topic/{topic.replace(' ', '_')}"
+    os.makedirs(topic_dir, exist_ok=True)
+    for fid, proposal in proposal_dict.items():
+        if os.path.exists(f"{topic_dir}/{fid}.json"):
             continue
-
-        res = chat_gpt(
-            message=TOPIC_PROMPT.format(topic=topic, proposal=proposal),
-            instruction=TOPIC_INSTRUCT,
-            json_schema=JSON_SCHEMA,
-            temperature=0,
-        )
-        res = json.loads(res)
-        with open(
-            f"{PROCESSED_DATA_DIR}/topic/{topic.replace(" ", "_")}/{fid}.json",
-            "w",
-            encoding="utf-8",
-        ) as fout:
-            json.dump(res, fout)
+        jobs[f"{topic_dir}/{fid}.json"] = {
+            "message": TOPIC_PROMPT.format(topic=topic, proposal=proposal),
+            "instruction": TOPIC_INSTRUCT,
+            "json_schema": JSON_SCHEMA,
+            "temperature": 0,
+        }
+
+asyncio.run(chat_gpt.amap(jobs, save_topic))
@@ -1,11 +1,10 @@
 """Script to label centralized exchange (CEX)"""
 
+import asyncio
 import json
 
 import pandas as pd
 
-from tqdm import tqdm
-
 from governenv.constants import DATA_DIR, PROCESSED_DATA_DIR
 from governenv.llm import ChatGPT
 
@@ -47,13 +46,29 @@ cex = cex.loc[cex["network"] == "ETH"]
 
 cex_china = {}
 
-for exchange in tqdm(cex["exchange"].unique()):
-    response = gpt(
-        CEX_PROMPT.format(cex=exchange),
-        json_schema=JSON_SCHEMA,
-    )
+
+def save_result(exchange: str, response: str) -> None:
+    """Collect a label as it completes."""
     cex_china[exchange] = json.loads(response)["result"]
 
+
+failed = asyncio.run(
+    gpt.amap(
+        {
+            exchange: {
+                "message": CEX_PROMPT.format(cex=exchange),
+                "json_schema": JSON_SCHEMA,
+            }
+            for exchange in cex["exchange"].unique()
+        },
+        save_result,
+    )
+)
+
+# a partial file would pass for a complete labelling, rerun to retry
+if failed:
+    raise SystemExit(f"No label for {len(failed)} exchanges: {', '.join(failed)}")
+
 with open(
     PROCESSED_DATA_DIR / "cex_china.json",
     "w",
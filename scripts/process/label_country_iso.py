@@ -1,13 +1,11 @@
 """Script to label country"""
 
+import asyncio
 import json
 
-from tqdm import tqdm
-
 from governenv.constants import PROCESSED_DATA_DIR
 from governenv.llm import ChatGPT
 
-
 COUNTRY_PROMPT = (
     'Please classify the country "{country}" '
     "into one of the ISO 3166-1 alpha-3 codes. "
@@ -38,13 +36,30 @@ with open(PROCESSED_DATA_DIR / "anchor_country.json", "r", encoding="utf-8") as
     anchor_country = json.load(f)
 
 anchor_country_iso = {}
-for country in tqdm(anchor_country):
-    response = gpt(
-        COUNTRY_PROMPT.format(country=country),
-        json_schema=JSON_SCHEMA,
-    )
+
+
+def save_result(country: str, response: str) -> None:
+    """Collect a label as it completes."""
     anchor_country_iso[country] = json.loads(response)["result"]
 
+
+failed = asyncio.run(
+    gpt.amap(
+        {
+            country: {
+                "message": COUNTRY_PROMPT.format(country=country),
+                "json_schema": JSON_SCHEMA,
+            }
+            for country in anchor_country
+        },
+        save_result,
+    )
+)
+
+# a partial file would pass for a complete labelling, rerun to retry
+if failed:
+    raise SystemExit(f"No label for {len(failed)} countries: {', '.join(failed)}")
+
 with open(
     PROCESSED_DATA_DIR / "anchor_country_iso.json",
     "w",
@@ -1,14 +1,13 @@
 """Script to label country"""
 
-import numpy as np
+import asyncio
 import json
 
-from tqdm import tqdm
+import numpy as np
 
 from governenv.constants import PROCESSED_DATA_DIR
 from governenv.llm import ChatGPT
 
-
 COUNTRY_PROMPT = (
     'Please classify the country "{country}" '
     "into one of the following regions: Africa and Middle East, "
@@ -41,13 +40,30 @@ anchor_country = np.load(
 ).tolist()
 
 anchor_country_region = {}
-for country in tqdm(anchor_country):
-    response = gpt(
-        COUNTRY_PROMPT.format(country=country),
-        json_schema=JSON_SCHEMA,
-    )
+
+
+def save_result(country: str, response: str) -> None:
+    """Collect a label as it completes."""
     anchor_country_region[country] = json.loads(response)["result"]
 
+
+failed = asyncio.run(
+    gpt.amap(
+        {
+            country: {
+                "message": COUNTRY_PROMPT.format(country=country),
+                "json_schema": JSON_SCHEMA,
+            }
+            for country in anchor_country
+        },
+        save_result,
+    )
+)
+
+# a partial file would pass for a complete labelling, rerun to retry
+if failed:
+    raise SystemExit(f"No label for {len(failed)} countries: {', '.join(failed)}")
+
 with open(
     PROCESSED_DATA_DIR / "anchor_country_region.json",
     "w",
@@ -1,6 +1,7 @@
 """Script to merge Coingecko chart data."""
 
 import json
+import os
 import pandas as pd
 from tqdm import tqdm
 import numpy as np
@@ -18,9 +19,12 @@ for idx, row in tqdm(coingecko_coins.iterrows(), total=coingecko_coins.shape[0])
     gecko_id = row["id"]
     gecko_name = row["name"]
     gecko_symbol = row["symbol"]
-    with open(
-        f"{DATA_DIR}/coingecko/market_charts/{gecko_id}.json", "r", encoding="utf-8"
-    ) as f:
+
+    # only the coins consumed downstream are fetched
+    chart_path = f"{DATA_DIR}/coingecko/market_charts/{gecko_id}.json"
+    if not os.path.exists(chart_path):
+        continue
+    with open(chart_path, "r", encoding="utf-8") as f:
         data = json.load(f)
 
     for idx, col in enumerate(["prices", "market_caps", "total_volumes"]):
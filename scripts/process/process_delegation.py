@@ -4,22 +4,26 @@ from typing import Literal
 
 import os
 import json
-import gzip
 import pandas as pd
 from tqdm import tqdm
 
-from governenv.constants import DATA_DIR, PROCESSED_DATA_DIR
+from governenv.constants import (
+    DATA_DIR,
+    PROCESSED_DATA_DIR,
+    SNAPSHOT_DELEGATION_ADDRESS,
+)
+from governenv.events import DELEGATION_EVENTS, to_hex
+from governenv.logstore import LogStore
 
 
 def load_delegation_data(delegation_type: Literal["set", "clear"]):
-    """Load delegation data from JSONL gzip files."""
+    """Load delegation data from the columnar delegation store."""
 
-    with gzip.open(
-        DATA_DIR / f"snapshot_{delegation_type}_delegate_onchain.jsonl.gz",
-        "rt",
-        encoding="utf-8",
-    ) as f:
-        delegations = [json.loads(line) for line in f.readlines()]
+    records = LogStore(
+        DATA_DIR / "delegation" / f"{delegation_type}_delegate",
+        SNAPSHOT_DELEGATION_ADDRESS.lower(),
+        DELEGATION_EVENTS[delegation_type],
+    ).load()
 
     df_delegations = {
         "delegator": [],
@@ -29,28 +33,25 @@ def load_delegation_data(delegation_type: Literal["set", "clear"]):
         "transactionIndex": [],
         "logIndex": [],
     }
-    for delegation in delegations:
+    delegators = to_hex(records["delegator"])
+    delegatees = to_hex(records["delegate"])
+    for i, space_id in enumerate(records["id"]):
         # id is the hex to string representation of space
-        if (
-            delegation["args"]["id"]
-            == "0x0000000000000000000000000000000000000000000000000000000000000000"
-        ):
+        if not space_id.any():
             df_delegations["space"].append("all")
         else:
             try:
                 df_delegations["space"].append(
-                    bytes.fromhex(delegation["args"]["id"][2:])
-                    .decode("utf-8")
-                    .rstrip("\x00")
+                    space_id.tobytes().decode("utf-8").rstrip("\x00")
                 )
             except Exception:  # pylint: disable=broad-except
                 continue
 
-        df_delegations["delegator"].append(delegation["args"]["delegator"].lower())
-        df_delegations["delegatee"].append(delegation["args"]["delegate"].lower())
-        df_delegations["blockNumber"].append(delegation["blockNumber"])
-        df_delegations["transactionIndex"].append(delegation["transactionIndex"])
-        df_delegations["logIndex"].append(delegation["logIndex"])
+        df_delegations["delegator"].append(delegators[i])
+        df_delegations["delegatee"].append(delegatees[i])
+        df_delegations["blockNumber"].append(records["blockNumber"][i])
+        df_delegations["transactionIndex"].append(records["transactionIndex"][i])
+        df_delegations["logIndex"].append(records["logIndex"][i])
 
     df_delegations = pd.DataFrame(df_delegations)
     df_delegations["type"] = delegation_type
@@ -1,24 +1,64 @@
 """Script to merge adjusted proposals with smart contract data."""
 
+import asyncio
 import json
 import os
 from ast import literal_eval
 
 import pandas as pd
-from web3 import Web3
-from tqdm import tqdm
 
-from governenv.constants import PROCESSED_DATA_DIR, INFURA_ENDPOINT, ABI_DIR
+from governenv.constants import (
+    PROCESSED_DATA_DIR,
+    INFURA_ENDPOINTS,
+    TOKEN_METADATA_PATH,
+)
 from governenv.etherscan import Etherscan
-from governenv.utils import get_token_decimal
+from governenv.multicall import token_metadata
+from governenv.rpc import RPCPool
 
-# Initialize web3
-w3 = Web3(Web3.HTTPProvider(INFURA_ENDPOINT))
-with open(ABI_DIR / "erc20.json", "r", encoding="utf-8") as f:
-    abi = json.load(f)
 ETHERSCAN_API_KEY = os.getenv("ETHERSCAN_API_KEY")
 etherscan = Etherscan(api_key=ETHERSCAN_API_KEY)
 
+
+async def fetch_token_metadata(tokens: list[str]) -> dict[str, dict]:
+    """Fetch the ERC20 metadata of tokens with Multicall3"""
+    async with RPCPool(INFURA_ENDPOINTS) as pool:
+        return await token_metadata(pool, tokens)
+
+
+def resolve_tokens(addresses: list[str]) -> dict[str, dict]:
+    """Resolve the creation block and ERC20 metadata of tokens, cached by address.
+
+    Addresses without a contract creation get a None blockNumber and those
+    without decimals() get None decimals, so they are not looked up again.
+    """
+
+    cache = {}
+    if os.path.exists(TOKEN_METADATA_PATH):
+        with open(TOKEN_METADATA_PATH, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+
+    missing = [address for address in addresses if address not in cache]
+    if missing:
+        print(f"Resolving {len(missing)} of {len(addresses)} tokens")
+        creations = etherscan.get_contract_creations(missing)
+        metadata = asyncio.run(fetch_token_metadata(missing))
+        for address in missing:
+            creation_info = creations.get(address)
+            cache[address] = {
+                "blockNumber": (
+                    int(creation_info["blockNumber"]) if creation_info else None
+                ),
+                **metadata[address],
+            }
+
+        with open(f"{TOKEN_METADATA_PATH}.tmp", "w", encoding="utf-8") as f:
+            json.dump(cache, f, indent=4)
+        os.replace(f"{TOKEN_METADATA_PATH}.tmp", TOKEN_METADATA_PATH)
+
+    return {address: cache[address] for address in addresses}
+
+
 df_proposals = pd.read_csv(PROCESSED_DATA_DIR / "proposals_event_study.csv")
 df_proposals["strategies"] = df_proposals["strategies"].apply(literal_eval)
 
@@ -79,20 +119,15 @@ for idx, row in df_proposals_with_sc.iterrows():
             "decimal": token["decimal"],
         }
 
+# keep contracts implementing the ERC20 decimals()
 token_block_dict = {}
-for address, _ in tqdm(token_dict.items()):
-    res = etherscan.get_contract_creation(
-        contract_address=address,
-    )
-    creation_info = res[address][0] if res[address] else {}
-    try:
-        _ = get_token_decimal(w3, address, abi)
-    except Exception as e:
-        print(f"Error getting token decimal for {address}: {e}")
+for address, info in resolve_tokens(list(token_dict)).items():
+    if info["blockNumber"] is None or info["decimals"] is None:
+        print(f"Skipping {address}: not an ERC20 contract")
         continue
 
     token_block_dict[address] = {
-        "blockNumber": int(creation_info["blockNumber"]),
+        "blockNumber": info["blockNumber"],
         "decimal": token_dict[address]["decimal"],
     }
 
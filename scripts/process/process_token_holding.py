@@ -9,7 +9,12 @@ import pandas as pd
 
 from tqdm import tqdm
 
-from governenv.constants import PROCESSED_DATA_DIR, STAKING_TOKEN, MIXED_TYPE_TOKEN
+from governenv.constants import (
+    PROCESSED_DATA_DIR,
+    STAKING_TOKEN,
+    MIXED_TYPE_TOKEN,
+    TRANSFER_STATE_PATH,
+)
 
 
 def build_snapshot(holding_dict: defaultdict, contract: set) -> dict:
@@ -25,16 +30,19 @@ def build_snapshot(holding_dict: defaultdict, contract: set) -> dict:
     return snap
 
 
-def save_snapshot(holding_dict: dict, address_str: str, block: int):
-    """Save the snapshot to a json file."""
-    with open(
+def snapshot_path(address_str: str, block: int):
+    """Path of the holding snapshot of a token at a block."""
+    return (
         PROCESSED_DATA_DIR
         / "holding"
         / f"{address_str}"
-        / f"{address_str}_{block}.json",
-        "w",
-        encoding="utf-8",
-    ) as f:
+        / f"{address_str}_{block}.json"
+    )
+
+
+def save_snapshot(holding_dict: dict, address_str: str, block: int):
+    """Save the snapshot to a json file."""
+    with open(snapshot_path(address_str, block), "w", encoding="utf-8") as f:
         json.dump(holding_dict, f, indent=4)
 
 
@@ -116,6 +124,12 @@ for idx, row in df_proposals_with_sc.iterrows():
 for address, block_list in token_block.items():
     token_block[address] = sorted(set(block_list))
 
+# last block appended to every processed transfer file
+transfer_state = {}
+if os.path.exists(TRANSFER_STATE_PATH):
+    with open(TRANSFER_STATE_PATH, "r", encoding="utf-8") as f:
+        transfer_state = json.load(f)
+
 for address, block_list in tqdm(
     token_block.items(),
     desc="Processing token holdings",
@@ -151,17 +165,35 @@ for address, block_list in tqdm(
     if not block_list:
         raise ValueError(f"No blocks found for address {address}")
 
-    # Interate through each proposal
+    # Skip the blocks whose snapshot was saved by an earlier run
+    block_list = [
+        b for b in block_list if b is None or not snapshot_path(address, b).exists()
+    ]
+    # files without a state are only known to cover their last transfer
+    through = (
+        transfer_state[address]["block"]
+        if address in transfer_state
+        else int(df_transfer["blockNumber"].max())
+    )
+
+    # Resume from the saved balances if every block left comes after them
     holding = defaultdict(float)
+    replayed = -1
+    state_path = PROCESSED_DATA_DIR / "holding" / f"{address}" / "state.json"
+    if state_path.exists():
+        with open(state_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        if all(b is None or int(b) > state["block"] for b in block_list):
+            holding.update(state["holding"])
+            replayed = state["block"]
+    df_transfer = df_transfer.loc[df_transfer["blockNumber"] > replayed]
+
+    # Interate through each proposal, replaying to the end to save the balances
     for _, r in df_transfer.iterrows():
 
         # Get the current block number
         block_number = r["blockNumber"]
 
-        # If there is no block left to process, break the loop
-        if len(block_list) == 0:
-            break
-
         # Get the list of blocks that are smaller than the current block number
         finished_block = [
             b for b in block_list if b is not None and int(b) < int(block_number)
@@ -189,10 +221,16 @@ for address, block_list in tqdm(
         holding[from_addr] -= amount
         holding[to_addr] += amount
 
-    # --- Final flush: emit remaining blocks (covers == last processed block) ---
-    if block_list:
-        print(f"Final flush for {address}, {len(block_list)} blocks left")
+    # --- Final flush: emit remaining blocks the transfers already cover ---
+    flush = [b for b in block_list if b is not None and int(b) <= through]
+    if flush:
+        print(f"Final flush for {address}, {len(flush)} blocks left")
         snapshot = build_snapshot(holding, contract_set)
-        for b in list(block_list):
+        for b in flush:
             save_snapshot(snapshot, address, b)
             block_list.remove(b)
+
+    # Save the balances, the next run only replays transfers after through
+    with open(f"{state_path}.tmp", "w", encoding="utf-8") as f:
+        json.dump({"block": through, "holding": holding}, f)
+    os.replace(f"{state_path}.tmp", state_path)
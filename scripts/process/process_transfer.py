@@ -1,15 +1,21 @@
 """Script to process the transfer data"""
 
 from ast import literal_eval
-import os
-import glob
 import json
+import os
 
 import pandas as pd
 from tqdm import tqdm
 
-from governenv.constants import DATA_DIR, PROCESSED_DATA_DIR, STAKING_TOKEN
-
+from governenv.constants import (
+    DATA_DIR,
+    LEGACY_TRANSFER_END_BLOCK,
+    PROCESSED_DATA_DIR,
+    STAKING_TOKEN,
+    TRANSFER_STATE_PATH,
+)
+from governenv.events import limbs_to_int, to_hex
+from governenv.logstore import LogStore
 
 for name in ["transfer", "contract"]:
     os.makedirs(PROCESSED_DATA_DIR / name, exist_ok=True)
@@ -32,41 +38,82 @@ for addr_list in df_proposals_with_sc["address"]:
     for staking_address, info in STAKING_TOKEN.items():
         token_decimal[info["address"].lower()] = info["decimal"]
 
-existing_files = glob.glob(f"{PROCESSED_DATA_DIR}/transfer/*.csv")
-existing_files = [os.path.basename(i) for i in existing_files]
-todo_tokens = set(token_decimal.keys()) - set(
-    [i.replace(".csv", "") for i in existing_files]
-)
+# last block and size of every processed transfer file, so reruns only append
+transfer_state = {}
+if os.path.exists(TRANSFER_STATE_PATH):
+    with open(TRANSFER_STATE_PATH, "r", encoding="utf-8") as f:
+        transfer_state = json.load(f)
+
+
+def save_state() -> None:
+    """Persist the processed transfer state."""
+    with open(f"{TRANSFER_STATE_PATH}.tmp", "w", encoding="utf-8") as f:
+        json.dump(transfer_state, f, indent=4)
+    os.replace(f"{TRANSFER_STATE_PATH}.tmp", TRANSFER_STATE_PATH)
+
 
 for address, decimal in tqdm(token_decimal.items(), desc="Processing token transfers"):
-    # process the transfer data
-    if f"{address}.csv" in existing_files:
-        continue
+    transfer_path = PROCESSED_DATA_DIR / "transfer" / f"{address}.csv"
+    contract_path = PROCESSED_DATA_DIR / "contract" / f"{address}.csv"
+
+    # files built in one go before the state was kept cover the old fetch
+    if address not in transfer_state and transfer_path.exists():
+        transfer_state[address] = {
+            "block": LEGACY_TRANSFER_END_BLOCK,
+            "size": os.path.getsize(transfer_path),
+        }
+    state = transfer_state.get(address, {"block": -1, "size": 0})
 
-    files = glob.glob(f"{DATA_DIR}/transfer/{address}/*.jsonl")
-    all_data = []
-    for file in files:
-        with open(file, "r", encoding="utf-8") as f:
-            for line in f:
-                item = json.loads(line)
-                item["from"] = item["args"]["from"].lower()
-                item["to"] = item["args"]["to"].lower()
-                item["amount"] = int(item["args"]["amount"]) / (10**decimal)
-                all_data.append(item)
-    df = pd.DataFrame(all_data)
-    if df.empty:
+    # drop rows appended by a run that stopped before saving the state
+    if transfer_path.exists() and os.path.getsize(transfer_path) > state["size"]:
+        with open(transfer_path, "r+b") as f:
+            f.truncate(state["size"])
+
+    # append the finalized blocks that directly follow the processed ones
+    store = LogStore(f"{DATA_DIR}/transfer/{address}", address)
+    coverage = [c for c in store.coverage(final=True) if c[1] > state["block"]]
+    if not coverage or (state["block"] >= 0 and coverage[0][0] > state["block"] + 1):
+        # keep the state of files with nothing to append yet
+        transfer_state[address] = state
+        save_state()
         continue
-    df.drop(columns=["args"], inplace=True)
-    df.sort_values("blockNumber", ascending=True, inplace=True)
-    df.to_csv(PROCESSED_DATA_DIR / "transfer" / f"{address}.csv", index=False)
-
-    # isolate the smart contract
-    contract = []
-    addresses = set(df["from"].tolist() + df["to"].tolist())
-    for addr in addresses:
-        if addr in smart_contract:
-            contract.append(addr)
-    # save the contract data
-    pd.DataFrame({"address": contract}).to_csv(
-        PROCESSED_DATA_DIR / "contract" / f"{address}.csv", index=False
-    )
+    records = store.load(state["block"] + 1, coverage[0][1])
+    if len(records):
+        df = pd.DataFrame(
+            {
+                "event": "Transfer",
+                "logIndex": records["logIndex"],
+                "transactionIndex": records["transactionIndex"],
+                "transactionHash": to_hex(records["transactionHash"]),
+                "address": address,
+                "blockHash": to_hex(records["blockHash"]),
+                "blockNumber": records["blockNumber"],
+                "from": to_hex(records["from"]),
+                "to": to_hex(records["to"]),
+                # exact integers first, uint256 amounts overflow float64 precision
+                "amount": [a / 10**decimal for a in limbs_to_int(records["amount"])],
+            }
+        )
+        df.sort_values("blockNumber", ascending=True, inplace=True)
+        df.to_csv(transfer_path, mode="a", header=state["size"] == 0, index=False)
+
+        # isolate the smart contracts not listed yet
+        listed = (
+            set(pd.read_csv(contract_path)["address"])
+            if contract_path.exists()
+            else set()
+        )
+        contract = ((set(df["from"]) | set(df["to"])) & smart_contract) - listed
+        if contract or not contract_path.exists():
+            pd.DataFrame({"address": sorted(contract)}).to_csv(
+                contract_path,
+                mode="a",
+                header=not contract_path.exists(),
+                index=False,
+            )
+
+    transfer_state[address] = {
+        "block": coverage[0][1],
+        "size": os.path.getsize(transfer_path) if transfer_path.exists() else 0,
+    }
+    save_state()
@@ -0,0 +1,144 @@
+"""Script to verify the replayed token holdings against on-chain balances"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import re
+from ast import literal_eval
+
+import pandas as pd
+from tqdm import tqdm
+
+from governenv.constants import INFURA_ENDPOINTS, PROCESSED_DATA_DIR, STAKING_TOKEN
+from governenv.multicall import balances_of
+from governenv.rpc import RPCPool
+
+ZERO_ADDRESS = "0x" + "0" * 40
+MAX_BLOCKS_IN_FLIGHT = 8
+REPORT_PATH = PROCESSED_DATA_DIR / "holding_verification.csv"
+
+
+def snapshot_blocks(address: str) -> list[int]:
+    """List the blocks with a holding snapshot of a token"""
+    pattern = re.compile(rf"^{address}_(\d+)\.json$")
+    return sorted(
+        int(m.group(1))
+        for f in os.listdir(PROCESSED_DATA_DIR / "holding" / address)
+        if (m := pattern.match(f))
+    )
+
+
+async def verify_snapshot(
+    pool: RPCPool,
+    address: str,
+    decimals: int,
+    block: int,
+    min_holding: float,
+) -> list[dict]:
+    """Compare the holders of one snapshot with their balanceOf at its block"""
+
+    path = PROCESSED_DATA_DIR / "holding" / address / f"{address}_{block}.json"
+    with open(path, "r", encoding="utf-8") as f:
+        snapshot = json.load(f)
+    holders = [
+        holder
+        for holder, info in snapshot.items()
+        if holder != ZERO_ADDRESS and abs(info["holding"]) >= min_holding
+    ]
+
+    balances = await balances_of(pool, address, holders, block)
+
+    mismatches = []
+    for holder, balance in zip(holders, balances):
+        replayed = snapshot[holder]["holding"]
+        onchain = None if balance is None else balance / 10**decimals
+        if onchain is not None and math.isclose(
+            replayed, onchain, rel_tol=1e-9, abs_tol=1e-9
+        ):
+            continue
+        mismatches.append(
+            {
+                "token": address,
+                "block": block,
+                "holder": holder,
+                "contract": snapshot[holder]["contract"],
+                "replayed": replayed,
+                "onchain": onchain,
+            }
+        )
+    return mismatches
+
+
+async def verify_holdings(
+    tokens: dict[str, int], min_holding: float = 0.0
+) -> pd.DataFrame:
+    """Verify every snapshot of the tokens, several blocks in flight at once"""
+
+    semaphore = asyncio.Semaphore(MAX_BLOCKS_IN_FLIGHT)
+    async with RPCPool(INFURA_ENDPOINTS) as pool:
+
+        async def verify(address: str, block: int) -> list[dict]:
+            async with semaphore:
+                return await verify_snapshot(
+                    pool, address, tokens[address], block, min_holding
+                )
+
+        tasks = [
+            verify(address, block)
+            for address in tokens
+            for block in snapshot_blocks(address)
+        ]
+        mismatches = []
+        for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+            mismatches.extend(await task)
+
+    return pd.DataFrame(
+        mismatches,
+        columns=["token", "block", "holder", "contract", "replayed", "onchain"],
+    )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Check the holding snapshots against balanceOf at their blocks."
+    )
+    parser.add_argument("--tokens", nargs="*", help="Token addresses, all by default.")
+    parser.add_argument(
+        "--min-holding",
+        type=float,
+        default=0.0,
+        help="Only check holders with at least this replayed holding.",
+    )
+    parser.add_argument(
+        "--include-staking",
+        action="store_true",
+        help="Also check tokens whose staking transfers are skipped on replay.",
+    )
+    args = parser.parse_args()
+
+    df_proposals = pd.read_csv(PROCESSED_DATA_DIR / "proposals_with_sc_blocks.csv")
+    token_decimals = {
+        token["address"]: int(token["decimals"])
+        for tokens in df_proposals["address"].map(literal_eval)
+        for token in tokens
+        if os.path.exists(PROCESSED_DATA_DIR / "holding" / token["address"])
+    }
+
+    # holdings replayed without staking transfers differ from balanceOf by design
+    staked = {info["address"].lower() for info in STAKING_TOKEN.values()}
+    token_decimals = {
+        address: decimals
+        for address, decimals in token_decimals.items()
+        if (not args.tokens or address in {t.lower() for t in args.tokens})
+        and (args.include_staking or address not in staked)
+    }
+
+    df_mismatch = asyncio.run(verify_holdings(token_decimals, args.min_holding))
+    df_mismatch.to_csv(REPORT_PATH, index=False)
+
+    print(f"{len(df_mismatch)} mismatched holdings in {len(token_decimals)} tokens")
+    for (token, block), group in df_mismatch.groupby(["token", "block"]):
+        print(f"{token} at block {block}: {len(group)} holders differ")
@@ -1,43 +1,29 @@
 """Script to build discussion data"""
 
-from collections import defaultdict
 import json
 
 import pandas as pd
-import numpy as np
 
 from scripts.process.nlp_discussion import df_proposals
+from governenv.batch import BatchResults
 from governenv.constants import PROCESSED_DATA_DIR, CRITERIA
+from governenv.llm import field_probs
 
+RESPONSE_DIR = PROCESSED_DATA_DIR / "discussion" / "response"
 
 # Load the discussion characteristics
-gpt_res = defaultdict(dict)
-
-with open(
-    PROCESSED_DATA_DIR / "discussion" / "response" / "discussion.jsonl",
-    "r",
-    encoding="utf-8",
-) as f:
-    batch_responses = [json.loads(line) for line in f.readlines()]
-
-for response in batch_responses:
-    proposal_id_criterion = response["custom_id"]
-    proposal_id, criterion = proposal_id_criterion.split("_", 1)
-    res = response["response"]["body"]["choices"][0]["logprobs"]["content"][3]["token"]
-    logprob = response["response"]["body"]["choices"][0]["logprobs"]["content"][3][
-        "logprob"
-    ]
-    prob = np.exp(logprob)
-    gpt_res[proposal_id][criterion] = prob if res == "true" else 1 - prob
+gpt_res = BatchResults(RESPONSE_DIR / "criteria.sqlite")
+gpt_res.load(RESPONSE_DIR / "criteria.jsonl")
 
 
 df_proposals_char = []
 for idx, row in df_proposals.iterrows():
     row_char = row.copy()
     proposal_id = row["id"]
+    result = gpt_res[f"{proposal_id}_full"]
+    discussion_data = field_probs(result["content"], result["logprobs"])
     for criterion in CRITERIA:
         criterion = criterion.lower().replace(" ", "_")
-        discussion_data = gpt_res[str(proposal_id)]
         row_char[criterion] = discussion_data[criterion]
 
     df_proposals_char.append(row_char)
@@ -58,28 +44,18 @@ for criterion in CRITERIA:
     df_proposals[criterion] = (df_proposals[criterion] - min_val) / (max_val - min_val)
 
 # Load the stance
-gpt_res = defaultdict(dict)
-
-with open(
-    PROCESSED_DATA_DIR / "discussion" / "response" / "stance.jsonl",
-    "r",
-    encoding="utf-8",
-) as f:
-    batch_responses = [json.loads(line) for line in f.readlines()]
-
-for response in batch_responses:
-    proposal_id = response["custom_id"]
-    res = response["response"]["body"]["choices"][0]["message"]["content"]
-    gpt_res[proposal_id] = json.loads(res)
+gpt_res = BatchResults(RESPONSE_DIR / "stance.sqlite")
+gpt_res.load(RESPONSE_DIR / "stance.jsonl")
 
 df_proposal_stance = []
 for idx, row in df_proposals.iterrows():
     row_char = row.copy()
     proposal_id = row["id"]
-    row_char["pro_management"] = gpt_res[proposal_id]["A"]
-    row_char["pro_token_holder"] = gpt_res[proposal_id]["B"]
-    row_char["pro_user"] = gpt_res[proposal_id]["C"]
-    row_char["neutral"] = gpt_res[proposal_id]["D"]
+    stance = json.loads(gpt_res[proposal_id]["content"])
+    row_char["pro_management"] = stance["A"]
+    row_char["pro_token_holder"] = stance["B"]
+    row_char["pro_user"] = stance["C"]
+    row_char["neutral"] = stance["D"]
     df_proposal_stance.append(row_char)
 
 df_proposals = pd.DataFrame(df_proposal_stance)
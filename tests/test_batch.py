@@ -0,0 +1,93 @@
+"""Tests of the sharded batch runner."""
+
+import contextlib
+import json
+from collections import Counter
+from types import SimpleNamespace
+
+from governenv.batch import BatchRunner
+from governenv.llm import ChatGPT, build_batch
+from governenv.llmcache import ResponseCache
+
+
+class FakeOpenAI:
+    """Files and batches of the OpenAI API that complete on the second poll."""
+
+    def __init__(self):
+        self.uploads = {}
+        self.batches = {}
+        self.files = SimpleNamespace(
+            create=self.create_file,
+            with_streaming_response=SimpleNamespace(content=self.stream_file),
+        )
+        self.batches_api = SimpleNamespace(
+            create=self.create_batch,
+            retrieve=self.retrieve_batch,
+            list=lambda limit: [],
+        )
+
+    def create_file(self, file, purpose):
+        file_id = f"file-{len(self.uploads)}"
+        self.uploads[file_id] = file.read()
+        return SimpleNamespace(id=file_id)
+
+    def create_batch(self, input_file_id, endpoint, completion_window):
+        batch_id = f"batch-{len(self.batches)}"
+        self.batches[batch_id] = {"input": input_file_id, "polls": 0}
+        return SimpleNamespace(id=batch_id)
+
+    def retrieve_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        batch["polls"] += 1
+        if batch["polls"] < 2:
+            return SimpleNamespace(status="in_progress", output_file_id=None)
+        lines = []
+        for line in self.uploads[batch["input"]].decode().splitlines():
+            request = json.loads(line)
+            content = json.dumps({"result": True})
+            body = {"choices": [{"message": {"content": content}}]}
+            lines.append(
+                {
+                    "custom_id": request["custom_id"],
+                    "response": {"status_code": 200, "body": body},
+                    "error": None,
+                }
+            )
+        self.uploads[f"out-{batch_id}"] = "".join(
+            json.dumps(line) + "\n" for line in lines
+        ).encode()
+        return SimpleNamespace(status="completed", output_file_id=f"out-{batch_id}")
+
+    @contextlib.contextmanager
+    def stream_file(self, file_id):
+        data = self.uploads[file_id]
+        yield SimpleNamespace(iter_bytes=lambda chunk_size: [data])
+
+
+def make_gpt(tmp_path) -> ChatGPT:
+    """ChatGPT on the fake API with a response cache in tmp_path."""
+    gpt = ChatGPT(api_key="test")
+    gpt.cache = ResponseCache(tmp_path / "llm_cache.sqlite", gpt.prompt_version)
+    fake = FakeOpenAI()
+    gpt.client = SimpleNamespace(files=fake.files, batches=fake.batches_api)
+    return gpt
+
+
+def test_rerun_writes_every_custom_id_once(tmp_path):
+    gpt = make_gpt(tmp_path)
+    requests = [
+        build_batch(f"id{i}", f"prompt {i}", {"name": "dao"}) for i in range(10)
+    ]
+    output_path = tmp_path / "output.jsonl"
+
+    # small shards so the requests span several batches
+    def runner() -> BatchRunner:
+        return BatchRunner(gpt, tmp_path / "batch", max_requests=3, poll_interval=0)
+
+    runner().run(requests, output_path)
+    # the rerun finds every answer in the response cache and in the ledger
+    runner().run(requests, output_path)
+
+    with open(output_path, "r", encoding="utf-8") as f:
+        counts = Counter(json.loads(line)["custom_id"] for line in f)
+    assert counts == Counter({request["custom_id"]: 1 for request in requests})